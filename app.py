@@ -1,13 +1,14 @@
 """⬡ Gestionale Aziendale — Home"""
 import streamlit as st
-from database import init_db
+from database import init_db, get_bootstrap_report
 from utils.styles import COMMON_CSS
 from utils.auth import check_auth, create_default_admin, logout_button
+from utils.query_stats import query_stats_panel
 
 st.set_page_config(page_title="Gestionale Aziendale", page_icon="⬡",
                    layout="wide", initial_sidebar_state="expanded")
 
-init_db()
+init_db(__file__)
 create_default_admin()
 st.markdown(COMMON_CSS, unsafe_allow_html=True)
 check_auth()
@@ -52,3 +53,13 @@ with col3:
     st.markdown("### 📤 Import/Export\nCaricamento massivo Excel/CSV con template. Export di tutte le tabelle.")
 
 st.info("👈 Usa il menu laterale per navigare tra le sezioni.")
+
+if st.session_state.get("ruolo") == "admin":
+    rep = get_bootstrap_report()
+    if rep:
+        stato = "schema aggiornato" if rep["schema_aggiornato"] else "schema invariato, DDL saltato"
+        fasi = " · ".join(f"{k} {v} ms" for k, v in rep["fasi"].items())
+        st.caption(f"🗄️ Bootstrap DB ({rep['eseguito_il']:%d/%m/%Y %H:%M}): "
+                   f"{rep['durata_ms']} ms — {stato} — {fasi}")
+
+query_stats_panel()
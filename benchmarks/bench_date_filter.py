@@ -0,0 +1,128 @@
+"""
+Benchmark filtri data: EXTRACT(month/year) contro intervallo semiaperto sulla colonna.
+
+Crea una tabella sintetica `bench_prestazioni` con un indice B-tree su
+data_inizio, poi per ogni tipo di filtro confronta piano di esecuzione e tempi
+della vecchia forma (EXTRACT) con quella attuale (apply_date_filter).
+
+    python benchmarks/bench_date_filter.py [--url URL] [--rows 500000] [--repeat 20]
+
+Senza --url usa un file SQLite temporaneo. Su PostgreSQL la tabella viene
+creata e rimossa a fine esecuzione.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import (MetaData, Table, Column, Integer, Date, Numeric, Index,
+                        create_engine, select, func, extract, text)
+from utils.helpers import parse_date_filter, apply_date_filter
+
+meta = MetaData()
+bench = Table(
+    "bench_prestazioni", meta,
+    Column("id", Integer, primary_key=True),
+    Column("data_inizio", Date, nullable=False),
+    Column("importo", Numeric(10, 2), nullable=False),
+    Index("idx_bench_data_inizio", "data_inizio"),
+)
+
+FILTRI = ["2025", "03/2025", "15/03/2025", "01/03/2025-15/04/2025", ">01/12/2025", "<15/01/2024"]
+
+
+def _legacy(stmt, field, f):
+    """Predicati della versione precedente (EXTRACT per anno e mese)."""
+    t = f["tipo"]
+    if t == "anno":
+        return stmt.where(extract("year", field) == f["anno"])
+    if t == "mese_anno":
+        return stmt.where(extract("year", field) == f["anno"], extract("month", field) == f["mese"])
+    if t == "data":
+        return stmt.where(field == f["data"])
+    if t == "dopo":
+        return stmt.where(field > f["data"])
+    if t == "prima":
+        return stmt.where(field < f["data"])
+    return stmt.where(field >= f["da"], field <= f["a"])
+
+
+class _Stmt:
+    """Adatta una select Core all'interfaccia .filter() usata da apply_date_filter."""
+    def __init__(self, stmt):
+        self.stmt = stmt
+
+    def filter(self, *crit):
+        return _Stmt(self.stmt.where(*crit))
+
+
+def _populate(engine, rows):
+    meta.drop_all(engine)
+    meta.create_all(engine)
+    random.seed(42)
+    start = date(2020, 1, 1)
+    batch = []
+    with engine.begin() as conn:
+        for i in range(rows):
+            batch.append({"data_inizio": start + timedelta(days=random.randint(0, 365 * 7)),
+                          "importo": random.randint(100, 100000) / 100})
+            if len(batch) == 10000:
+                conn.execute(bench.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(bench.insert(), batch)
+        if engine.dialect.name == "postgresql":
+            conn.execute(text("ANALYZE bench_prestazioni"))
+        else:
+            conn.execute(text("ANALYZE"))
+
+
+def _plan(conn, stmt):
+    sql = str(stmt.compile(conn, compile_kwargs={"literal_binds": True}))
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    rows = conn.execute(text(prefix + sql)).fetchall()
+    return " | ".join(str(r[-1]) for r in rows)
+
+
+def _time(conn, stmt, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        conn.execute(stmt).fetchall()
+    return (time.perf_counter() - t0) * 1000 / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url")
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    url = args.url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    engine = create_engine(url)
+    print(f"Popolamento {args.rows} righe su {engine.dialect.name}…")
+    _populate(engine, args.rows)
+
+    base = select(func.count(), func.sum(bench.c.importo))
+    try:
+        with engine.connect() as conn:
+            for txt in FILTRI:
+                f = parse_date_filter(txt)
+                old = _legacy(base, bench.c.data_inizio, f)
+                new = apply_date_filter(_Stmt(base), bench.c.data_inizio, f).stmt
+                assert conn.execute(old).one() == conn.execute(new).one(), txt
+                print(f"\n== {txt!r} ({f['tipo']})")
+                print(f"  EXTRACT  {_time(conn, old, args.repeat):8.2f} ms  {_plan(conn, old)}")
+                print(f"  RANGE    {_time(conn, new, args.repeat):8.2f} ms  {_plan(conn, new)}")
+    finally:
+        if engine.dialect.name != "sqlite":
+            meta.drop_all(engine)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark PDF di cortesia.
+
+Genera fatture sintetiche con logo (snapshot, nessun database) e misura
+pagine/secondo ricostruendo stili e immagine del logo per ogni documento (come
+prima della cache), con stili e logo decodificato condivisi da
+utils/pdf_generator.py, e nel pool di processi di utils/xml_pool.py. In modalità
+invariante di reportlab verifica che i PDF siano identici.
+
+    python benchmarks/bench_pdf.py [--fatture 300] [--righe 30] [--workers 4] [--giri 3]
+"""
+import argparse
+import io
+import os
+import re
+import sys
+import time
+from datetime import date
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image as PILImage
+from reportlab import rl_config
+from utils.snapshot import Snapshot, ClienteSnapshot
+from utils import pdf_generator
+from utils.xml_pool import genera_pdf_parallelo, shutdown
+
+_PAGINA = re.compile(rb"/Type /Page\b")
+
+
+def _logo():
+    img = PILImage.new("RGB", (1600, 800), "#1e293b")
+    img.paste(PILImage.new("RGB", (800, 400), "#38bdf8"), (400, 200))
+    buf = io.BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
+
+
+def _dati(n_fatture, n_righe):
+    fatturante = Snapshot(id=1, ragione_sociale="Studio Esempio Srl", partita_iva="01234567890",
+                          codice_fiscale="01234567890", indirizzo="Via Roma 1", cap="00100",
+                          citta="Roma", provincia="RM", paese="IT", regime_fiscale="Ordinario",
+                          iban="IT60X0542811101000000123456", pec="esempio@pec.it",
+                          logo=_logo())
+    lotto = []
+    for i in range(1, n_fatture + 1):
+        cliente = ClienteSnapshot(id=i, titolo="", nome="", cognome_ragione_sociale=f"Cliente {i} Srl",
+                                  partita_iva=f"{i:011d}", codice_fiscale="", codice_sdi="0000000",
+                                  pec=f"c{i}@pec.it", indirizzo="Via Milano 2", cap="20100",
+                                  citta="Milano", provincia="MI", paese="IT", split_payment=False)
+        fattura = Snapshot(id=i, numero=i, anno=2025, data=date(2025, 1, 31))
+        righe = [Snapshot(id=i * 100 + j, descrizione=f"Servizio {j}", periodicita="Mensile",
+                          data_inizio=date(2025, 1, 1), importo_unitario=Decimal("100.00"),
+                          aliquota_iva=22)
+                 for j in range(n_righe)]
+        lotto.append((fattura, righe, fatturante, cliente))
+    return lotto
+
+
+def _misura(genera, lotto, giri):
+    migliore, pdf = None, None
+    for _ in range(giri):
+        t0 = time.perf_counter()
+        pdf = genera(lotto)
+        dt = time.perf_counter() - t0
+        migliore = dt if migliore is None else min(migliore, dt)
+    return migliore, pdf
+
+
+def _seriale(lotto):
+    return [pdf_generator.genera_fattura_pdf(*t) for t in lotto]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--fatture", type=int, default=300)
+    parser.add_argument("--righe", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument("--giri", type=int, default=3)
+    args = parser.parse_args()
+
+    rl_config.invariant = 1
+    lotto = _dati(args.fatture, args.righe)
+    print(f"{args.fatture} fatture × {args.righe} righe, un fatturante, miglior tempo su {args.giri} giri")
+
+    def riga(nome, dt, pdf):
+        pagine = sum(len(_PAGINA.findall(p)) for p in pdf)
+        print(f"  {nome:<14} {dt:7.3f} s  {len(pdf) / dt:7.1f} fatture/s  {pagine / dt:7.1f} pagine/s")
+
+    con_cache = pdf_generator.stili, pdf_generator.logo_reader
+    pdf_generator.stili, pdf_generator.logo_reader = pdf_generator._costruisci_stili, pdf_generator._costruisci_logo
+    try:
+        dt, senza = _misura(_seriale, lotto, args.giri)
+    finally:
+        pdf_generator.stili, pdf_generator.logo_reader = con_cache
+    riga("ricostruiti", dt, senza)
+
+    dt, con = _misura(_seriale, lotto, args.giri)
+    assert con == senza
+    riga("da cache", dt, con)
+
+    # Il primo giro avvia i worker (spawn) e ne riempie le cache: non si conta
+    parallelo = lambda l: [p for p, _, _ in sorted(genera_pdf_parallelo(l, args.workers), key=lambda r: r[2])]
+    parallelo(lotto)
+    dt, pool = _misura(parallelo, lotto, args.giri)
+    shutdown()
+    riga(f"pool {args.workers} proc.", dt, pool)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark frammenti FatturaPA per fatturante.
+
+Genera fatture sintetiche di un solo fatturante (snapshot, nessun database) e
+misura fatture/secondo ricostruendo IdTrasmittente e CedentePrestatore per ogni
+documento (come prima della cache) e copiandoli dalla cache di
+utils/fattura_xml.frammenti_fatturante. Verifica che gli XML siano identici.
+
+    python benchmarks/bench_xml_header.py [--fatture 5000] [--righe 1] [--giri 3]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import date
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.snapshot import Snapshot, ClienteSnapshot
+from utils import fattura_xml
+
+
+def _dati(n_fatture, n_righe):
+    fatturante = Snapshot(id=1, ragione_sociale="Studio Esempio Srl", partita_iva="01234567890",
+                          codice_fiscale="01234567890", indirizzo="Via Roma 1", cap="00100",
+                          citta="Roma", provincia="RM", paese="IT", regime_fiscale="Ordinario",
+                          iban="IT60X0542811101000000123456")
+    lotto = []
+    for i in range(1, n_fatture + 1):
+        cliente = ClienteSnapshot(id=i, nome="", cognome_ragione_sociale=f"Cliente {i} Srl",
+                                  partita_iva=f"{i:011d}", codice_fiscale="", codice_sdi="0000000",
+                                  pec=f"c{i}@pec.it", indirizzo="Via Milano 2", cap="20100",
+                                  citta="Milano", provincia="MI", paese="IT", split_payment=False)
+        fattura = Snapshot(id=i, numero=i, anno=2025, data=date(2025, 1, 31))
+        righe = [Snapshot(id=i * 100 + j, descrizione=f"Servizio {j}", periodicita="Una tantum",
+                          data_inizio=date(2025, 1, 1), importo_unitario=Decimal("100.00"),
+                          aliquota_iva=22)
+                 for j in range(n_righe)]
+        lotto.append((fattura, righe, fatturante, cliente))
+    return lotto
+
+
+def _misura(lotto, giri):
+    migliore, xml = None, None
+    for _ in range(giri):
+        t0 = time.perf_counter()
+        xml = [fattura_xml.genera_fattura_xml(*t)[0] for t in lotto]
+        dt = time.perf_counter() - t0
+        migliore = dt if migliore is None else min(migliore, dt)
+    return migliore, xml
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--fatture", type=int, default=5000)
+    parser.add_argument("--righe", type=int, default=1)
+    parser.add_argument("--giri", type=int, default=3)
+    args = parser.parse_args()
+
+    lotto = _dati(args.fatture, args.righe)
+    print(f"{args.fatture} fatture × {args.righe} righe, un fatturante, miglior tempo su {args.giri} giri")
+
+    con_cache = fattura_xml.frammenti_fatturante
+    fattura_xml.frammenti_fatturante = fattura_xml._costruisci_frammenti
+    try:
+        dt, senza = _misura(lotto, args.giri)
+    finally:
+        fattura_xml.frammenti_fatturante = con_cache
+    print(f"  ricostruiti  {dt:7.3f} s  {len(lotto) / dt:8.0f} fatture/s")
+
+    dt, con = _misura(lotto, args.giri)
+    assert con == senza
+    print(f"  da cache     {dt:7.3f} s  {len(lotto) / dt:8.0f} fatture/s")
+
+
+if __name__ == "__main__":
+    main()
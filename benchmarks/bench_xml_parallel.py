@@ -0,0 +1,78 @@
+"""
+Benchmark generazione XML FatturaPA: seriale contro pool di processi.
+
+Genera fatture sintetiche (snapshot, nessun database) e misura fatture/secondo
+in modalità seriale e con il pool di utils/xml_pool.py per ogni numero di
+worker indicato. Il primo giro del pool include l'avvio dei processi, che
+viene riportato a parte.
+
+    python benchmarks/bench_xml_parallel.py [--fatture 2000] [--righe 5] [--workers 2,4]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.snapshot import Snapshot, ClienteSnapshot
+from utils.fattura_xml import genera_fattura_xml
+from utils import xml_pool
+
+
+def _dati(n_fatture, n_righe):
+    random.seed(42)
+    fatturante = Snapshot(id=1, ragione_sociale="Studio Esempio Srl", partita_iva="01234567890",
+                          codice_fiscale="01234567890", indirizzo="Via Roma 1", cap="00100",
+                          citta="Roma", provincia="RM", paese="IT", regime_fiscale="Ordinario",
+                          iban="IT60X0542811101000000123456")
+    lotto = []
+    for i in range(1, n_fatture + 1):
+        cliente = ClienteSnapshot(id=i, nome="", cognome_ragione_sociale=f"Cliente {i} Srl",
+                                  partita_iva=f"{i:011d}", codice_fiscale="", codice_sdi="0000000",
+                                  pec=f"c{i}@pec.it", indirizzo="Via Milano 2", cap="20100",
+                                  citta="Milano", provincia="MI", paese="IT", split_payment=False)
+        fattura = Snapshot(id=i, numero=i, anno=2025, data=date(2025, 1, 31))
+        righe = [Snapshot(id=i * 100 + j, descrizione=f"Servizio {j}", periodicita="Mensile",
+                          data_inizio=date(2025, 1, 1),
+                          importo_unitario=Decimal(random.randint(1000, 200000)) / 100,
+                          aliquota_iva=random.choice([0, 10, 22]))
+                 for j in range(n_righe)]
+        lotto.append((fattura, righe, fatturante, cliente))
+    return lotto
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--fatture", type=int, default=2000)
+    parser.add_argument("--righe", type=int, default=5)
+    parser.add_argument("--workers", default=",".join(str(w) for w in sorted({2, os.cpu_count() or 2})))
+    args = parser.parse_args()
+
+    lotto = _dati(args.fatture, args.righe)
+    print(f"{args.fatture} fatture × {args.righe} righe, CPU disponibili: {os.cpu_count()}")
+
+    t0 = time.perf_counter()
+    seriale = [genera_fattura_xml(*t) for t in lotto]
+    dt = time.perf_counter() - t0
+    print(f"  seriale      {dt:7.2f} s  {len(seriale) / dt:8.0f} fatture/s")
+
+    for w in (int(x) for x in args.workers.split(",")):
+        t0 = time.perf_counter()
+        xml_pool.get_pool(w).submit(int).result()  # avvio processi
+        for f in [xml_pool.get_pool(w).submit(int) for _ in range(w)]:
+            f.result()
+        avvio = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        parallelo = list(xml_pool.genera_parallelo(lotto, w, valida=False))
+        dt = time.perf_counter() - t0
+        assert sorted(x[0] for x in parallelo) == sorted(x[0] for x in seriale)
+        print(f"  {w} worker     {dt:7.2f} s  {len(parallelo) / dt:8.0f} fatture/s  (avvio pool {avvio:.2f} s)")
+    xml_pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
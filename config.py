@@ -1,4 +1,5 @@
 """Configurazione e costanti del gestionale."""
+import os
 
 MESI = ["Gennaio","Febbraio","Marzo","Aprile","Maggio","Giugno",
         "Luglio","Agosto","Settembre","Ottobre","Novembre","Dicembre"]
@@ -18,3 +19,30 @@ STATO_SDD_OPTIONS = ["Caricato da confermare","Confermato","Insoluto"]
 ALIQUOTA_OPTIONS = [0, 4, 5, 10, 22]
 TITOLO_OPTIONS = ["","Dott.","Dott.ssa","Avv.","Ing.","Arch.","Geom.","Rag.","Prof.","Prof.ssa"]
 RUOLI_UTENTE = ["admin", "operatore", "lettore"]
+PAGE_SIZE_OPTIONS = [50, 100, 250, 500]
+
+# Migrazioni schema: se disattivato le pagine non eseguono DDL e va lanciato
+# `python manage.py migrate` prima di avviare l'app
+AUTO_MIGRATE = os.getenv("GESTIONALE_AUTO_MIGRATE", "1") != "0"
+
+# Strumentazione query: log JSON-lines per rerun (vuoto = disattivato) e soglia
+# di ripetizioni della stessa SELECT oltre cui si segnala un probabile N+1
+QUERY_LOG_PATH = os.getenv("GESTIONALE_QUERY_LOG", "logs/query_stats.jsonl")
+N_PLUS_ONE_SOGLIA = int(os.getenv("GESTIONALE_N_PLUS_ONE", "10"))
+
+# Generazione XML in parallelo: processi worker (<= 1 = sempre seriale) e numero
+# minimo di fatture per cui conviene avviare il pool
+XML_WORKERS = int(os.getenv("GESTIONALE_XML_WORKERS", str(min(4, os.cpu_count() or 1))))
+XML_PARALLELO_SOGLIA = int(os.getenv("GESTIONALE_XML_PARALLELO_SOGLIA", "200"))
+# Un PDF costa molto più di un XML: il pool conviene già con lotti piccoli
+PDF_PARALLELO_SOGLIA = int(os.getenv("GESTIONALE_PDF_PARALLELO_SOGLIA", "20"))
+
+# Archivi ZIP delle fatture: livello di compressione (0 = solo archiviazione,
+# 1-9 deflate) e dimensione oltre cui l'archivio passa dalla memoria al disco
+ZIP_LIVELLO = int(os.getenv("GESTIONALE_ZIP_LIVELLO", "6"))
+ZIP_SPOOL_MB = int(os.getenv("GESTIONALE_ZIP_SPOOL_MB", "32"))
+
+# Tracciati SDD: transazioni e somma di controllo (euro) massime per file,
+# oltre le quali il tracciato si divide in più file (0 = nessun limite)
+SDD_MAX_TRANSAZIONI = int(os.getenv("GESTIONALE_SDD_MAX_TRANSAZIONI", "0"))
+SDD_MAX_IMPORTO = int(os.getenv("GESTIONALE_SDD_MAX_IMPORTO", "0"))
@@ -0,0 +1,109 @@
+"""
+Comandi di amministrazione da riga di comando (fuori da Streamlit).
+
+    python manage.py migrate [--dry-run] [--url URL]
+    python manage.py status [--url URL]
+    python manage.py riconcilia [--fix] [--url URL]
+    python manage.py verifica-numerazione [--fatturante ID] [--anno AAAA] [--url URL]
+
+L'URL del database si legge, in ordine, da --url, dai secrets Streamlit
+(`[database] url`) o dalla variabile d'ambiente DATABASE_URL.
+"""
+import argparse
+import sys
+from database import _get_database_url, create_engine_from_url
+
+
+def _engine(args):
+    url = args.url or _get_database_url()
+    if not url:
+        sys.exit("Database non configurato: usa --url oppure DATABASE_URL.")
+    return create_engine_from_url(url)
+
+
+def cmd_migrate(args):
+    from utils.migrations import migrate
+    migrate(_engine(args), dry_run=args.dry_run)
+    if args.dry_run:
+        print("Dry-run: nessuna modifica applicata.")
+
+
+def cmd_status(args):
+    from utils.migrations import MIGRATIONS, applied_versions
+    with _engine(args).connect() as conn:
+        done = applied_versions(conn)
+    for versione, descrizione, _ in MIGRATIONS:
+        print(f"[{'x' if versione in done else ' '}] {versione:04d} — {descrizione}")
+    from utils.validazione_xml import origine_schemi
+    for ufficiale, origine in origine_schemi().items():
+        print(f"XSD {ufficiale}: {origine}")
+
+
+def cmd_riconcilia(args):
+    from utils.saldi import riconcilia
+    with _engine(args).begin() as conn:
+        righe = riconcilia(conn, fix=args.fix)
+    for r in righe[:50]:
+        print(f"#{r.id}: totale {r.totale} → {r.totale_atteso}, "
+              f"incassato {r.totale_incassato_confermato} → {r.incassato_atteso}, "
+              f"residuo {r.credito_residuo} → {r.residuo_atteso}")
+    if len(righe) > 50:
+        print(f"… e altre {len(righe) - 50}")
+    if not righe:
+        print("Saldi allineati: nessuna differenza.")
+    elif args.fix:
+        print(f"{len(righe)} prestazioni riallineate.")
+    else:
+        print(f"{len(righe)} prestazioni con saldi non allineati (usa --fix per correggere).")
+        sys.exit(1)
+
+
+def cmd_verifica_numerazione(args):
+    from utils.numerazione import verifica_numerazione
+    with _engine(args).connect() as conn:
+        esito = verifica_numerazione(conn, args.fatturante, args.anno)
+    for r in esito["buchi"]:
+        mancanti = str(r.da) if r.da == r.a else f"{r.da}–{r.a}"
+        print(f"Buco: fatturante {r.fatturante_id}, anno {r.anno}: mancano {mancanti}")
+    for r in esito["duplicati"]:
+        print(f"Duplicato: fatturante {r.fatturante_id}, anno {r.anno}: n. {r.numero} ×{r.quante}")
+    for r in esito["contatori"]:
+        print(f"Contatore indietro: fatturante {r.fatturante_id}, anno {r.anno}: "
+              f"{r.contatore} < {r.massimo}")
+    if not any(esito.values()):
+        print("Numerazione regolare.")
+    elif esito["buchi"] or esito["duplicati"]:
+        sys.exit(1)
+
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--url", help="URL SQLAlchemy del database")
+    parser = argparse.ArgumentParser(description="Gestionale — comandi di amministrazione")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("migrate", parents=[common], help="applica le migrazioni mancanti")
+    p.add_argument("--dry-run", action="store_true",
+                   help="mostra DDL e impatto stimato senza applicare")
+    p.set_defaults(func=cmd_migrate)
+
+    p = sub.add_parser("status", parents=[common], help="elenca le migrazioni e il loro stato")
+    p.set_defaults(func=cmd_status)
+
+    p = sub.add_parser("riconcilia", parents=[common],
+                       help="ricalcola totale/incassato/residuo delle prestazioni e segnala differenze")
+    p.add_argument("--fix", action="store_true", help="riallinea i saldi non corretti")
+    p.set_defaults(func=cmd_riconcilia)
+
+    p = sub.add_parser("verifica-numerazione", parents=[common],
+                       help="cerca buchi e duplicati nella numerazione delle fatture")
+    p.add_argument("--fatturante", type=int, help="id del soggetto fatturante")
+    p.add_argument("--anno", type=int)
+    p.set_defaults(func=cmd_verifica_numerazione)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,13 @@
 """
 Gestionale Aziendale — Modelli Database (SQLAlchemy)
-Tabelle: User, SavedFilter, Cliente, ContoRicavo, SoggettoFatturante, Fattura, Prestazione, Incasso
+Tabelle: User, SavedFilter, Cliente, ContoRicavo, SoggettoFatturante, NumerazioneFattura,
+Fattura, DocumentoFattura, Prestazione, Incasso, SddBatch, SddBatchFile
 """
 from sqlalchemy import (
     Column, Integer, String, Boolean, Date, DateTime, Numeric, Text, LargeBinary,
-    ForeignKey, UniqueConstraint, JSON
+    ForeignKey, UniqueConstraint, Index, JSON, text
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred, synonym
 from database import Base
 from datetime import datetime
 
@@ -114,19 +115,30 @@ class SoggettoFatturante(Base):
     pec = Column(String(255), default="")
     codice_sdi = Column(String(7), default="0000000")
     iban = Column(String(34), default="")
-    logo = Column(LargeBinary, nullable=True)
+    # Colonne usate solo da PDF / email: caricate su richiesta (vedi helpers.load_fatturante)
+    logo = deferred(Column(LargeBinary, nullable=True), group="logo")
     logo_filename = Column(String(255), default="")
-    smtp_host = Column(String(255), default="")
-    smtp_port = Column(Integer, default=587)
-    smtp_user = Column(String(255), default="")
-    smtp_password = Column(String(255), default="")
-    smtp_from = Column(String(255), default="")
+    smtp_host = deferred(Column(String(255), default=""), group="smtp")
+    smtp_port = deferred(Column(Integer, default=587), group="smtp")
+    smtp_user = deferred(Column(String(255), default=""), group="smtp")
+    smtp_password = deferred(Column(String(255), default=""), group="smtp")
+    smtp_from = deferred(Column(String(255), default=""), group="smtp")
     created_at = Column(DateTime, default=datetime.utcnow)
 
     prestazioni = relationship("Prestazione", back_populates="fatturante")
     fatture = relationship("Fattura", back_populates="fatturante")
 
 
+class NumerazioneFattura(Base):
+    """Ultimo numero fattura assegnato per soggetto fatturante e anno (vedi utils/numerazione.py)."""
+    __tablename__ = "numerazione_fatture"
+    fatturante_id = Column(Integer, ForeignKey("soggetti_fatturanti.id"), primary_key=True,
+                           autoincrement=False)
+    anno = Column(Integer, primary_key=True, autoincrement=False)
+    ultimo_numero = Column(Integer, nullable=False, default=0)
+    aggiornato_il = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
 class Fattura(Base):
     __tablename__ = "fatture"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -153,6 +165,24 @@ class Fattura(Base):
     righe = relationship("Prestazione", back_populates="fattura")
 
 
+class DocumentoFattura(Base):
+    """XML / PDF generati per una fattura (vedi utils/documenti.py)."""
+    __tablename__ = "documenti_fattura"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    fattura_id = Column(Integer, ForeignKey("fatture.id"), nullable=False)
+    tipo = Column(String(10), nullable=False)  # "xml" / "pdf"
+    impronta = Column(String(64), nullable=False)  # sha256 dei dati di input
+    sha256 = Column(String(64), nullable=False)  # sha256 del contenuto
+    filename = Column(String(255), default="")
+    dimensione = Column(Integer, default=0)
+    contenuto = deferred(Column(LargeBinary, nullable=False))
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("fattura_id", "tipo", "impronta", name="uq_documento_fattura"),
+    )
+
+
 class Prestazione(Base):
     __tablename__ = "prestazioni"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -170,6 +200,10 @@ class Prestazione(Base):
     note = Column(Text, default="")
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Saldi memorizzati, mantenuti da utils/saldi.py (eventi di sessione)
+    totale = Column(Numeric(12, 2), nullable=False, default=0)
+    totale_incassato_confermato = Column(Numeric(12, 2), nullable=False, default=0)
+    credito_residuo = Column(Numeric(12, 2), nullable=False, default=0)
 
     cliente = relationship("Cliente", back_populates="prestazioni")
     conto_ricavo = relationship("ContoRicavo", back_populates="prestazioni")
@@ -179,19 +213,11 @@ class Prestazione(Base):
 
     @property
     def importo_iva(self):
-        return float(self.importo_unitario or 0) * (self.aliquota_iva or 0) / 100
-
-    @property
-    def totale(self):
-        return float(self.importo_unitario or 0) + self.importo_iva
+        from utils import importi
+        return importi.euro(importi.iva(importi.centesimi(self.importo_unitario), self.aliquota_iva))
 
-    @property
-    def totale_incassato(self):
-        return sum(float(i.importo) for i in self.incassi if i.stato == "Confermato")
-
-    @property
-    def credito_residuo(self):
-        return self.totale - self.totale_incassato
+    # Alias storico della colonna memorizzata
+    totale_incassato = synonym("totale_incassato_confermato")
 
     @property
     def is_fatturata(self):
@@ -207,7 +233,50 @@ class Incasso(Base):
     stato = Column(String(30), default="Confermato")
     modalita = Column(String(20), default="Bonifico")
     riferimento = Column(String(100), default="")
+    end_to_end_id = Column(String(35), index=True)  # EndToEndId del tracciato SDD
+    sdd_batch_id = Column(Integer, ForeignKey("sdd_batch.id"), nullable=True, index=True)
     note = Column(Text, default="")
     created_at = Column(DateTime, default=datetime.utcnow)
 
     prestazione = relationship("Prestazione", back_populates="incassi")
+    sdd_batch = relationship("SddBatch", back_populates="incassi")
+
+
+class SddBatch(Base):
+    """Tracciato SDD generato con i suoi incassi (vedi utils/sdd_batch.py)."""
+    __tablename__ = "sdd_batch"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chiave = Column(String(64), nullable=False, index=True)  # sha256 di fatturante, data e addebiti
+    fatturante_id = Column(Integer, ForeignKey("soggetti_fatturanti.id"), nullable=False)
+    data_addebito = Column(Date, nullable=False)
+    stato = Column(String(20), default="Generato")  # Generato / Annullato
+    n_transazioni = Column(Integer, default=0)
+    totale = Column(Numeric(12, 2), default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    annullato_il = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # Un solo batch attivo per chiave: due click concorrenti non creano due tracciati
+        Index("uq_sdd_batch_chiave_attivo", "chiave", unique=True,
+              postgresql_where=text("stato = 'Generato'"), sqlite_where=text("stato = 'Generato'")),
+    )
+
+    fatturante = relationship("SoggettoFatturante")
+    files = relationship("SddBatchFile", back_populates="batch", order_by="SddBatchFile.progressivo",
+                         cascade="all, delete-orphan")
+    incassi = relationship("Incasso", back_populates="sdd_batch")
+
+
+class SddBatchFile(Base):
+    """File pain.008 di un SddBatch, con MsgId e PmtInfId scritti nel tracciato."""
+    __tablename__ = "sdd_batch_file"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    batch_id = Column(Integer, ForeignKey("sdd_batch.id"), nullable=False, index=True)
+    progressivo = Column(Integer, nullable=False)
+    msg_id = Column(String(35), nullable=False)
+    pmt_inf_ids = Column(Text, default="")  # separati da virgola
+    filename = Column(String(255), default="")
+    sha256 = Column(String(64), nullable=False)
+    contenuto = deferred(Column(LargeBinary, nullable=False))
+
+    batch = relationship("SddBatch", back_populates="files")
@@ -9,9 +9,10 @@ from config import MODALITA_INCASSO_OPTIONS
 from utils.helpers import format_currency, calc_periodicity_label
 from utils.styles import COMMON_CSS
 from utils.auth import check_auth, logout_button
+from utils.query_stats import query_stats_panel
 
 st.set_page_config(page_title="Incassi Prestazione", page_icon="💰", layout="wide")
-init_db(); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
+init_db(__file__); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
 
 params = st.query_params
 prest_id = params.get("id")
@@ -109,3 +110,4 @@ try:
 
 finally:
     session.close()
+    query_stats_panel()
@@ -5,10 +5,11 @@ from database import get_session, init_db
 from models import User
 from config import RUOLI_UTENTE
 from utils.auth import check_auth, logout_button, require_role, hash_password
+from utils.query_stats import query_stats_panel
 from utils.styles import COMMON_CSS
 
 st.set_page_config(page_title="Utenti", page_icon="🔐", layout="wide")
-init_db(); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
+init_db(__file__); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
 require_role("admin")
 
 st.markdown('<div class="page-header"><h2>🔐 Gestione Utenti</h2></div>', unsafe_allow_html=True)
@@ -101,3 +102,4 @@ try:
                 st.success("✅ Password cambiata!")
 finally:
     session.close()
+    query_stats_panel()
@@ -2,23 +2,29 @@
 import streamlit as st
 import pandas as pd
 from datetime import date
-from decimal import Decimal
 from database import get_session, init_db
-from models import (Prestazione, Cliente, ContoRicavo, SoggettoFatturante,
-                    Fattura, Incasso, SavedFilter)
+from models import Prestazione, Fattura, Incasso, SavedFilter
 from config import (MESI, MESI_SHORT, PERIODICITA_OPTIONS, MODALITA_INCASSO_OPTIONS,
-                    ALIQUOTA_OPTIONS)
-from utils.helpers import (format_currency, calc_periodicity_label, add_period,
-                           get_next_fattura_number, parse_date_filter, apply_date_filter)
-from utils.fattura_xml import genera_fattura_xml, genera_zip_fatture
-from utils.sdd_sepa_xml import genera_sdd_xml
+                    ALIQUOTA_OPTIONS, PAGE_SIZE_OPTIONS)
+from utils.helpers import format_currency, calc_periodicity_label, parse_date_filter
+from utils.importi import centesimi, euro
+from utils.prestazioni_query import (applica_filtri, metriche_prestazioni,
+                                     pagina_prestazioni, ids_prestazioni)
+from utils.prestazioni_bulk import duplica_prestazioni
+from utils.emissione import anteprima_emissione, emetti_fatture
+from utils.fattura_xml import genera_zip_fatture
+from utils.fatture_batch import genera_xml
+from utils.sdd_batch import crea_batch, file_batch, addebiti_in_sospeso, AddebitiInSospeso
+from utils.validazione_xml import XMLNonValido, formatta_errori
+from utils.validazione_sdd import valida_clienti_sdd, valida_creditore
+from utils.lookup_cache import get_clienti, get_conti, get_fatturanti
 from utils.styles import COMMON_CSS
 from utils.auth import check_auth, logout_button
-from sqlalchemy import extract
+from utils.query_stats import query_stats_panel
 from sqlalchemy.orm import joinedload
 
 st.set_page_config(page_title="Dashboard", page_icon="📊", layout="wide")
-init_db()
+init_db(__file__)
 st.markdown(COMMON_CSS, unsafe_allow_html=True)
 check_auth()
 logout_button()
@@ -38,10 +44,10 @@ st.markdown('<div class="page-header"><h2>📊 Dashboard Prestazioni</h2></div>'
 
 session = get_session()
 try:
-    # === LOAD LOOKUPS (una sola query ciascuno, cached) ===
-    clienti = {c.id: c for c in session.query(Cliente).order_by(Cliente.cognome_ragione_sociale).all()}
-    conti = {c.id: c for c in session.query(ContoRicavo).order_by(ContoRicavo.codice).all()}
-    fatturanti = {f.id: f for f in session.query(SoggettoFatturante).order_by(SoggettoFatturante.ragione_sociale).all()}
+    # === LOAD LOOKUPS (cache condivisa tra sessioni, invalidata al commit) ===
+    clienti = get_clienti()
+    conti = get_conti()
+    fatturanti = get_fatturanti()
 
     if not fatturanti:
         st.warning("⚠️ Aggiungi almeno un Soggetto Fatturante, un Conto Ricavo e un Cliente.")
@@ -148,14 +154,13 @@ try:
             st.rerun()
 
     # =============================================
-    # QUERY PRESTAZIONI (ottimizzata con joinedload)
+    # QUERY PRESTAZIONI (paginata, solo la finestra visibile)
     # =============================================
     q = session.query(Prestazione).options(
         joinedload(Prestazione.cliente),
         joinedload(Prestazione.conto_ricavo),
         joinedload(Prestazione.fatturante),
         joinedload(Prestazione.fattura),
-        joinedload(Prestazione.incassi),
     )
 
     if st.session_state.filter_mode == "advanced":
@@ -163,58 +168,48 @@ try:
         st.markdown('<div class="month-banner">🔍 Filtro avanzato attivo</div>',
                     unsafe_allow_html=True)
 
-        # Filtro data testuale
-        date_filter_parsed = parse_date_filter(flt_date)
-        if date_filter_parsed:
-            q = apply_date_filter(q, Prestazione.data_inizio, date_filter_parsed)
-
-        # Filtri aggiuntivi
-        if flt_cl != "Tutti":
-            cid = next((c.id for c in clienti.values() if c.denominazione == flt_cl), None)
-            if cid:
-                q = q.filter(Prestazione.cliente_id == cid)
-        if flt_cr != "Tutti":
-            cod = flt_cr.split(" - ")[0]
-            crid = next((c.id for c in conti.values() if c.codice == cod), None)
-            if crid:
-                q = q.filter(Prestazione.conto_ricavo_id == crid)
-        if flt_ft != "Tutti":
-            fid = next((f.id for f in fatturanti.values() if f.ragione_sociale == flt_ft), None)
-            if fid:
-                q = q.filter(Prestazione.fatturante_id == fid)
-        if flt_per != "Tutte":
-            q = q.filter(Prestazione.periodicita == flt_per)
-        if flt_stato == "Fatturato":
-            q = q.filter(Prestazione.fattura_id.isnot(None))
-        elif flt_stato == "Non fatturato":
-            q = q.filter(Prestazione.fattura_id.is_(None))
+        cod = flt_cr.split(" - ")[0]
+        filtri = {
+            "data": parse_date_filter(flt_date),
+            "cliente_id": next((c.id for c in clienti.values() if c.denominazione == flt_cl), None),
+            "conto_ricavo_id": next((c.id for c in conti.values() if c.codice == cod), None),
+            "fatturante_id": next((f.id for f in fatturanti.values() if f.ragione_sociale == flt_ft), None),
+            "periodicita": flt_per if flt_per != "Tutte" else None,
+            "stato": flt_stato,
+        }
     else:
         # Filtro rapido mese/anno
-        q = q.filter(
-            extract("month", Prestazione.data_inizio) == sel_m,
-            extract("year", Prestazione.data_inizio) == sel_y
-        )
-
-    prestazioni = q.order_by(Prestazione.data_inizio, Prestazione.cliente_id).all()
+        filtri = {"mese": sel_m, "anno": sel_y}
 
-    # Pulisci selezione: rimuovi ID non più nell'elenco corrente
-    valid_ids = {p.id for p in prestazioni}
-    st.session_state.selected_ids = st.session_state.selected_ids & valid_ids
+    # Pulisci selezione: rimuovi ID non più nei filtri correnti (su tutte le pagine)
+    if st.session_state.selected_ids:
+        st.session_state.selected_ids = ids_prestazioni(session, filtri,
+                                                        tra=st.session_state.selected_ids)
 
     # =============================================
-    # METRICHE
+    # METRICHE (aggregate in SQL, anche come conteggio totale)
     # =============================================
-    tot = sum(p.totale for p in prestazioni)
-    inc = sum(p.totale_incassato for p in prestazioni)
-    fat = sum(p.totale for p in prestazioni if p.is_fatturata)
-    nfat = sum(p.totale for p in prestazioni if not p.is_fatturata)
+    met = metriche_prestazioni(session, filtri)
+
+    # Paginazione keyset: page_keys[i] è la chiave dell'ultima riga prima della pagina i
+    page_size = st.session_state.get("page_size", PAGE_SIZE_OPTIONS[1])
+    page_sig = repr((sorted(filtri.items()), page_size))
+    if st.session_state.get("page_sig") != page_sig:
+        st.session_state.page_sig = page_sig
+        st.session_state.page_keys = [None]
+    page_idx = len(st.session_state.page_keys) - 1
+    n_pagine = max(1, -(-met["n"] // page_size))
+
+    prestazioni, next_key = pagina_prestazioni(applica_filtri(q, filtri),
+                                               dopo=st.session_state.page_keys[-1],
+                                               limite=page_size)
 
     m1, m2, m3, m4, m5 = st.columns(5)
-    m1.metric("Totale", format_currency(tot), f"{len(prestazioni)} record")
-    m2.metric("Fatturato", format_currency(fat))
-    m3.metric("Non fatturato", format_currency(nfat))
-    m4.metric("Incassato", format_currency(inc))
-    m5.metric("Residuo", format_currency(tot - inc))
+    m1.metric("Totale", format_currency(met["totale"]), f"{met['n']} record")
+    m2.metric("Fatturato", format_currency(met["fatturato"]))
+    m3.metric("Non fatturato", format_currency(met["non_fatturato"]))
+    m4.metric("Incassato", format_currency(met["incassato"]))
+    m5.metric("Residuo", format_currency(met["residuo"]))
 
     # =============================================
     # PULSANTI AZIONE (riga 1 e 2)
@@ -241,7 +236,7 @@ try:
     # =============================================
     sa1, sa2, sa3, sa4 = st.columns([1, 1, 2, 4])
     if sa1.button("☑️ Selez. tutto", use_container_width=True):
-        st.session_state.selected_ids = {p.id for p in prestazioni}
+        st.session_state.selected_ids = ids_prestazioni(session, filtri)
         st.rerun()
     if sa2.button("⬜ Deselez. tutto", use_container_width=True):
         st.session_state.selected_ids = set()
@@ -253,7 +248,21 @@ try:
     ]
     raggruppamento = sa3.selectbox("Raggruppa per", RAGGRUPPAMENTI, key="raggr",
                                    label_visibility="collapsed")
-    sa4.markdown(f"**{len(st.session_state.selected_ids)}** selezionate su **{len(prestazioni)}**")
+    sa4.markdown(f"**{len(st.session_state.selected_ids)}** selezionate su **{met['n']}**")
+
+    # Navigazione pagine
+    pg1, pg2, pg3, pg4 = st.columns([1, 2, 1, 2])
+    if pg1.button("◀ Prec.", use_container_width=True, disabled=page_idx == 0):
+        st.session_state.page_keys.pop()
+        st.rerun()
+    pg2.markdown(f"<div style='text-align:center;padding-top:6px;'>Pagina <b>{page_idx + 1}</b> "
+                 f"di <b>{n_pagine}</b></div>", unsafe_allow_html=True)
+    if pg3.button("Succ. ▶", use_container_width=True, disabled=next_key is None):
+        st.session_state.page_keys.append(next_key)
+        st.rerun()
+    pg4.selectbox("Righe per pagina", PAGE_SIZE_OPTIONS, key="page_size",
+                  index=PAGE_SIZE_OPTIONS.index(page_size), label_visibility="collapsed",
+                  format_func=lambda n: f"{n} righe per pagina")
 
     # Link nuova prestazione
     st.markdown(
@@ -341,9 +350,9 @@ try:
                     "Descrizione": (p.descrizione + pl)[:50],
                     "Importo": float(p.importo_unitario or 0),
                     "IVA%": p.aliquota_iva,
-                    "Totale": round(p.totale, 2),
-                    "Incassato": round(p.totale_incassato, 2),
-                    "Residuo": round(p.credito_residuo, 2),
+                    "Totale": float(p.totale),
+                    "Incassato": float(p.totale_incassato_confermato),
+                    "Residuo": float(p.credito_residuo),
                     "Mod": (p.modalita_incasso or "")[:4],
                     "Fatt.": f"{fa.numero}/{fa.anno}" if fa else "—",
                     "Per": (p.periodicita or "")[:3],
@@ -352,7 +361,7 @@ try:
             df = pd.DataFrame(rows)
 
             # Chiave unica per data_editor per gruppo
-            safe_key = f"tbl_{hash(group_name) % 100000}"
+            safe_key = f"tbl_{hash((page_sig, page_idx, group_name)) % 100000}"
 
             edited = st.data_editor(
                 df.drop(columns=["_id"]),
@@ -427,7 +436,6 @@ try:
         id_list = [int(i) for i in sids]
         return session.query(Prestazione).options(
             joinedload(Prestazione.cliente),
-            joinedload(Prestazione.incassi),
         ).filter(Prestazione.id.in_(id_list)).all()
 
     # --- ELIMINA ---
@@ -473,20 +481,7 @@ try:
         st.info(f"📋 **Duplicare {len(sids)} prestazioni ({label})?**")
         dd1, dd2 = st.columns(2)
         if dd1.button("✅ Sì, duplica", type="primary", key="yes_dup"):
-            psel = _load_selected()
-            new_ids = set()
-            for p in psel:
-                di = p.data_inizio if period == "same" else add_period(p.data_inizio, period)
-                df_new = p.data_fine if period == "same" else add_period(p.data_fine, period)
-                new_p = Prestazione(
-                    cliente_id=p.cliente_id, conto_ricavo_id=p.conto_ricavo_id,
-                    fatturante_id=p.fatturante_id, periodicita=p.periodicita,
-                    descrizione=p.descrizione, importo_unitario=p.importo_unitario,
-                    aliquota_iva=p.aliquota_iva, data_inizio=di, data_fine=df_new,
-                    modalita_incasso=p.modalita_incasso, note=p.note or "")
-                session.add(new_p)
-                session.flush()
-                new_ids.add(new_p.id)
+            new_ids = set(duplica_prestazioni(session, sids, period))
             session.commit()
             st.session_state.selected_ids = new_ids
             st.session_state.pop("confirm_action", None)
@@ -498,60 +493,47 @@ try:
 
     # --- EMETTI FATTURE ---
     if btn_emetti and not _no_sel():
-        psel = _load_selected()
-        gia_fatt = [p for p in psel if p.is_fatturata]
-        if gia_fatt:
-            st.error(f"⚠️ {len(gia_fatt)} prestazioni hanno GIÀ una fattura. Deselezionale.")
+        n_gia = session.query(Prestazione.id).filter(
+            Prestazione.id.in_([int(i) for i in sids]), Prestazione.fattura_id.isnot(None)).count()
+        if n_gia:
+            st.error(f"⚠️ {n_gia} prestazioni hanno GIÀ una fattura. Deselezionale.")
         else:
-            fatt_ids = set(p.fatturante_id for p in psel)
-            if len(fatt_ids) > 1:
-                nomi = [fatturanti[fid].ragione_sociale for fid in fatt_ids if fid in fatturanti]
-                st.error(f"⚠️ Fatturanti diversi: {', '.join(nomi)}. Filtra prima per fatturante.")
-            else:
-                st.session_state["confirm_action"] = "emetti"
+            st.session_state["confirm_action"] = "emetti"
 
     if st.session_state.get("confirm_action") == "emetti":
-        psel = _load_selected()
-        psel = [p for p in psel if not p.is_fatturata]
-        if psel:
+        gruppi_em = anteprima_emissione(session, sids)
+        if gruppi_em:
             st.markdown("### 📄 Anteprima Emissione Fattura")
             data_em = st.date_input("📅 Data emissione", value=date.today(), key="dt_em")
 
-            groups_fatt = {}
-            for p in psel:
-                groups_fatt.setdefault(p.cliente_id, []).append(p)
-
-            for cid, prests in groups_fatt.items():
-                cl = clienti.get(cid)
-                tot_g = sum(p.totale for p in prests)
-                st.markdown(f"**{cl.denominazione if cl else '-'}** — {len(prests)} righe — "
-                            f"{format_currency(tot_g)}")
-                for p in prests:
-                    st.caption(f"  • {p.descrizione} — {format_currency(p.importo_unitario)} + IVA {p.aliquota_iva}%")
+            for g in gruppi_em:
+                cl = clienti.get(g["cliente_id"])
+                ft = fatturanti.get(g["fatturante_id"])
+                aliq = " · ".join(f"IVA {a}%: {format_currency(imp)} + {format_currency(iva)}"
+                                  for a, (imp, iva) in sorted(g["aliquote"].items()))
+                st.markdown(f"**{cl.denominazione if cl else '-'}** — {g['n_righe']} righe — "
+                            f"{format_currency(g['totale'])}"
+                            + (f" — _{ft.ragione_sociale}_" if ft and len(fatturanti) > 1 else ""))
+                st.caption(f"  {aliq}")
 
             ef1, ef2 = st.columns(2)
             if ef1.button("✅ Conferma emissione", type="primary", key="yes_em"):
-                fatt_id = psel[0].fatturante_id
-                for cid, prests in groups_fatt.items():
-                    num = get_next_fattura_number(session, fatt_id, data_em.year)
-                    t_imp = sum(float(p.importo_unitario) for p in prests)
-                    t_iva = sum(p.importo_iva for p in prests)
-                    t_tot = sum(p.totale for p in prests)
-                    f = Fattura(numero=num, anno=data_em.year, data=data_em, cliente_id=cid,
-                                fatturante_id=fatt_id, totale_imponibile=Decimal(str(t_imp)),
-                                totale_iva=Decimal(str(t_iva)), totale=Decimal(str(t_tot)))
-                    session.add(f)
-                    session.flush()
-                    for p in prests:
-                        p.fattura_id = f.id
-                session.commit()
-                st.session_state.selected_ids = set()
-                st.session_state.pop("confirm_action", None)
-                st.success(f"✅ {len(groups_fatt)} fattura/e emessa/e!")
-                st.rerun()
+                try:
+                    nuove = emetti_fatture(session, sids, data_em)
+                    session.commit()
+                except ValueError as e:
+                    session.rollback()
+                    st.error(f"⚠️ {e}")
+                else:
+                    st.session_state.selected_ids = set()
+                    st.session_state.pop("confirm_action", None)
+                    st.success(f"✅ {len(nuove)} fattura/e emessa/e!")
+                    st.rerun()
             if ef2.button("❌ Annulla", key="no_em"):
                 st.session_state.pop("confirm_action", None)
                 st.rerun()
+        else:
+            st.session_state.pop("confirm_action", None)
 
     # --- INCASSA I SELEZIONATI ---
     if btn_incassa and not _no_sel():
@@ -580,7 +562,7 @@ try:
             if ii1.button("✅ Conferma incasso", type="primary", key="yes_inc"):
                 for p in psel_cr:
                     session.add(Incasso(
-                        prestazione_id=p.id, importo=Decimal(str(round(p.credito_residuo, 2))),
+                        prestazione_id=p.id, importo=euro(centesimi(p.credito_residuo)),
                         data=data_inc, stato="Confermato", modalita=mod_inc))
                 session.commit()
                 st.session_state.pop("confirm_action", None)
@@ -614,25 +596,39 @@ try:
             st.markdown("### 🏦 Anteprima Tracciato SDD SEPA")
             data_add = st.date_input("📅 Data addebito", value=date.today(), key="dt_sdd")
 
-            anomalie = []
+            # Primo addebito (FRST) per i clienti senza incassi SDD precedenti
+            gia_addebitati = {r[0] for r in session.query(Prestazione.cliente_id).join(Incasso)
+                              .filter(Incasso.modalita == "SDD SEPA",
+                                      Prestazione.cliente_id.in_({p.cliente_id for p in psel_sdd}))
+                              .distinct()}
+            ft = fatturanti[psel_sdd[0].fatturante_id]
+            errori_creditore = valida_creditore(ft)
+            # IBAN, mandati e duplicati controllati una volta per tutto il lotto
+            clienti_sdd = {p.cliente.id: p.cliente for p in psel_sdd if p.cliente}
+            controlli = valida_clienti_sdd(clienti_sdd.values(), data_add)
+            sospesi = addebiti_in_sospeso(session, [p.id for p in psel_sdd])
+            anomalie = list(errori_creditore)
             inc_data = []
+            for cl in clienti_sdd.values():
+                c = controlli.get(cl.id)
+                if c:
+                    anomalie.extend(f"{cl.denominazione}: {a}" for a in c["errori"] + c["avvisi"])
             for p in psel_sdd:
                 cl = p.cliente
                 if not cl:
                     anomalie.append(f"Prestazione #{p.id}: cliente non trovato")
                     continue
-                if not cl.sdd_attivo:
-                    anomalie.append(f"{cl.denominazione}: SDD non attivo")
+                if cl.id in controlli and controlli[cl.id]["errori"]:
                     continue
-                if not cl.iban_sdd:
-                    anomalie.append(f"{cl.denominazione}: IBAN SDD mancante")
+                if p.id in sospesi:
+                    anomalie.append(f"{cl.denominazione}: prestazione #{p.id} già nel tracciato "
+                                    f"#{sospesi[p.id]} da confermare")
                     continue
-                if not cl.rif_mandato_sdd:
-                    anomalie.append(f"{cl.denominazione}: rif. mandato SDD mancante")
                 inc_data.append({
                     "prestazione": p, "cliente": cl,
-                    "importo": round(p.credito_residuo, 2),
+                    "importo": euro(centesimi(p.credito_residuo)),
                     "prestazione_descrizione": p.descrizione + calc_periodicity_label(p.periodicita, p.data_inizio),
+                    "seq_tipo": "RCUR" if cl.id in gia_addebitati else "FRST",
                 })
 
             if anomalie:
@@ -640,7 +636,7 @@ try:
                 for a in anomalie:
                     st.caption(f"  ⚠️ {a}")
 
-            if inc_data:
+            if inc_data and not errori_creditore:
                 tot_sdd = sum(i["importo"] for i in inc_data)
                 st.markdown(f"**{len(inc_data)} addebiti — Totale: {format_currency(tot_sdd)}**")
                 for i in inc_data:
@@ -649,53 +645,75 @@ try:
 
                 sd1, sd2 = st.columns(2)
                 if sd1.button("✅ Conferma e genera XML", type="primary", key="yes_sdd"):
-                    for i in inc_data:
-                        session.add(Incasso(
-                            prestazione_id=i["prestazione"].id,
-                            importo=Decimal(str(i["importo"])),
-                            data=data_add, stato="Caricato da confermare", modalita="SDD SEPA"))
-                    session.commit()
-
-                    fatt_id = psel_sdd[0].fatturante_id
-                    ft = fatturanti[fatt_id]
-                    xml = genera_sdd_xml(ft, inc_data, data_add)
-                    st.download_button("⬇️ Scarica XML SDD SEPA", xml,
-                                       f"SDD_{data_add.isoformat()}.xml", "application/xml")
-                    st.session_state.pop("confirm_action", None)
-                    st.success(f"✅ Tracciato SDD creato!")
+                    try:
+                        batch, creato = crea_batch(session, ft, inc_data, data_add)
+                        session.commit()
+                    except AddebitiInSospeso as e:
+                        session.rollback()
+                        st.error(f"❌ {e}: annullare prima il tracciato o attenderne l'esito.")
+                    except XMLNonValido as e:
+                        # Nessun incasso registrato: il tracciato verrebbe scartato dalla banca
+                        session.rollback()
+                        st.error(f"❌ Il tracciato SDD non supera la validazione XSD pain.008 ({e}):")
+                        for r in formatta_errori(e.errori):
+                            st.caption(f"  ⚠️ {r}")
+                    else:
+                        tracciati = file_batch(session, batch.id)
+                        if len(tracciati) == 1:
+                            xml, fn = tracciati[0]
+                            st.download_button("⬇️ Scarica XML SDD SEPA", xml, fn, "application/xml")
+                        else:
+                            st.download_button(f"⬇️ Scarica ZIP SDD SEPA ({len(tracciati)} file)",
+                                               genera_zip_fatture(tracciati),
+                                               f"SDD_{data_add.isoformat()}_{batch.id:06d}.zip", "application/zip")
+                        st.session_state.pop("confirm_action", None)
+                        if creato:
+                            st.success(f"✅ Tracciato SDD #{batch.id} creato!")
+                        else:
+                            st.info(f"ℹ️ Tracciato SDD #{batch.id} già generato il "
+                                    f"{batch.created_at:%d/%m/%Y %H:%M}: nessun nuovo incasso registrato.")
                 if sd2.button("❌ Annulla", key="no_sdd"):
                     st.session_state.pop("confirm_action", None)
                     st.rerun()
             else:
-                st.error("Nessun addebito valido.")
+                st.error("Dati del creditore non validi." if errori_creditore else "Nessun addebito valido.")
                 if st.button("Chiudi", key="close_sdd"):
                     st.session_state.pop("confirm_action", None)
                     st.rerun()
 
     # --- GENERA XML FATTURE ---
     if btn_xml:
-        fno = session.query(Fattura).filter(Fattura.xml_generato == False).all()
+        fno = [r[0] for r in session.query(Fattura.id).filter(Fattura.xml_generato == False)
+               .order_by(Fattura.id)]
         if not fno:
             st.info("Nessuna fattura da esportare in XML.")
         else:
-            xml_list = []
-            for f in fno:
-                righe = session.query(Prestazione).filter(Prestazione.fattura_id == f.id).all()
-                cl = clienti.get(f.cliente_id)
-                ft = fatturanti.get(f.fatturante_id)
-                if cl and ft and righe:
-                    xs, fn = genera_fattura_xml(f, righe, ft, cl)
-                    xml_list.append((xs, fn))
-                    f.xml_generato = True
-                    f.xml_filename = fn
-                    f.stato = "XML Generato"
+            barra = st.progress(0.0, text="Generazione XML…")
+            esito = {}
+            xml_gen = genera_xml(session, fno, esito,
+                                 avanzamento=lambda n, tot: barra.progress(n / tot, text=f"XML {n}/{tot}"))
+            if len(fno) == 1:
+                xml_list = [(xs, fn) for xs, fn, _ in xml_gen]
+                archivio = None
+            else:
+                xml_list = None
+                archivio = genera_zip_fatture((xs, fn) for xs, fn, _ in xml_gen)
+            barra.empty()
             session.commit()
-            if len(xml_list) == 1:
+            n_xml = len(esito["generati"])
+            if xml_list:
                 st.download_button("⬇️ Scarica XML", xml_list[0][0], xml_list[0][1], "application/xml")
-            elif xml_list:
-                st.download_button(f"⬇️ Scarica ZIP ({len(xml_list)})",
-                                   genera_zip_fatture(xml_list), "fatture.zip", "application/zip")
-            st.success(f"✅ {len(xml_list)} XML generati!")
+            elif n_xml:
+                st.download_button(f"⬇️ Scarica ZIP ({n_xml})", archivio, "fatture.zip", "application/zip")
+            st.success(f"✅ {n_xml} XML generati!")
+            if esito["non_validi"]:
+                st.error(f"❌ {len(esito['non_validi'])} XML non superano la validazione XSD "
+                         "e non sono stati segnati come generati:")
+                for fid, errori in esito["non_validi"].items():
+                    st.caption(f"  ⚠️ Fattura #{fid}: " + "; ".join(formatta_errori(errori)))
+            st.caption(" · ".join(f"{k} {v} ms" for k, v in esito["tempi"].items())
+                           + f" · {esito['workers']} processi")
 
 finally:
     session.close()
+    query_stats_panel()
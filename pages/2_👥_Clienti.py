@@ -5,10 +5,12 @@ from database import get_session, init_db
 from models import Cliente
 from config import TIPO_CLIENTE_OPTIONS, REGIME_FISCALE_OPTIONS, MODALITA_INCASSO_OPTIONS, TITOLO_OPTIONS
 from utils.styles import COMMON_CSS
+from utils.validazione_sdd import errori_cliente
 from utils.auth import check_auth, logout_button
+from utils.query_stats import query_stats_panel
 
 st.set_page_config(page_title="Clienti", page_icon="👥", layout="wide")
-init_db(); st.markdown(COMMON_CSS, unsafe_allow_html=True)
+init_db(__file__); st.markdown(COMMON_CSS, unsafe_allow_html=True)
 check_auth(); logout_button()
 st.markdown('<div class="page-header"><h2>👥 Anagrafica Clienti</h2></div>', unsafe_allow_html=True)
 
@@ -65,6 +67,9 @@ try:
                     st.error(f"P.IVA {piva} già presente!"); dup = True
                 if cf and not dup and session.query(Cliente).filter(Cliente.codice_fiscale == cf).first():
                     st.error(f"C.F. {cf} già presente!"); dup = True
+                if not dup:
+                    for e in errori_cliente(sdd, iban, rmand, dmand):
+                        st.error(f"SDD: {e}"); dup = True
                 if not dup:
                     session.add(Cliente(
                         cognome_ragione_sociale=cognome, nome=nome or "", titolo=titolo or "",
@@ -133,12 +138,17 @@ try:
                             eib = st.text_input("IBAN SDD", value=cl.iban_sdd or "")
                             eatt = st.checkbox("Attivo", value=cl.cliente_attivo)
                         if st.form_submit_button("💾 Aggiorna", type="primary"):
-                            cl.cognome_ragione_sociale = ec; cl.nome = en
-                            cl.partita_iva = ep; cl.codice_fiscale = ecf; cl.pec = em
-                            cl.tipo_cliente = et; cl.citta = eci; cl.codice_sdi = esd
-                            cl.sdd_attivo = esdd; cl.iban_sdd = eib; cl.cliente_attivo = eatt
-                            session.commit(); st.success("✅ Aggiornato!"); st.rerun()
+                            errori_sdd = errori_cliente(esdd, eib, cl.rif_mandato_sdd, cl.data_mandato_sdd)
+                            for e in errori_sdd:
+                                st.error(f"SDD: {e}")
+                            if not errori_sdd:
+                                cl.cognome_ragione_sociale = ec; cl.nome = en
+                                cl.partita_iva = ep; cl.codice_fiscale = ecf; cl.pec = em
+                                cl.tipo_cliente = et; cl.citta = eci; cl.codice_sdi = esd
+                                cl.sdd_attivo = esdd; cl.iban_sdd = eib; cl.cliente_attivo = eatt
+                                session.commit(); st.success("✅ Aggiornato!"); st.rerun()
         else:
             st.info("Nessun cliente trovato.")
 finally:
     session.close()
+    query_stats_panel()
@@ -5,9 +5,10 @@ from database import get_session, init_db
 from models import ContoRicavo
 from utils.styles import COMMON_CSS
 from utils.auth import check_auth, logout_button
+from utils.query_stats import query_stats_panel
 
 st.set_page_config(page_title="Conti Ricavo", page_icon="📁", layout="wide")
-init_db(); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
+init_db(__file__); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
 st.markdown('<div class="page-header"><h2>📁 Conti Ricavo</h2></div>', unsafe_allow_html=True)
 
 session = get_session()
@@ -41,3 +42,4 @@ try:
         st.info("Nessun conto ricavo.")
 finally:
     session.close()
+    query_stats_panel()
@@ -4,11 +4,14 @@ import pandas as pd
 from database import get_session, init_db
 from models import SoggettoFatturante
 from config import REGIME_FISCALE_OPTIONS
+from utils.helpers import load_fatturante
+from sqlalchemy.orm import undefer_group
 from utils.styles import COMMON_CSS
 from utils.auth import check_auth, logout_button
+from utils.query_stats import query_stats_panel
 
 st.set_page_config(page_title="Soggetti Fatturanti", page_icon="🏢", layout="wide")
-init_db(); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
+init_db(__file__); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
 st.markdown('<div class="page-header"><h2>🏢 Soggetti Fatturanti</h2></div>', unsafe_allow_html=True)
 
 session = get_session()
@@ -58,20 +61,23 @@ try:
                     session.commit()
                     st.success(f"✅ '{rs}' creato!"); st.rerun()
     else:
-        fl = session.query(SoggettoFatturante).order_by(SoggettoFatturante.ragione_sociale).all()
+        fl = session.query(SoggettoFatturante).options(undefer_group("smtp")).order_by(
+            SoggettoFatturante.ragione_sociale).all()
+        con_logo = {r[0] for r in session.query(SoggettoFatturante.id).filter(
+            SoggettoFatturante.logo.isnot(None))}
         if fl:
             df = pd.DataFrame([{
                 "Ragione Sociale": f.ragione_sociale, "P.IVA": f.partita_iva,
                 "C.F.": f.codice_fiscale, "Città": f"{f.citta} ({f.provincia})" if f.citta else "",
                 "PEC": f.pec, "IBAN": f.iban, "Regime": f.regime_fiscale,
-                "Logo": "✓" if f.logo else "—", "SMTP": "✓" if f.smtp_host else "—",
+                "Logo": "✓" if f.id in con_logo else "—", "SMTP": "✓" if f.smtp_host else "—",
             } for f in fl])
             st.dataframe(df, use_container_width=True, hide_index=True)
 
             st.markdown("---")
             sel_id = st.selectbox("✏️ Modifica fatturante", [f.id for f in fl],
                 format_func=lambda i: next(f.ragione_sociale for f in fl if f.id == i))
-            sf = session.query(SoggettoFatturante).get(sel_id)
+            sf = load_fatturante(session, sel_id, logo=True, smtp=True)
             if sf:
                 with st.form("edit_sf"):
                     e1, e2 = st.columns(2)
@@ -115,3 +121,4 @@ try:
             st.info("Nessun soggetto fatturante.")
 finally:
     session.close()
+    query_stats_panel()
@@ -3,22 +3,26 @@ import streamlit as st
 import pandas as pd
 from datetime import date
 from database import get_session, init_db
-from models import Fattura, Prestazione, Cliente, SoggettoFatturante
-from utils.helpers import format_currency
-from utils.fattura_xml import genera_fattura_xml, genera_zip_fatture
-from utils.pdf_generator import genera_fattura_pdf
+from models import Fattura, Prestazione
+from utils.helpers import format_currency, load_fatturante
+from utils.fattura_xml import genera_zip_fatture
+from utils.fatture_batch import genera_xml, genera_pdf
+from utils.documenti import xml_fattura, pdf_fattura
+from utils.validazione_xml import XMLNonValido, formatta_errori
 from utils.email_sender import invia_fattura_email
+from utils.lookup_cache import get_clienti, get_fatturanti
 from utils.styles import COMMON_CSS
 from utils.auth import check_auth, logout_button
+from utils.query_stats import query_stats_panel
 
 st.set_page_config(page_title="Fatture", page_icon="📄", layout="wide")
-init_db(); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
+init_db(__file__); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
 st.markdown('<div class="page-header"><h2>📄 Fatture Emesse</h2></div>', unsafe_allow_html=True)
 
 session = get_session()
 try:
-    clienti = {c.id: c for c in session.query(Cliente).all()}
-    fatturanti = {f.id: f for f in session.query(SoggettoFatturante).all()}
+    clienti = get_clienti()
+    fatturanti = get_fatturanti()
 
     f1, f2, f3 = st.columns(3)
     anno = f1.number_input("Anno", 2020, 2030, date.today().year)
@@ -57,29 +61,45 @@ try:
 
             ac1, ac2, ac3, ac4 = st.columns(4)
 
-            # Genera XML
-            if ac1.button("📋 Genera XML", disabled=fatt.xml_generato, use_container_width=True):
-                if cl and ft and righe:
-                    xs, fn = genera_fattura_xml(fatt, righe, ft, cl)
-                    fatt.xml_generato = True; fatt.xml_filename = fn; fatt.stato = "XML Generato"
+            # Genera / scarica XML (dall'archivio se i dati non sono cambiati; validato XSD)
+            if fatt.xml_generato:
+                chiesto = ac1.button("📋 Scarica XML", use_container_width=True)
+            else:
+                chiesto = ac1.button("📋 Genera XML", use_container_width=True)
+            if chiesto and cl and ft and righe:
+                try:
+                    xs, fn = xml_fattura(session, fatt, righe, ft, cl)
+                except XMLNonValido as e:
+                    st.error(f"❌ {e}")
+                    for r in formatta_errori(e.errori):
+                        st.caption(f"  ⚠️ {r}")
+                else:
+                    if not fatt.xml_generato:
+                        fatt.xml_generato = True; fatt.xml_filename = fn; fatt.stato = "XML Generato"
                     session.commit()
                     st.download_button("⬇️ Scarica XML", xs, fn, "application/xml")
 
-            # Genera PDF
+            # Genera PDF (serve il fatturante completo di logo)
             if ac2.button("📄 Genera PDF", use_container_width=True):
                 if cl and ft and righe:
-                    pdf = genera_fattura_pdf(fatt, righe, ft, cl)
+                    pdf = pdf_fattura(session, fatt, righe, load_fatturante(session, ft.id), cl)
+                    session.commit()
                     st.download_button("⬇️ Scarica PDF", pdf,
                         f"Fattura_{fatt.numero}_{fatt.anno}.pdf", "application/pdf")
 
             # Invia email
             if ac3.button("📧 Invia per email", use_container_width=True):
                 if cl and ft and righe:
-                    pdf = genera_fattura_pdf(fatt, righe, ft, cl)
+                    ft_full = load_fatturante(session, ft.id, logo=True, smtp=True)
+                    pdf = pdf_fattura(session, fatt, righe, ft_full, cl)
                     xml_str = None
                     if fatt.xml_generato and fatt.xml_filename:
-                        xml_str, _ = genera_fattura_xml(fatt, righe, ft, cl)
-                    ok, msg = invia_fattura_email(ft, cl, fatt, pdf_bytes=pdf, xml_str=xml_str)
+                        try:
+                            xml_str, _ = xml_fattura(session, fatt, righe, ft, cl)
+                        except XMLNonValido as e:
+                            st.warning(f"⚠️ {e}: email inviata senza XML")
+                    session.commit()
+                    ok, msg = invia_fattura_email(ft_full, cl, fatt, pdf_bytes=pdf, xml_str=xml_str)
                     if ok:
                         st.success(f"✅ {msg}")
                     else:
@@ -90,20 +110,49 @@ try:
             no_xml = [f for f in fl if not f.xml_generato]
             if no_xml:
                 if st.button(f"📋 Genera XML per {len(no_xml)} fattura/e senza XML", type="primary"):
-                    xl = []
-                    for f in no_xml:
-                        rr = session.query(Prestazione).filter(Prestazione.fattura_id == f.id).all()
-                        c, ft2 = clienti.get(f.cliente_id), fatturanti.get(f.fatturante_id)
-                        if c and ft2 and rr:
-                            xs, fn = genera_fattura_xml(f, rr, ft2, c)
-                            xl.append((xs, fn)); f.xml_generato = True; f.xml_filename = fn; f.stato = "XML Generato"
+                    barra = st.progress(0.0, text="Generazione XML…")
+                    esito = {}
+                    xml_gen = genera_xml(session, [f.id for f in no_xml], esito,
+                                         avanzamento=lambda n, tot: barra.progress(n / tot, text=f"XML {n}/{tot}"))
+                    if len(no_xml) == 1:
+                        xl = [(xs, fn) for xs, fn, _ in xml_gen]
+                        archivio = None
+                    else:
+                        xl = None
+                        archivio = genera_zip_fatture((xs, fn) for xs, fn, _ in xml_gen)
+                    barra.empty()
                     session.commit()
-                    if len(xl) == 1:
+                    n_xml = len(esito["generati"])
+                    if xl:
                         st.download_button("⬇️ Scarica", xl[0][0], xl[0][1], "application/xml")
-                    elif xl:
-                        st.download_button(f"⬇️ ZIP ({len(xl)})", genera_zip_fatture(xl), f"fatture_{anno}.zip", "application/zip")
-                    st.success(f"✅ {len(xl)} XML generati!")
+                    elif n_xml:
+                        st.download_button(f"⬇️ ZIP ({n_xml})", archivio, f"fatture_{anno}.zip", "application/zip")
+                    st.success(f"✅ {n_xml} XML generati!")
+                    if esito["non_validi"]:
+                        st.error(f"❌ {len(esito['non_validi'])} XML non superano la validazione XSD "
+                                 "e non sono stati segnati come generati:")
+                        for fid, errori in esito["non_validi"].items():
+                            st.caption(f"  ⚠️ Fattura #{fid}: " + "; ".join(formatta_errori(errori)))
+                    st.caption(" · ".join(f"{k} {v} ms" for k, v in esito["tempi"].items())
+                               + f" · {esito['workers']} processi")
+
+            if len(fl) > 1 and st.button(f"📄 PDF di cortesia per {len(fl)} fatture (ZIP)"):
+                barra = st.progress(0.0, text="Generazione PDF…")
+                esito = {}
+                pdf_gen = genera_pdf(session, [f.id for f in fl], esito,
+                                     avanzamento=lambda n, tot: barra.progress(n / tot, text=f"PDF {n}/{tot}"))
+                # I PDF sono già compressi: nello ZIP si archiviano soltanto
+                archivio = genera_zip_fatture(((pdf, fn) for pdf, fn, _ in pdf_gen), livello=0)
+                barra.empty()
+                session.commit()
+                st.download_button(f"⬇️ ZIP PDF ({len(esito['generati'])})", archivio,
+                                   f"fatture_{anno}_pdf.zip", "application/zip")
+                if esito["saltate"]:
+                    st.warning(f"⚠️ {len(esito['saltate'])} fatture senza righe, cliente o fatturante")
+                st.caption(" · ".join(f"{k} {v} ms" for k, v in esito["tempi"].items())
+                           + f" · {esito['workers']} processi · {esito['da_archivio']} dall'archivio")
     else:
         st.info(f"Nessuna fattura per {anno}.")
 finally:
     session.close()
+    query_stats_panel()
@@ -4,14 +4,21 @@ import pandas as pd
 from datetime import date
 from decimal import Decimal
 from database import get_session, init_db
-from models import Incasso, Prestazione
+from models import Incasso, Prestazione, SddBatch
+from sqlalchemy.orm import joinedload
 from utils.helpers import format_currency
+from utils.importi import centesimi, euro
+from utils.esiti_sdd import leggi_esiti, applica_esiti
+from utils.riconciliazione import leggi_camt053, proponi_abbinamenti, registra_incassi, scegli_partita
+from utils.sdd_batch import file_batch, annulla_batch
+from utils.fattura_xml import genera_zip_fatture
 from config import MODALITA_INCASSO_OPTIONS
 from utils.styles import COMMON_CSS
 from utils.auth import check_auth, logout_button
+from utils.query_stats import query_stats_panel
 
 st.set_page_config(page_title="Incassi", page_icon="💰", layout="wide")
-init_db(); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
+init_db(__file__); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
 st.markdown('<div class="page-header"><h2>💰 Incassi</h2></div>', unsafe_allow_html=True)
 
 session = get_session()
@@ -30,6 +37,116 @@ try:
             {"stato": "Insoluto"}, synchronize_session=False)
         session.commit(); st.warning(f"⚠️ {u} insoluti."); st.rerun()
 
+    with st.expander("📥 Importa esiti SDD (pain.002 / CBI)"):
+        file_esiti = st.file_uploader("Report di esito della banca (XML)", type=["xml"], key="esiti_sdd")
+        if file_esiti and st.button("Applica esiti", type="primary", key="applica_esiti"):
+            try:
+                r = applica_esiti(session, leggi_esiti(file_esiti))
+            except ValueError as e:
+                session.rollback(); st.error(f"❌ {e}")
+            else:
+                session.commit()
+                st.success(f"✅ {r['aggiornati']} incassi aggiornati, {r['invariati']} già allineati, "
+                           f"{r['ignorati']} esiti senza effetto.")
+                livelli = {"gruppo": "Messaggio", "pmtinf": "Blocco"}
+                for livello, rif, motivo, n in r["rifiuti"]:
+                    st.warning(f"⛔ {livelli[livello]} {rif} rifiutato dalla banca"
+                               f"{f' ({motivo})' if motivo else ''}: {n} incassi insoluti.")
+                for livello, rif, motivo in r["rifiuti_non_trovati"]:
+                    st.error(f"⛔ {livelli[livello]} {rif} rifiutato dalla banca"
+                             f"{f' ({motivo})' if motivo else ''}, ma il tracciato non è archiviato: "
+                             "aggiornare a mano gli incassi interessati.")
+                if r["non_trovati"]:
+                    st.warning(f"⚠️ {len(r['non_trovati'])} EndToEndId senza incasso corrispondente:")
+                    st.caption(", ".join(f"{e2e} ({r['motivi'][e2e]})" if e2e in r["motivi"] else e2e
+                                         for e2e in r["non_trovati"][:100]))
+
+    with st.expander("📦 Tracciati SDD generati"):
+        batches = (session.query(SddBatch).options(joinedload(SddBatch.fatturante))
+                   .order_by(SddBatch.id.desc()).limit(50).all())
+        if not batches:
+            st.caption("Nessun tracciato generato.")
+        for b in batches:
+            bc1, bc2, bc3 = st.columns([5, 1, 1])
+            bc1.text(f"#{b.id} — {b.data_addebito:%d/%m/%Y} — {b.fatturante.ragione_sociale if b.fatturante else '-'} — "
+                     f"{b.n_transazioni} addebiti — {format_currency(b.totale)} — {b.stato}")
+            if bc2.button("⬇️", key=f"scarica_b{b.id}", help="Prepara il download dall'archivio"):
+                tracciati = file_batch(session, b.id)
+                if len(tracciati) == 1:
+                    bc1.download_button("⬇️ Scarica XML", tracciati[0][0], tracciati[0][1],
+                                        "application/xml", key=f"dl_b{b.id}")
+                else:
+                    bc1.download_button("⬇️ Scarica ZIP", genera_zip_fatture(tracciati),
+                                        f"SDD_{b.data_addebito.isoformat()}_{b.id:06d}.zip",
+                                        "application/zip", key=f"dl_b{b.id}")
+            if b.stato != "Annullato" and bc3.button("🚫", key=f"annulla_b{b.id}", help="Annulla tracciato"):
+                try:
+                    n = annulla_batch(session, b)
+                except ValueError as e:
+                    st.error(f"❌ {e}")
+                else:
+                    session.commit(); st.warning(f"Tracciato #{b.id} annullato: {n} incassi eliminati."); st.rerun()
+
+    with st.expander("🏦 Riconcilia estratto conto (camt.053)"):
+        file_camt = st.file_uploader("Estratto conto della banca (XML camt.053)", type=["xml"], key="camt053")
+        if file_camt and st.button("🔍 Cerca abbinamenti", key="analizza_camt"):
+            try:
+                st.session_state["riconciliazione"] = proponi_abbinamenti(session, leggi_camt053(file_camt))
+            except ValueError as e:
+                st.error(f"❌ {e}")
+        proposte = st.session_state.get("riconciliazione")
+        if proposte:
+            conteggi = {}
+            for pr in proposte:
+                conteggi[pr["stato"]] = conteggi.get(pr["stato"], 0) + 1
+            st.caption(" · ".join(f"{k}: {v}" for k, v in conteggi.items()))
+            df_r = pd.DataFrame([{
+                "Registra": pr["stato"] == "proposto",
+                "Data": pr["movimento"]["data"].strftime("%d/%m/%Y"),
+                "Importo": float(euro(pr["movimento"]["importo"])),
+                "Ordinante": pr["movimento"]["ordinante"],
+                "Causale": pr["movimento"]["causale"],
+                "Abbinamento": (f"{pr['partita']['cliente']} — {pr['partita']['descrizione']}"
+                                if pr["partita"] else " | ".join(
+                                    f"{a['cliente']} — {a['descrizione']}" for a in pr["alternative"])),
+                "Residuo": float(euro(pr["partita"]["residuo"])) if pr["partita"] else None,
+                "Punti": pr["punteggio"], "Stato": pr["stato"],
+            } for pr in proposte])
+            ed = st.data_editor(df_r, use_container_width=True, hide_index=True, key="ed_camt",
+                                disabled=[c for c in df_r.columns if c != "Registra"],
+                                column_config={"Importo": st.column_config.NumberColumn(format="€ %.2f"),
+                                               "Residuo": st.column_config.NumberColumn(format="€ %.2f")})
+            # Movimenti senza partita proposta: abbinamento scelto a mano tra le alternative
+            da_scegliere = [i for i, pr in enumerate(proposte) if not pr["partita"] and pr["alternative"]]
+            if da_scegliere:
+                st.caption("Movimenti ambigui o senza abbinamento: scegliere la partita e spuntare *Registra*.")
+            abbinate = list(proposte)
+            for i in da_scegliere:
+                pr = proposte[i]
+                mov = pr["movimento"]
+                alt = st.selectbox(
+                    f"{mov['data']:%d/%m/%Y} — {format_currency(euro(mov['importo']))} — {mov['ordinante']}",
+                    [None] + pr["alternative"], key=f"alt_camt_{i}",
+                    format_func=lambda a: "— nessun abbinamento —" if a is None else
+                    f"{a['cliente']} — {a['descrizione']} (residuo {format_currency(euro(a['residuo']))})")
+                if alt is not None:
+                    abbinate[i] = scegli_partita(pr, alt)
+            scelte = [pr for pr, ok in zip(abbinate, ed["Registra"]) if ok and pr["partita"]]
+            rc1, rc2 = st.columns(2)
+            if rc1.button(f"💾 Registra {len(scelte)} incassi", type="primary", key="registra_camt",
+                          disabled=not scelte):
+                r = registra_incassi(session, scelte)
+                session.commit()
+                st.session_state.pop("riconciliazione", None)
+                st.success(f"✅ {r['creati']} incassi registrati da {len(scelte)} movimenti.")
+                if r["gia_registrati"]:
+                    st.warning(f"⚠️ {r['gia_registrati']} movimenti erano già stati registrati: saltati.")
+                if r["non_allocato"]:
+                    st.warning(f"⚠️ {format_currency(euro(r['non_allocato']))} non allocati: "
+                               "il residuo delle prestazioni è cambiato dopo la proposta.")
+            if rc2.button("Annulla", key="annulla_camt"):
+                st.session_state.pop("riconciliazione", None); st.rerun()
+
     st.markdown("---")
     q = session.query(Incasso).order_by(Incasso.data.desc())
     if fs != "Tutti": q = q.filter(Incasso.stato == fs)
@@ -37,9 +154,10 @@ try:
     il = q.limit(500).all()
 
     if il:
-        tc = sum(float(i.importo) for i in il if i.stato == "Confermato")
-        ta = sum(float(i.importo) for i in il if i.stato == "Caricato da confermare")
-        ti = sum(float(i.importo) for i in il if i.stato == "Insoluto")
+        per_stato = {}
+        for i in il:
+            per_stato[i.stato] = per_stato.get(i.stato, 0) + centesimi(i.importo)
+        tc, ta, ti = (euro(per_stato.get(s, 0)) for s in ("Confermato", "Caricato da confermare", "Insoluto"))
         m1, m2, m3 = st.columns(3)
         m1.metric("✅ Confermati", format_currency(tc))
         m2.metric("⏳ Da confermare", format_currency(ta))
@@ -50,6 +168,7 @@ try:
             "Cliente": i.prestazione.cliente.denominazione if i.prestazione and i.prestazione.cliente else "-",
             "Prestazione": i.prestazione.descrizione if i.prestazione else "-",
             "Importo": float(i.importo), "Modalità": i.modalita, "Stato": i.stato,
+            "EndToEndId": i.end_to_end_id or "",
         } for i in il])
         st.dataframe(df, use_container_width=True, hide_index=True,
             column_config={"Importo": st.column_config.NumberColumn(format="€ %.2f")})
@@ -69,7 +188,8 @@ try:
 
     st.markdown("---")
     st.markdown("#### ➕ Incasso Manuale")
-    prest = session.query(Prestazione).order_by(Prestazione.data_inizio.desc()).limit(100).all()
+    prest = session.query(Prestazione).options(joinedload(Prestazione.cliente)).order_by(
+        Prestazione.data_inizio.desc()).limit(100).all()
     if prest:
         with st.form("new_inc"):
             ni1, ni2, ni3, ni4 = st.columns(4)
@@ -84,3 +204,4 @@ try:
                 session.commit(); st.success(f"✅ Registrato!"); st.rerun()
 finally:
     session.close()
+    query_stats_panel()
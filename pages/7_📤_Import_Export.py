@@ -7,9 +7,10 @@ from database import get_session, init_db
 from models import Cliente, ContoRicavo, SoggettoFatturante, Prestazione, Fattura
 from utils.styles import COMMON_CSS
 from utils.auth import check_auth, logout_button
+from utils.query_stats import query_stats_panel
 
 st.set_page_config(page_title="Import/Export", page_icon="📤", layout="wide")
-init_db(); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
+init_db(__file__); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
 st.markdown('<div class="page-header"><h2>📤 Import / Export</h2></div>', unsafe_allow_html=True)
 
 TEMPLATES = {
@@ -143,3 +144,4 @@ try:
                 "text/csv", key=f"ec_{name}")
 finally:
     session.close()
+    query_stats_panel()
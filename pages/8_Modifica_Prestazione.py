@@ -3,14 +3,16 @@ import streamlit as st
 from datetime import date
 from decimal import Decimal
 from database import get_session, init_db
-from models import Prestazione, Cliente, ContoRicavo, SoggettoFatturante, Incasso
+from models import Prestazione, Incasso
 from config import PERIODICITA_OPTIONS, MODALITA_INCASSO_OPTIONS, ALIQUOTA_OPTIONS
 from utils.helpers import format_currency, calc_periodicity_label
+from utils.lookup_cache import get_clienti, get_conti, get_fatturanti
 from utils.styles import COMMON_CSS
 from utils.auth import check_auth, logout_button
+from utils.query_stats import query_stats_panel
 
 st.set_page_config(page_title="Modifica Prestazione", page_icon="✏️", layout="wide")
-init_db(); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
+init_db(__file__); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
 
 # Leggi ID dalla query string
 params = st.query_params
@@ -29,9 +31,9 @@ try:
         st.error(f"Prestazione #{prest_id} non trovata.")
         st.stop()
 
-    clienti = session.query(Cliente).order_by(Cliente.cognome_ragione_sociale).all()
-    conti = session.query(ContoRicavo).order_by(ContoRicavo.codice).all()
-    fatturanti = session.query(SoggettoFatturante).order_by(SoggettoFatturante.ragione_sociale).all()
+    clienti = list(get_clienti().values())
+    conti = list(get_conti().values())
+    fatturanti = list(get_fatturanti().values())
 
     cl = next((c for c in clienti if c.id == p.cliente_id), None)
     pl = calc_periodicity_label(p.periodicita, p.data_inizio)
@@ -115,3 +117,4 @@ try:
 
 finally:
     session.close()
+    query_stats_panel()
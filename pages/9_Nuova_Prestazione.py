@@ -4,13 +4,15 @@ from datetime import date
 from decimal import Decimal
 import calendar
 from database import get_session, init_db
-from models import Prestazione, Cliente, ContoRicavo, SoggettoFatturante
+from models import Prestazione
 from config import PERIODICITA_OPTIONS, MODALITA_INCASSO_OPTIONS, ALIQUOTA_OPTIONS
+from utils.lookup_cache import get_clienti, get_conti, get_fatturanti
 from utils.styles import COMMON_CSS
 from utils.auth import check_auth, logout_button
+from utils.query_stats import query_stats_panel
 
 st.set_page_config(page_title="Nuova Prestazione", page_icon="➕", layout="wide")
-init_db(); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
+init_db(__file__); st.markdown(COMMON_CSS, unsafe_allow_html=True); check_auth(); logout_button()
 
 params = st.query_params
 default_month = int(params.get("month", date.today().month))
@@ -23,9 +25,9 @@ st.markdown("""
 
 session = get_session()
 try:
-    clienti = session.query(Cliente).filter(Cliente.cliente_attivo == True).order_by(Cliente.cognome_ragione_sociale).all()
-    conti = session.query(ContoRicavo).order_by(ContoRicavo.codice).all()
-    fatturanti = session.query(SoggettoFatturante).order_by(SoggettoFatturante.ragione_sociale).all()
+    clienti = [c for c in get_clienti().values() if c.cliente_attivo]
+    conti = list(get_conti().values())
+    fatturanti = list(get_fatturanti().values())
 
     if not clienti or not conti or not fatturanti:
         st.warning("⚠️ Serve almeno un Cliente, Conto Ricavo e Soggetto Fatturante.")
@@ -67,3 +69,4 @@ try:
                 st.balloons()
 finally:
     session.close()
+    query_stats_panel()
@@ -0,0 +1,138 @@
+"""
+Archivio dei documenti generati (XML FatturaPA e PDF di cortesia).
+
+Ogni documento è salvato con lo sha256 del contenuto e con l'impronta dei dati
+da cui è stato generato (fattura, righe, fatturante, cliente). Finché
+l'impronta non cambia, download ed email riusano i byte archiviati invece di
+rigenerarli; se cambia un dato di input viene prodotta e salvata una nuova
+versione accanto alla precedente.
+"""
+import hashlib
+import json
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from models import DocumentoFattura, Fattura, Prestazione, Cliente, SoggettoFatturante
+from utils.lookup_cache import FATTURANTE_ESCLUSE
+from utils.snapshot import column_keys
+
+# Da incrementare quando cambia il formato dei documenti generati
+VERSIONE = 3
+
+_D = DocumentoFattura.__table__
+_TIMESTAMP = ("created_at", "updated_at")
+_CAMPI = {
+    Fattura: column_keys(Fattura, _TIMESTAMP + ("stato", "xml_generato", "xml_filename")),
+    Prestazione: column_keys(Prestazione, _TIMESTAMP + ("totale_incassato_confermato", "credito_residuo")),
+    Cliente: column_keys(Cliente, _TIMESTAMP),
+    SoggettoFatturante: column_keys(SoggettoFatturante, _TIMESTAMP + FATTURANTE_ESCLUSE),
+}
+
+
+def _valori(model, obj):
+    # getattr con default: funziona sia su oggetti ORM sia sugli snapshot della cache
+    return [getattr(obj, k, None) for k in _CAMPI[model]]
+
+
+def impronta(tipo, fattura, righe, fatturante, cliente, logo=None):
+    """sha256 dei dati di input di un documento (per il PDF anche del logo)."""
+    dati = [VERSIONE, tipo,
+            _valori(Fattura, fattura),
+            [_valori(Prestazione, p) for p in righe],
+            _valori(SoggettoFatturante, fatturante),
+            _valori(Cliente, cliente),
+            hashlib.sha256(logo).hexdigest() if logo else None]
+    return hashlib.sha256(json.dumps(dati, default=str).encode()).hexdigest()
+
+
+def _riga(fattura_id, tipo, impronta_, filename, contenuto):
+    return {"fattura_id": fattura_id, "tipo": tipo, "impronta": impronta_,
+            "sha256": hashlib.sha256(contenuto).hexdigest(), "filename": filename,
+            "dimensione": len(contenuto), "contenuto": contenuto}
+
+
+# =============================================
+# LETTURA / SCRITTURA
+# =============================================
+def cerca(session, fattura_id, tipo, impronta_):
+    """Contenuto archiviato (bytes, filename) o None; None anche se lo sha256 non torna."""
+    row = session.query(DocumentoFattura.contenuto, DocumentoFattura.sha256,
+                        DocumentoFattura.filename).filter(
+        DocumentoFattura.fattura_id == fattura_id, DocumentoFattura.tipo == tipo,
+        DocumentoFattura.impronta == impronta_,
+    ).first()
+    if row is None or hashlib.sha256(row.contenuto).hexdigest() != row.sha256:
+        return None
+    return row.contenuto, row.filename
+
+
+def salva(session, fattura_id, tipo, impronta_, filename, contenuto):
+    """Archivia un documento; se un'altra sessione l'ha appena salvato non fa nulla."""
+    try:
+        with session.begin_nested():
+            session.execute(insert(_D), [_riga(fattura_id, tipo, impronta_, filename, contenuto)])
+    except IntegrityError:
+        pass
+
+
+def salva_molti(session, documenti):
+    """
+    Archivia [(fattura_id, tipo, impronta, filename, contenuto), ...] con un'unica
+    executemany. I documenti già archiviati nel frattempo da un'altra sessione
+    (stessa fattura, tipo e impronta) vengono ignorati.
+    """
+    if not documenti:
+        return
+    righe = [_riga(*d) for d in documenti]
+    dialect = session.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as insert_dialetto
+        else:
+            from sqlalchemy.dialects.sqlite import insert as insert_dialetto
+        session.execute(insert_dialetto(_D).on_conflict_do_nothing(
+            index_elements=[_D.c.fattura_id, _D.c.tipo, _D.c.impronta]), righe)
+        return
+    # Altri dialetti: executemany in un savepoint, riga per riga se c'è un conflitto
+    try:
+        with session.begin_nested():
+            session.execute(insert(_D), righe)
+    except IntegrityError:
+        for d in documenti:
+            salva(session, *d)
+
+
+# =============================================
+# DOCUMENTI DI UNA FATTURA
+# =============================================
+def xml_fattura(session, fattura, righe, fatturante, cliente):
+    """
+    (xml_str, filename): dall'archivio se gli input non sono cambiati, altrimenti
+    generato e salvato. In entrambi i casi validato: solleva XMLNonValido se non
+    supera lo schema XSD in uso.
+    """
+    from utils.fattura_xml import genera_fattura_xml
+    from utils.validazione_xml import valida, XMLNonValido
+    imp = impronta("xml", fattura, righe, fatturante, cliente)
+    hit = cerca(session, fattura.id, "xml", imp)
+    if hit:
+        xml_str, filename = hit[0].decode("utf-8"), hit[1]
+    else:
+        xml_str, filename = genera_fattura_xml(fattura, righe, fatturante, cliente)
+    errori = valida(xml_str, "fatturapa")
+    if errori:
+        raise XMLNonValido(filename, errori)
+    if not hit:
+        salva(session, fattura.id, "xml", imp, filename, xml_str.encode("utf-8"))
+    return xml_str, filename
+
+
+def pdf_fattura(session, fattura, righe, fatturante, cliente):
+    """PDF (bytes) dall'archivio o generato e salvato; `fatturante` deve avere il logo caricato."""
+    from utils.pdf_generator import genera_fattura_pdf
+    imp = impronta("pdf", fattura, righe, fatturante, cliente, logo=fatturante.logo)
+    hit = cerca(session, fattura.id, "pdf", imp)
+    if hit:
+        return hit[0]
+    pdf = genera_fattura_pdf(fattura, righe, fatturante, cliente)
+    salva(session, fattura.id, "pdf", imp, f"Fattura_{fattura.numero}_{fattura.anno}.pdf", pdf)
+    return pdf
@@ -0,0 +1,102 @@
+"""
+Emissione fatture in blocco dalle prestazioni selezionate.
+
+Le prestazioni non ancora fatturate vengono raggruppate in SQL per
+(fatturante, cliente, aliquota); ogni coppia (fatturante, cliente) diventa una
+fattura. Numeri riservati a blocchi per fatturante, fatture inserite con una
+sola INSERT multi-riga e righe collegate con un'unica UPDATE ... FROM.
+"""
+from collections import defaultdict
+from sqlalchemy import select, insert, update, func, and_
+from models import Prestazione, Fattura
+from utils.importi import centesimi, euro
+from utils.numerazione import riserva_numeri
+
+_P = Prestazione.__table__
+_F = Fattura.__table__
+
+
+def anteprima_emissione(session, ids):
+    """
+    Fatture che verrebbero emesse per le prestazioni `ids`. Ritorna una lista di
+    dict ordinata per (fatturante_id, cliente_id) con n_righe, imponibile, iva,
+    totale (Decimal) e "aliquote" {aliquota: (imponibile, iva)}. L'IVA è la somma
+    di quella per riga (Prestazione.totale - importo, utils/importi.py), come
+    nel tracciato XML e nel PDF.
+    """
+    ids = [int(i) for i in ids]
+    if not ids:
+        return []
+    rows = session.execute(
+        select(_P.c.fatturante_id, _P.c.cliente_id, _P.c.aliquota_iva,
+               func.count().label("n"),
+               func.sum(_P.c.importo_unitario).label("imponibile"),
+               func.sum(_P.c.totale).label("totale"))
+        .where(_P.c.id.in_(ids), _P.c.fattura_id.is_(None))
+        .group_by(_P.c.fatturante_id, _P.c.cliente_id, _P.c.aliquota_iva)
+        .order_by(_P.c.fatturante_id, _P.c.cliente_id, _P.c.aliquota_iva)
+    ).fetchall()
+
+    gruppi = {}
+    for r in rows:
+        g = gruppi.setdefault((r.fatturante_id, r.cliente_id), {
+            "fatturante_id": r.fatturante_id, "cliente_id": r.cliente_id, "n_righe": 0,
+            "imponibile": 0, "totale": 0, "aliquote": {},
+        })
+        imp, tot = centesimi(r.imponibile), centesimi(r.totale)
+        g["n_righe"] += r.n
+        g["imponibile"] += imp
+        g["totale"] += tot
+        g["aliquote"][r.aliquota_iva or 0] = (euro(imp), euro(tot - imp))
+    for g in gruppi.values():
+        g["iva"] = euro(g["totale"] - g["imponibile"])
+        g["imponibile"], g["totale"] = euro(g["imponibile"]), euro(g["totale"])
+    return list(gruppi.values())
+
+
+def emetti_fatture(session, ids, data_emissione):
+    """
+    Emette le fatture per le prestazioni `ids` (anche di più fatturanti) nella
+    transazione della sessione, senza commit. Ritorna gli id delle fatture create.
+    Solleva ValueError se nel frattempo alcune righe sono state fatturate da altri.
+    """
+    gruppi = anteprima_emissione(session, ids)
+    if not gruppi:
+        return []
+    anno = data_emissione.year
+
+    per_fatturante = defaultdict(list)
+    for g in gruppi:
+        per_fatturante[g["fatturante_id"]].append(g)
+    righe = []
+    for fid, gs in per_fatturante.items():
+        primo = riserva_numeri(session, fid, anno, len(gs))
+        for numero, g in enumerate(gs, start=primo):
+            righe.append({"numero": numero, "anno": anno, "data": data_emissione,
+                          "cliente_id": g["cliente_id"], "fatturante_id": fid,
+                          "totale_imponibile": g["imponibile"], "totale_iva": g["iva"],
+                          "totale": g["totale"], "stato": "Emessa", "xml_generato": False,
+                          "xml_filename": "", "note": ""})
+
+    nuove = session.execute(
+        insert(_F).returning(_F.c.id, sort_by_parameter_order=True), righe
+    ).scalars().all()
+
+    # Collega le prestazioni alla fattura del proprio (fatturante, cliente)
+    collegate = session.execute(
+        update(_P).values(fattura_id=_F.c.id)
+        .where(and_(_F.c.id.in_(nuove),
+                    _F.c.fatturante_id == _P.c.fatturante_id,
+                    _F.c.cliente_id == _P.c.cliente_id,
+                    _P.c.id.in_([int(i) for i in ids]),
+                    _P.c.fattura_id.is_(None)))
+    ).rowcount
+    attese = sum(g["n_righe"] for g in gruppi)
+    if collegate != attese:
+        raise ValueError(f"{attese - collegate} prestazioni sono state fatturate nel frattempo: "
+                         "emissione annullata, riprova.")
+
+    for obj in session.identity_map.values():
+        if isinstance(obj, Prestazione):
+            session.expire(obj, ["fattura_id", "fattura"])
+    return list(nuove)
@@ -0,0 +1,141 @@
+"""
+Esiti SDD restituiti dalla banca: report pain.002 e CBI con la stessa struttura
+(TxInfAndSts con OrgnlEndToEndId e TxSts).
+
+Il file si legge in streaming con iterparse, una transazione alla volta; gli
+incassi si cercano per EndToEndId e si aggiornano con una UPDATE ... CASE per
+blocco di BLOCCO id, senza caricarli nella sessione. I saldi delle prestazioni
+si ricalcolano con gli eventi di utils/saldi.py.
+
+Un rifiuto dell'intero messaggio (OrgnlGrpInfAndSts/GrpSts) o di un blocco
+(OrgnlPmtInfAndSts/PmtInfSts) spesso non elenca le transazioni: gli EndToEndId
+si ricavano dal tracciato archiviato (sdd_batch_file) con lo stesso MsgId o
+PmtInfId. I rifiuti di tracciati non archiviati restano nel riepilogo.
+"""
+import io
+from lxml import etree
+from sqlalchemy import case, select, update
+from models import Incasso, SddBatchFile
+
+# TxSts → stato dell'incasso; gli altri codici (PDNG, ACTC, ...) non cambiano nulla
+STATI_ESITO = {
+    "ACCP": "Confermato", "ACSP": "Confermato", "ACSC": "Confermato", "ACWC": "Confermato",
+    "RJCT": "Insoluto",
+}
+BLOCCO = 1000
+
+
+def _testo(el, percorso):
+    t = el.find("/".join(f"{{*}}{tag}" for tag in percorso.split("/")))
+    return t.text.strip() if t is not None and t.text else None
+
+
+# Elemento → (livello, riferimento originale, codice di stato)
+_LIVELLI = {
+    "TxInfAndSts": ("transazione", "OrgnlEndToEndId", "TxSts"),
+    "OrgnlPmtInfAndSts": ("pmtinf", "OrgnlPmtInfId", "PmtInfSts"),
+    "OrgnlGrpInfAndSts": ("gruppo", "OrgnlMsgId", "GrpSts"),
+}
+
+
+def leggi_esiti(fonte):
+    """
+    Legge un report di esito (percorso o file binario). Yield un dict per
+    transazione, blocco e messaggio: livello ("transazione", "pmtinf",
+    "gruppo"), riferimento (EndToEndId, PmtInfId o MsgId originale), codice
+    (TxSts / PmtInfSts / GrpSts) e motivo (StsRsnInf/Rsn/Cd). Per le transazioni
+    end_to_end_id è uguale a riferimento.
+    """
+    try:
+        for _, el in etree.iterparse(fonte, events=("end",), tag=[f"{{*}}{t}" for t in _LIVELLI],
+                                     no_network=True, resolve_entities=False):
+            livello, rif, stato = _LIVELLI[etree.QName(el).localname]
+            esito = {"livello": livello, "riferimento": _testo(el, rif), "codice": _testo(el, stato),
+                     "motivo": _testo(el, "StsRsnInf/Rsn/Cd")}
+            if livello == "transazione":
+                esito["end_to_end_id"] = esito["riferimento"]
+            yield esito
+            # Libera l'elemento già letto: memoria costante sul file (le
+            # intestazioni del blocco, lette alla sua chiusura, restano)
+            el.clear()
+            el.getparent().remove(el)
+    except etree.XMLSyntaxError as e:
+        raise ValueError(f"Report di esito non leggibile: {e}") from e
+
+
+def end_to_end_tracciati(session, rifiuti):
+    """
+    EndToEndId dei tracciati archiviati per [(livello, riferimento), ...] con
+    livello "gruppo" (MsgId) o "pmtinf" (PmtInfId). Ritorna {(livello, riferimento): [e2e, ...]}
+    per i soli riferimenti trovati.
+    """
+    # PmtInfId = MsgId-NN (vedi utils/sdd_batch.py)
+    msg_ids = {r if l == "gruppo" else r.rsplit("-", 1)[0] for l, r in rifiuti}
+    trovati = {}
+    for f in session.query(SddBatchFile).filter(SddBatchFile.msg_id.in_(list(msg_ids))):
+        blocchi = {}
+        for _, pi in etree.iterparse(io.BytesIO(f.contenuto), tag="{*}PmtInf"):
+            blocchi[_testo(pi, "PmtInfId")] = [e.text for e in pi.iterfind("{*}DrctDbtTxInf/{*}PmtId/{*}EndToEndId")]
+        for l, r in rifiuti:
+            if l == "gruppo" and r == f.msg_id:
+                trovati[(l, r)] = [e for ids in blocchi.values() for e in ids]
+            elif l == "pmtinf" and r in blocchi:
+                trovati[(l, r)] = blocchi[r]
+    return trovati
+
+
+def applica_esiti(session, esiti):
+    """
+    Applica gli esiti di leggi_esiti() agli incassi (commit a carico del
+    chiamante). Un RJCT di messaggio o di blocco rende insoluti tutti gli
+    incassi del tracciato archiviato corrispondente, salvo esiti più specifici
+    della singola transazione. Ritorna il riepilogo: aggiornati, invariati,
+    ignorati (codici senza effetto), non_trovati (EndToEndId senza incasso),
+    motivi {e2e: codice}, rifiuti [(livello, riferimento, motivo, n. transazioni)]
+    e rifiuti_non_trovati [(livello, riferimento, motivo)] senza tracciato archiviato.
+    """
+    riepilogo = {"aggiornati": 0, "invariati": 0, "ignorati": 0, "non_trovati": [], "motivi": {},
+                 "rifiuti": [], "rifiuti_non_trovati": []}
+    stati, rifiuti = {}, {}
+    for e in esiti:
+        if e.get("livello", "transazione") != "transazione":
+            # Solo il rifiuto decide per il blocco; ACCP/PART/... rimandano alle transazioni
+            if e["codice"] == "RJCT" and e["riferimento"]:
+                rifiuti[(e["livello"], e["riferimento"])] = e["motivo"]
+            continue
+        stato = STATI_ESITO.get(e["codice"])
+        if stato is None or not e["end_to_end_id"]:
+            riepilogo["ignorati"] += 1
+            continue
+        stati[e["end_to_end_id"]] = stato
+        if e["motivo"]:
+            riepilogo["motivi"][e["end_to_end_id"]] = e["motivo"]
+
+    trovati = end_to_end_tracciati(session, list(rifiuti)) if rifiuti else {}
+    for (livello, rif), motivo in rifiuti.items():
+        if (livello, rif) not in trovati:
+            riepilogo["rifiuti_non_trovati"].append((livello, rif, motivo))
+            continue
+        riepilogo["rifiuti"].append((livello, rif, motivo, len(trovati[(livello, rif)])))
+        for e2e in trovati[(livello, rif)]:
+            stati.setdefault(e2e, STATI_ESITO["RJCT"])
+            if motivo:
+                riepilogo["motivi"].setdefault(e2e, motivo)
+
+    ids = list(stati)
+    for i in range(0, len(ids), BLOCCO):
+        blocco = ids[i:i + BLOCCO]
+        attuali = {}
+        for e2e, stato in session.execute(select(Incasso.end_to_end_id, Incasso.stato)
+                                          .where(Incasso.end_to_end_id.in_(blocco))):
+            attuali.setdefault(e2e, set()).add(stato)
+        riepilogo["non_trovati"].extend(k for k in blocco if k not in attuali)
+        cambi = {k: stati[k] for k in blocco if k in attuali and attuali[k] != {stati[k]}}
+        riepilogo["invariati"] += len(attuali) - len(cambi)
+        if cambi:
+            session.execute(
+                update(Incasso).where(Incasso.end_to_end_id.in_(list(cambi)))
+                .values(stato=case(cambi, value=Incasso.end_to_end_id))
+                .execution_options(synchronize_session=False))
+            riepilogo["aggiornati"] += len(cambi)
+    return riepilogo
@@ -1,7 +1,9 @@
 """Generazione XML FatturaPA (versione 1.2.2)."""
 from lxml import etree
-from decimal import Decimal, ROUND_HALF_UP
-import zipfile, io
+import io, os, copy, zipfile, tempfile, threading
+from collections import OrderedDict
+from config import ZIP_LIVELLO, ZIP_SPOOL_MB
+from utils.importi import riepilogo, euro
 
 NAMESPACE = "http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2"
 SCHEMA_LOCATION = (
@@ -12,9 +14,6 @@ SCHEMA_LOCATION = (
 REGIME_MAP = {"Ordinario": "RF01", "Semplificato": "RF01", "Forfettario": "RF19"}
 
 
-def _r2(val):
-    return Decimal(str(val)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-
 def _el(parent, tag, text=None):
     e = etree.SubElement(parent, tag)
     if text is not None:
@@ -22,6 +21,55 @@ def _el(parent, tag, text=None):
     return e
 
 
+# =============================================
+# FRAMMENTI PER FATTURANTE
+# =============================================
+# IdTrasmittente e CedentePrestatore dipendono solo dal fatturante: si costruiscono
+# una volta per versione dei suoi dati (la chiave sono i valori usati, quindi una
+# modifica del fatturante produce un nuovo frammento) e si copiano in ogni fattura.
+_CAMPI_FATTURANTE = ("partita_iva", "codice_fiscale", "ragione_sociale", "regime_fiscale",
+                     "indirizzo", "cap", "citta", "provincia", "paese")
+_FRAMMENTI_MAX = 64
+_frammenti = OrderedDict()
+_frammenti_lock = threading.Lock()
+
+
+def _costruisci_frammenti(fatturante):
+    idt = etree.Element("IdTrasmittente")
+    _el(idt, "IdPaese", "IT"); _el(idt, "IdCodice", fatturante.partita_iva)
+
+    ced = etree.Element("CedentePrestatore")
+    da_c = _el(ced, "DatiAnagrafici")
+    idf = _el(da_c, "IdFiscaleIVA")
+    _el(idf, "IdPaese", fatturante.paese or "IT"); _el(idf, "IdCodice", fatturante.partita_iva)
+    if fatturante.codice_fiscale: _el(da_c, "CodiceFiscale", fatturante.codice_fiscale)
+    an = _el(da_c, "Anagrafica"); _el(an, "Denominazione", fatturante.ragione_sociale)
+    _el(da_c, "RegimeFiscale", REGIME_MAP.get(fatturante.regime_fiscale, "RF01"))
+    sede = _el(ced, "Sede")
+    _el(sede, "Indirizzo", fatturante.indirizzo or "N/D")
+    _el(sede, "CAP", fatturante.cap or "00000")
+    _el(sede, "Comune", fatturante.citta or "N/D")
+    if fatturante.provincia: _el(sede, "Provincia", fatturante.provincia)
+    _el(sede, "Nazione", fatturante.paese or "IT")
+    return idt, ced
+
+
+def frammenti_fatturante(fatturante):
+    """Copie di (IdTrasmittente, CedentePrestatore) per il fatturante, pronte da inserire."""
+    key = tuple(getattr(fatturante, k, None) for k in _CAMPI_FATTURANTE)
+    with _frammenti_lock:
+        cached = _frammenti.get(key)
+        if cached is not None:
+            _frammenti.move_to_end(key)
+    if cached is None:
+        cached = _costruisci_frammenti(fatturante)
+        with _frammenti_lock:
+            _frammenti[key] = cached
+            while len(_frammenti) > _FRAMMENTI_MAX:
+                _frammenti.popitem(last=False)
+    return copy.deepcopy(cached[0]), copy.deepcopy(cached[1])
+
+
 def genera_fattura_xml(fattura, prestazioni, fatturante, cliente):
     filename = f"IT{fatturante.partita_iva}_{fattura.numero:05d}.xml"
     root = etree.Element(
@@ -31,28 +79,15 @@ def genera_fattura_xml(fattura, prestazioni, fatturante, cliente):
                 "{http://www.w3.org/2001/XMLSchema-instance}schemaLocation": SCHEMA_LOCATION},
     )
     header = _el(root, "FatturaElettronicaHeader")
+    id_trasmittente, cedente = frammenti_fatturante(fatturante)
     dt = _el(header, "DatiTrasmissione")
-    idt = _el(dt, "IdTrasmittente")
-    _el(idt, "IdPaese", "IT"); _el(idt, "IdCodice", fatturante.partita_iva)
+    dt.append(id_trasmittente)
     _el(dt, "ProgressivoInvio", f"{fattura.numero:05d}")
     _el(dt, "FormatoTrasmissione", "FPR12")
     _el(dt, "CodiceDestinatario", cliente.codice_sdi or "0000000")
     if cliente.pec and (not cliente.codice_sdi or cliente.codice_sdi == "0000000"):
         _el(dt, "PECDestinatario", cliente.pec)
-
-    ced = _el(header, "CedentePrestatore")
-    da_c = _el(ced, "DatiAnagrafici")
-    idf = _el(da_c, "IdFiscaleIVA")
-    _el(idf, "IdPaese", fatturante.paese or "IT"); _el(idf, "IdCodice", fatturante.partita_iva)
-    if fatturante.codice_fiscale: _el(da_c, "CodiceFiscale", fatturante.codice_fiscale)
-    an = _el(da_c, "Anagrafica"); _el(an, "Denominazione", fatturante.ragione_sociale)
-    _el(da_c, "RegimeFiscale", REGIME_MAP.get(fatturante.regime_fiscale, "RF01"))
-    sede = _el(ced, "Sede")
-    _el(sede, "Indirizzo", fatturante.indirizzo or "N/D")
-    _el(sede, "CAP", fatturante.cap or "00000")
-    _el(sede, "Comune", fatturante.citta or "N/D")
-    if fatturante.provincia: _el(sede, "Provincia", fatturante.provincia)
-    _el(sede, "Nazione", fatturante.paese or "IT")
+    header.append(cedente)
 
     cess = _el(header, "CessionarioCommittente")
     da_cl = _el(cess, "DatiAnagrafici")
@@ -79,43 +114,98 @@ def genera_fattura_xml(fattura, prestazioni, fatturante, cliente):
     _el(dgd, "Data", fattura.data.isoformat()); _el(dgd, "Numero", str(fattura.numero))
 
     dbs = _el(body, "DatiBeniServizi")
-    riepilogo_iva = {}
+    conti = riepilogo(prestazioni)
     from utils.helpers import calc_periodicity_label
-    for i, p in enumerate(prestazioni, 1):
+    for i, (p, (imp, _, _)) in enumerate(zip(prestazioni, conti["righe"]), 1):
         det = _el(dbs, "DettaglioLinee")
         _el(det, "NumeroLinea", str(i))
         desc = p.descrizione + calc_periodicity_label(p.periodicita, p.data_inizio)
         _el(det, "Descrizione", desc)
-        _el(det, "PrezzoUnitario", str(_r2(p.importo_unitario)))
-        _el(det, "PrezzoTotale", str(_r2(p.importo_unitario)))
+        _el(det, "PrezzoUnitario", str(euro(imp)))
+        _el(det, "PrezzoTotale", str(euro(imp)))
         _el(det, "AliquotaIVA", f"{p.aliquota_iva:.2f}")
-        aliq = p.aliquota_iva
-        riepilogo_iva.setdefault(aliq, {"imp": Decimal("0"), "iva": Decimal("0")})
-        riepilogo_iva[aliq]["imp"] += _r2(p.importo_unitario)
-        riepilogo_iva[aliq]["iva"] += _r2(float(p.importo_unitario) * aliq / 100)
+        if p.aliquota_iva == 0: _el(det, "Natura", "N2.2")
 
-    for aliq, v in sorted(riepilogo_iva.items()):
+    for aliq, (imp, iva) in conti["aliquote"].items():
         r = _el(dbs, "DatiRiepilogo")
         _el(r, "AliquotaIVA", f"{aliq:.2f}")
-        _el(r, "ImponibileImporto", str(_r2(v["imp"])))
-        _el(r, "Imposta", str(_r2(v["iva"])))
-        _el(r, "EsigibilitaIVA", "S" if cliente.split_payment else "I")
         if aliq == 0: _el(r, "Natura", "N2.2")
+        _el(r, "ImponibileImporto", str(euro(imp)))
+        _el(r, "Imposta", str(euro(iva)))
+        _el(r, "EsigibilitaIVA", "S" if cliente.split_payment else "I")
 
     dp = _el(body, "DatiPagamento"); _el(dp, "CondizioniPagamento", "TP02")
     ddp = _el(dp, "DettaglioPagamento"); _el(ddp, "ModalitaPagamento", "MP05")
-    tot = sum(_r2(float(p.importo_unitario) * (1 + p.aliquota_iva / 100)) for p in prestazioni)
-    _el(ddp, "ImportoPagamento", str(_r2(tot)))
+    _el(ddp, "ImportoPagamento", str(euro(conti["totale"])))
     if fatturante.iban: _el(ddp, "IBAN", fatturante.iban.replace(" ", ""))
 
     xml_str = etree.tostring(root, xml_declaration=True, encoding="UTF-8", pretty_print=True).decode()
     return xml_str, filename
 
 
-def genera_zip_fatture(fatture_xml_list):
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-        for xml_str, fname in fatture_xml_list:
+def genera_zip_fatture(fatture_xml, livello=None):
+    """
+    Scrive le coppie (xml_str, filename) in un archivio ZIP man mano che
+    arrivano (anche da un generatore), senza accumularle. L'archivio sta in
+    memoria e passa su un file temporaneo oltre ZIP_SPOOL_MB; ritorna il file
+    pronto da passare a st.download_button.
+    livello: 0 = solo archiviazione, 1-9 = deflate (default ZIP_LIVELLO).
+    """
+    livello = ZIP_LIVELLO if livello is None else livello
+    out = _ArchivioSpool(ZIP_SPOOL_MB * 1024 * 1024)
+    if livello == 0:
+        zf = zipfile.ZipFile(out, "w", zipfile.ZIP_STORED)
+    else:
+        zf = zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED, compresslevel=livello)
+    with zf:
+        for xml_str, fname in fatture_xml:
             zf.writestr(fname, xml_str)
-    buf.seek(0)
-    return buf.getvalue()
+    return out.file_download()
+
+
+class _ArchivioSpool:
+    """
+    File di scrittura per ZipFile: un BytesIO finché non supera `soglia` byte,
+    poi un file temporaneo su disco con lo stesso contenuto e la stessa posizione.
+    """
+
+    def __init__(self, soglia):
+        self._soglia = soglia
+        self._f = io.BytesIO()
+        self._su_disco = False
+
+    def write(self, dati):
+        n = self._f.write(dati)
+        if not self._su_disco and self._f.tell() > self._soglia:
+            disco = tempfile.TemporaryFile(suffix=".zip")
+            pos = self._f.tell()
+            disco.write(self._f.getvalue())
+            disco.seek(pos)
+            self._f, self._su_disco = disco, True
+        return n
+
+    def tell(self):
+        return self._f.tell()
+
+    def seek(self, *args):
+        return self._f.seek(*args)
+
+    def seekable(self):
+        return True
+
+    def flush(self):
+        self._f.flush()
+
+    def file_download(self):
+        """
+        Handle leggibile da st.download_button (accetta BytesIO o
+        BufferedReader): il buffer in memoria, oppure un BufferedReader sul
+        file temporaneo, che resta aperto tramite il descrittore duplicato.
+        """
+        self._f.seek(0)
+        if not self._su_disco:
+            return self._f
+        self._f.flush()
+        fh = io.open(os.dup(self._f.fileno()), "rb")
+        self._f.close()
+        return fh
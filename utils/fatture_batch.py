@@ -0,0 +1,229 @@
+"""
+Generazione XML FatturaPA per gruppi di fatture.
+
+Le righe di tutte le fatture si leggono con una sola query (IN sugli id) e si
+raggruppano in memoria per fattura_id; clienti e fatturanti arrivano dalla
+cache di lookup, quindi il numero di query non dipende dal numero di fatture.
+Ogni XML viene validato contro lo schema XSD prima di essere archiviato o
+segnato come generato. I lotti grandi vengono generati in parallelo da un pool
+di processi; lo stesso vale per i PDF di cortesia (`genera_pdf`).
+"""
+import itertools
+import time
+from collections import defaultdict
+from sqlalchemy import update, bindparam
+from config import XML_WORKERS, XML_PARALLELO_SOGLIA, PDF_PARALLELO_SOGLIA
+from models import Fattura, Prestazione, DocumentoFattura
+from utils.documenti import impronta, salva_molti
+from utils.fattura_xml import genera_fattura_xml
+from utils.helpers import load_fatturante
+from utils.lookup_cache import get_clienti, get_fatturanti, FATTURANTE_ESCLUSE
+from utils.snapshot import snapshot
+from utils.validazione_xml import valida, valida_lotto
+
+_F = Fattura.__table__
+
+# XML nuovi archiviati ogni N documenti, per non tenerli tutti in memoria
+ARCHIVIO_BLOCCO = 200
+
+
+def carica_fatture(session, fattura_ids):
+    """
+    Fatture `fattura_ids` con righe, fatturante e cliente: lista di tuple
+    (fattura, righe, fatturante, cliente) nell'ordine degli id richiesti.
+    Righe ordinate per id; fatturante/cliente sono None se non trovati.
+    """
+    ids = [int(i) for i in fattura_ids]
+    if not ids:
+        return []
+    fatture = {f.id: f for f in session.query(Fattura).filter(Fattura.id.in_(ids))}
+    righe = defaultdict(list)
+    for p in (session.query(Prestazione).filter(Prestazione.fattura_id.in_(list(fatture)))
+              .order_by(Prestazione.fattura_id, Prestazione.id)):
+        righe[p.fattura_id].append(p)
+    clienti, fatturanti = get_clienti(), get_fatturanti()
+    return [(f, righe.get(f.id, []), fatturanti.get(f.fatturante_id), clienti.get(f.cliente_id))
+            for f in (fatture.get(i) for i in ids) if f is not None]
+
+
+def segna_xml_generati(session, generati):
+    """Stato 'XML Generato' e nome file per [(fattura_id, filename), ...] in un'unica executemany."""
+    if not generati:
+        return
+    session.execute(
+        update(_F).where(_F.c.id == bindparam("b_id"))
+        .values(xml_generato=True, xml_filename=bindparam("b_fn"), stato="XML Generato"),
+        [{"b_id": fid, "b_fn": fn} for fid, fn in generati],
+    )
+    ids = {fid for fid, _ in generati}
+    for obj in session.identity_map.values():
+        if isinstance(obj, Fattura) and obj.id in ids:
+            session.expire(obj, ["xml_generato", "xml_filename", "stato"])
+
+
+def _archiviati(session, impronte, tipo="xml"):
+    """{fattura_id: (contenuto, filename)} dei documenti già archiviati con la stessa impronta (XML come str)."""
+    if not impronte:
+        return {}
+    rows = session.query(DocumentoFattura.fattura_id, DocumentoFattura.impronta,
+                         DocumentoFattura.filename, DocumentoFattura.contenuto).filter(
+        DocumentoFattura.fattura_id.in_(list(impronte)), DocumentoFattura.tipo == tipo,
+        DocumentoFattura.impronta.in_(list(set(impronte.values()))),
+    )
+    return {r.fattura_id: (r.contenuto.decode("utf-8") if tipo == "xml" else r.contenuto, r.filename)
+            for r in rows if impronte[r.fattura_id] == r.impronta}
+
+
+def _genera_seriale(lotto):
+    for t in lotto:
+        xml_str, filename = genera_fattura_xml(*t)
+        yield xml_str, filename, t[0].id, valida(xml_str, "fatturapa")
+
+
+def genera_xml(session, fattura_ids, esito, segna=True, workers=None, avanzamento=None):
+    """
+    Generatore di (xml_str, filename, fattura_id) per le fatture `fattura_ids`,
+    da consumare man mano (es. verso genera_zip_fatture) senza tenere in memoria
+    tutti gli XML. Gli XML nuovi che non superano la validazione XSD non vengono
+    restituiti, archiviati né segnati. Gli XML già archiviati con la stessa impronta dei dati
+    (utils/documenti.py) vengono riusati; i nuovi vengono archiviati a blocchi.
+    A generatore esaurito `esito` contiene:
+    - "generati": [(fattura_id, filename), ...];
+    - "da_archivio": quanti XML sono stati trovati nell'archivio (rivalidati
+      come i nuovi: quelli non più validi finiscono in "non_validi");
+    - "non_validi": {fattura_id: errori} (vedi utils/validazione_xml.valida);
+    - "saltate": id delle fatture senza righe, cliente o fatturante;
+    - "tempi": millisecondi per fase (caricamento, generazione, salvataggio);
+    - "workers": processi usati (1 = seriale).
+    Oltre XML_PARALLELO_SOGLIA fatture la generazione passa al pool di processi
+    (utils/xml_pool.py). `avanzamento(fatti, totale)` segnala il progresso (al più ~100 volte).
+    Con segna=True le fatture generate passano a 'XML Generato' (senza commit).
+    """
+    workers = XML_WORKERS if workers is None else workers
+    tempi = esito["tempi"] = {}
+    t0 = time.perf_counter()
+    lotto = carica_fatture(session, fattura_ids)
+    esito["saltate"] = [f.id for f, righe, ft, cl in lotto if not (righe and ft and cl)]
+    lotto = [t for t in lotto if t[1] and t[2] and t[3]]
+    impronte = {t[0].id: impronta("xml", *t) for t in lotto}
+    archiviati = _archiviati(session, impronte)
+    da_generare = [t for t in lotto if t[0].id not in archiviati]
+    esito["da_archivio"] = len(archiviati)
+    tempi["caricamento"] = round((time.perf_counter() - t0) * 1000, 1)
+
+    # Anche gli XML archiviati si rivalidano: lo schema in uso può essere cambiato
+    # (es. schema ufficiale al posto della trascrizione) dopo l'archiviazione
+    t0 = time.perf_counter()
+    non_validi_archivio = valida_lotto(((fid, x) for fid, (x, _) in archiviati.items()),
+                                       "fatturapa", workers)
+    tempi["validazione_archivio"] = round((time.perf_counter() - t0) * 1000, 1)
+
+    t0 = time.perf_counter()
+    if workers > 1 and len(da_generare) >= XML_PARALLELO_SOGLIA:
+        from utils.xml_pool import snapshot_lotto, genera_parallelo
+        nuovi = genera_parallelo(snapshot_lotto(da_generare), workers)
+    else:
+        workers = 1
+        nuovi = _genera_seriale(da_generare)
+    esito["workers"] = workers
+    risultati = itertools.chain(((x, fn, fid, non_validi_archivio.get(fid))
+                                 for fid, (x, fn) in archiviati.items()), nuovi)
+
+    generati = esito["generati"] = []
+    non_validi = esito["non_validi"] = {}
+    da_salvare, t_salva = [], 0.0
+    passo = max(1, len(lotto) // 100)
+    for fatti, (xml_str, filename, fattura_id, errori) in enumerate(risultati, 1):
+        if errori:
+            non_validi[fattura_id] = errori
+        else:
+            generati.append((fattura_id, filename))
+            if fattura_id not in archiviati:
+                da_salvare.append((fattura_id, "xml", impronte[fattura_id], filename, xml_str.encode("utf-8")))
+                if len(da_salvare) >= ARCHIVIO_BLOCCO:
+                    ts = time.perf_counter()
+                    salva_molti(session, da_salvare)
+                    da_salvare, t_salva = [], t_salva + time.perf_counter() - ts
+            yield xml_str, filename, fattura_id
+        if avanzamento and (fatti % passo == 0 or fatti == len(lotto)):
+            avanzamento(fatti, len(lotto))
+    tempi["generazione"] = round((time.perf_counter() - t0 - t_salva) * 1000, 1)
+
+    t0 = time.perf_counter()
+    salva_molti(session, da_salvare)
+    if segna:
+        segna_xml_generati(session, generati)
+    tempi["salvataggio"] = round((time.perf_counter() - t0 + t_salva) * 1000, 1)
+
+
+def genera_xml_batch(session, fattura_ids, segna=True, workers=None, avanzamento=None):
+    """Come genera_xml, ma raccoglie tutto: l'esito ha in più "xml" = [(xml_str, filename, fattura_id)]."""
+    esito = {}
+    esito["xml"] = list(genera_xml(session, fattura_ids, esito, segna, workers, avanzamento))
+    return esito
+
+
+# =============================================
+# PDF
+# =============================================
+def _genera_pdf_seriale(lotto):
+    from utils.pdf_generator import genera_fattura_pdf
+    for t in lotto:
+        yield genera_fattura_pdf(*t), f"Fattura_{t[0].numero}_{t[0].anno}.pdf", t[0].id
+
+
+def genera_pdf(session, fattura_ids, esito, workers=None, avanzamento=None):
+    """
+    Generatore di (pdf, filename, fattura_id) per le fatture `fattura_ids`, come
+    genera_xml: PDF riusati dall'archivio se l'impronta (logo compreso) non è
+    cambiata, nuovi archiviati a blocchi. I fatturanti si caricano una volta
+    sola con il logo e passano ai worker come snapshot (senza credenziali SMTP).
+    Oltre PDF_PARALLELO_SOGLIA fatture da generare si usa il pool di processi.
+    A generatore esaurito `esito` contiene "generati", "da_archivio", "saltate",
+    "tempi" e "workers" come in genera_xml (nessuna validazione XSD).
+    """
+    workers = XML_WORKERS if workers is None else workers
+    tempi = esito["tempi"] = {}
+    t0 = time.perf_counter()
+    lotto = carica_fatture(session, fattura_ids)
+    esito["saltate"] = [f.id for f, righe, ft, cl in lotto if not (righe and ft and cl)]
+    lotto = [t for t in lotto if t[1] and t[2] and t[3]]
+    escluse = tuple(k for k in FATTURANTE_ESCLUSE if k != "logo")
+    fatturanti = {fid: snapshot(load_fatturante(session, fid), exclude=escluse)
+                  for fid in {t[2].id for t in lotto}}
+    lotto = [(f, righe, fatturanti[ft.id], cl) for f, righe, ft, cl in lotto]
+    impronte = {t[0].id: impronta("pdf", *t, logo=t[2].logo) for t in lotto}
+    archiviati = _archiviati(session, impronte, "pdf")
+    da_generare = [t for t in lotto if t[0].id not in archiviati]
+    esito["da_archivio"] = len(archiviati)
+    tempi["caricamento"] = round((time.perf_counter() - t0) * 1000, 1)
+
+    t0 = time.perf_counter()
+    if workers > 1 and len(da_generare) >= PDF_PARALLELO_SOGLIA:
+        from utils.xml_pool import snapshot_lotto, genera_pdf_parallelo
+        nuovi = genera_pdf_parallelo(snapshot_lotto(da_generare), workers)
+    else:
+        workers = 1
+        nuovi = _genera_pdf_seriale(da_generare)
+    esito["workers"] = workers
+    risultati = itertools.chain(((pdf, fn, fid) for fid, (pdf, fn) in archiviati.items()), nuovi)
+
+    generati = esito["generati"] = []
+    da_salvare, t_salva = [], 0.0
+    passo = max(1, len(lotto) // 100)
+    for fatti, (pdf, filename, fattura_id) in enumerate(risultati, 1):
+        generati.append((fattura_id, filename))
+        if fattura_id not in archiviati:
+            da_salvare.append((fattura_id, "pdf", impronte[fattura_id], filename, pdf))
+            if len(da_salvare) >= ARCHIVIO_BLOCCO:
+                ts = time.perf_counter()
+                salva_molti(session, da_salvare)
+                da_salvare, t_salva = [], t_salva + time.perf_counter() - ts
+        yield pdf, filename, fattura_id
+        if avanzamento and (fatti % passo == 0 or fatti == len(lotto)):
+            avanzamento(fatti, len(lotto))
+    tempi["generazione"] = round((time.perf_counter() - t0 - t_salva) * 1000, 1)
+
+    t0 = time.perf_counter()
+    salva_molti(session, da_salvare)
+    tempi["salvataggio"] = round((time.perf_counter() - t0 + t_salva) * 1000, 1)
@@ -1,6 +1,6 @@
 """Funzioni di utilità condivise."""
 from config import MESI, ROMAN_TRIMESTRI, ROMAN_SEMESTRI
-from datetime import date
+from datetime import date, timedelta
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 import re
@@ -42,14 +42,21 @@ def add_period(dt, periodicita):
     return dt + deltas.get(periodicita, relativedelta())
 
 
-def get_next_fattura_number(session, fatturante_id, anno):
-    from models import Fattura
-    from sqlalchemy import func
-    result = session.query(func.max(Fattura.numero)).filter(
-        Fattura.fatturante_id == fatturante_id,
-        Fattura.anno == anno
-    ).scalar()
-    return (result or 0) + 1
+def load_fatturante(session, fatturante_id, logo=True, smtp=False):
+    """
+    Soggetto fatturante con le colonne differite richieste già caricate
+    (logo per il PDF, credenziali SMTP per l'invio email).
+    """
+    from models import SoggettoFatturante
+    from sqlalchemy.orm import undefer_group
+    opts = []
+    if logo:
+        opts.append(undefer_group("logo"))
+    if smtp:
+        opts.append(undefer_group("smtp"))
+    return session.query(SoggettoFatturante).options(*opts).filter(
+        SoggettoFatturante.id == fatturante_id
+    ).first()
 
 
 def parse_date_filter(text):
@@ -132,25 +139,48 @@ def parse_date_filter(text):
     return None
 
 
+def date_filter_bounds(date_filter):
+    """
+    Converte il filtro data parsed nell'intervallo semiaperto [inizio, fine).
+    Un estremo None indica nessun limite. Ritorna None se il filtro non
+    corrisponde a date valide (es. mese 13).
+    """
+    t = date_filter["tipo"]
+    try:
+        if t == "anno":
+            inizio = date(date_filter["anno"], 1, 1)
+            return inizio, inizio + relativedelta(years=1)
+        elif t == "mese_anno":
+            inizio = date(date_filter["anno"], date_filter["mese"], 1)
+            return inizio, inizio + relativedelta(months=1)
+        elif t == "data":
+            return date_filter["data"], date_filter["data"] + timedelta(days=1)
+        elif t == "dopo":
+            return date_filter["data"] + timedelta(days=1), None
+        elif t == "prima":
+            return None, date_filter["data"]
+        elif t == "range":
+            return date_filter["da"], date_filter["a"] + timedelta(days=1)
+    except ValueError:
+        return None
+    return None, None
+
+
 def apply_date_filter(query, model_field, date_filter):
-    """Applica il filtro data parsed alla query SQLAlchemy."""
-    from sqlalchemy import extract
+    """
+    Applica il filtro data parsed alla query SQLAlchemy come confronto sulla
+    colonna grezza (campo >= inizio AND campo < fine), così da usare l'indice
+    B-tree della colonna per qualsiasi tipo di filtro.
+    """
+    from sqlalchemy import false
     if not date_filter:
         return query
-    t = date_filter["tipo"]
-    if t == "anno":
-        return query.filter(extract("year", model_field) == date_filter["anno"])
-    elif t == "mese_anno":
-        return query.filter(
-            extract("year", model_field) == date_filter["anno"],
-            extract("month", model_field) == date_filter["mese"]
-        )
-    elif t == "data":
-        return query.filter(model_field == date_filter["data"])
-    elif t == "dopo":
-        return query.filter(model_field > date_filter["data"])
-    elif t == "prima":
-        return query.filter(model_field < date_filter["data"])
-    elif t == "range":
-        return query.filter(model_field >= date_filter["da"], model_field <= date_filter["a"])
+    bounds = date_filter_bounds(date_filter)
+    if bounds is None:
+        return query.filter(false())
+    inizio, fine = bounds
+    if inizio is not None:
+        query = query.filter(model_field >= inizio)
+    if fine is not None:
+        query = query.filter(model_field < fine)
     return query
@@ -0,0 +1,86 @@
+"""
+Importi in centesimi interi, con un'unica regola di arrotondamento.
+
+Gli importi si convertono in centesimi (int) una volta sola; l'IVA di ogni riga
+è arrotondata al centesimo half-up (la metà si arrotonda lontano da zero) e
+riepiloghi per aliquota e totali di fattura sono somme di interi. Emissione,
+saldi, XML, PDF e SDD usano queste funzioni e ottengono sempre gli stessi
+valori. Le funzioni *_righe lavorano su array numpy per calcolare molte righe
+insieme; `totale_sql` applica la stessa regola nel database.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+import numpy as np
+from sqlalchemy import Integer, Numeric, case, cast, func
+
+
+def centesimi(valore):
+    """Decimal/float/str/int/None → centesimi interi (half-up)."""
+    if valore is None:
+        return 0
+    if not isinstance(valore, Decimal):
+        valore = Decimal(str(valore))
+    return int(valore.scaleb(2).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def euro(cent):
+    """Centesimi interi → Decimal con due decimali."""
+    return Decimal(int(cent)).scaleb(-2)
+
+
+def iva(cent, aliquota):
+    """IVA in centesimi di un imponibile in centesimi, aliquota percentuale intera."""
+    cent, aliquota = int(cent), int(aliquota or 0)
+    q = (abs(cent) * aliquota + 50) // 100
+    return q if cent >= 0 else -q
+
+
+def totale(cent, aliquota):
+    """Imponibile + IVA in centesimi."""
+    return int(cent) + iva(cent, aliquota)
+
+
+# =============================================
+# ARRAY
+# =============================================
+def iva_righe(cent, aliquote):
+    """Come iva() su array di centesimi e aliquote (int64)."""
+    cent = np.asarray(cent, dtype=np.int64)
+    aliquote = np.asarray(aliquote, dtype=np.int64)
+    return np.sign(cent) * ((np.abs(cent) * aliquote + 50) // 100)
+
+
+def riepilogo(righe):
+    """
+    Calcolo completo di una fattura dalle righe (oggetti con importo_unitario e
+    aliquota_iva). Ritorna un dict in centesimi:
+    - "righe": [(imponibile, iva, totale), ...] nell'ordine delle righe;
+    - "aliquote": {aliquota: (imponibile, iva)} ordinato per aliquota;
+    - "imponibile", "iva", "totale" della fattura.
+    """
+    righe = list(righe)
+    n = len(righe)
+    cent = np.fromiter((centesimi(p.importo_unitario) for p in righe), np.int64, count=n)
+    aliq = np.fromiter((int(p.aliquota_iva or 0) for p in righe), np.int64, count=n)
+    iv = iva_righe(cent, aliq)
+    tot = cent + iv
+    aliquote = {}
+    for a in np.unique(aliq):
+        m = aliq == a
+        aliquote[int(a)] = (int(cent[m].sum()), int(iv[m].sum()))
+    return {
+        "righe": list(zip(cent.tolist(), iv.tolist(), tot.tolist())),
+        "aliquote": aliquote,
+        "imponibile": int(cent.sum()), "iva": int(iv.sum()), "totale": int(tot.sum()),
+    }
+
+
+# =============================================
+# SQL
+# =============================================
+def totale_sql(importo, aliquota):
+    """Espressione SQL di totale() su colonne importo (euro) e aliquota, in euro."""
+    cent = cast(func.round(importo * 100), Integer)
+    aliq = func.coalesce(aliquota, 0)
+    iv = case((cent < 0, -((-cent * aliq + 50) // 100)), else_=(cent * aliq + 50) // 100)
+    # round(): sui database senza decimali esatti (SQLite) elimina il residuo float
+    return func.round(cast(cent + iv, Numeric(14, 2)) * Decimal("0.01"), 2)
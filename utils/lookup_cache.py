@@ -0,0 +1,114 @@
+"""
+Cache di processo per le tabelle di lookup (clienti, conti ricavo, fatturanti).
+
+Gli snapshot sono condivisi da tutte le sessioni Streamlit del processo e
+ricaricati solo quando il contatore di versione cambia. Il contatore viene
+incrementato al commit di qualunque sessione che abbia inserito, modificato o
+cancellato righe di queste tabelle (flush ORM o UPDATE/DELETE massivi).
+"""
+import threading
+from types import MappingProxyType
+from sqlalchemy import event
+from sqlalchemy.orm import load_only
+from models import Cliente, ContoRicavo, SoggettoFatturante
+from utils.snapshot import Snapshot, ClienteSnapshot, snapshot, column_keys
+
+# Colonne pesanti o riservate escluse dagli snapshot condivisi
+FATTURANTE_ESCLUSE = ("logo", "smtp_host", "smtp_port", "smtp_user", "smtp_password", "smtp_from")
+
+_TABELLE = {
+    "clienti": (Cliente, Cliente.cognome_ragione_sociale, ClienteSnapshot, ()),
+    "conti": (ContoRicavo, ContoRicavo.codice, Snapshot, ()),
+    "fatturanti": (SoggettoFatturante, SoggettoFatturante.ragione_sociale, Snapshot,
+                   FATTURANTE_ESCLUSE),
+}
+_MODELLI = tuple(t[0] for t in _TABELLE.values())
+
+_lock = threading.Lock()
+_version = 0
+_cache = {}  # nome -> (versione, mapping id -> snapshot)
+
+
+def _load(nome):
+    from database import get_session
+    model, order_by, cls, exclude = _TABELLE[nome]
+    cols = [getattr(model, k) for k in column_keys(model, exclude)]
+    session = get_session()
+    try:
+        rows = session.query(model).options(load_only(*cols)).order_by(order_by).all()
+        return MappingProxyType({r.id: snapshot(r, cls, exclude) for r in rows})
+    finally:
+        session.close()
+
+
+def _get(nome):
+    hit = _cache.get(nome)
+    if hit and hit[0] == _version:
+        return hit[1]
+    with _lock:
+        hit = _cache.get(nome)
+        if hit and hit[0] == _version:
+            return hit[1]
+        versione = _version
+        data = _load(nome)
+        _cache[nome] = (versione, data)
+        return data
+
+
+def get_clienti():
+    """{id: ClienteSnapshot} ordinati per cognome/ragione sociale."""
+    return _get("clienti")
+
+
+def get_conti():
+    """{id: Snapshot} dei conti ricavo ordinati per codice."""
+    return _get("conti")
+
+
+def get_fatturanti():
+    """{id: Snapshot} dei fatturanti per ragione sociale, senza logo e SMTP."""
+    return _get("fatturanti")
+
+
+def invalidate():
+    global _version
+    with _lock:
+        _version += 1
+
+
+def version():
+    return _version
+
+
+# =============================================
+# INVALIDAZIONE AL COMMIT
+# =============================================
+def _after_flush(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, _MODELLI):
+            session.info["_lookup_dirty"] = True
+            return
+
+
+def _do_orm_execute(state):
+    if (state.is_insert or state.is_update or state.is_delete) and any(
+            m.class_ in _MODELLI for m in state.all_mappers):
+        state.session.info["_lookup_dirty"] = True
+
+
+def _after_commit(session):
+    if session.info.pop("_lookup_dirty", False):
+        invalidate()
+
+
+def _after_rollback(session):
+    session.info.pop("_lookup_dirty", None)
+
+
+def install(session_factory):
+    """Registra gli eventi di invalidazione sulla factory delle sessioni."""
+    if not event.contains(session_factory, "after_commit", _after_commit):
+        event.listen(session_factory, "after_flush", _after_flush)
+        event.listen(session_factory, "do_orm_execute", _do_orm_execute)
+        event.listen(session_factory, "after_commit", _after_commit)
+        event.listen(session_factory, "after_rollback", _after_rollback)
@@ -0,0 +1,259 @@
+"""
+Migrazioni versionate dello schema.
+
+Ogni versione è un elenco ordinato di operazioni; ogni operazione produce le
+istruzioni SQL da eseguire leggendo il catalogo corrente. Una versione viene
+applicata in un'unica transazione e registrata in `schema_migrations`; in caso
+di errore la transazione viene annullata e le versioni successive non partono.
+"""
+import re
+import time
+from datetime import datetime
+from sqlalchemy import (MetaData, Table, Column, Integer, String, DateTime, Numeric,
+                        inspect, select, text)
+from sqlalchemy.schema import CreateTable, CreateIndex
+from database import Base
+
+_meta = MetaData()
+schema_migrations = Table(
+    "schema_migrations", _meta,
+    Column("versione", Integer, primary_key=True, autoincrement=False),
+    Column("descrizione", String(255), nullable=False),
+    Column("applicata_il", DateTime, default=datetime.utcnow),
+    Column("durata_ms", Numeric(10, 1)),
+)
+
+
+# =============================================
+# OPERAZIONI
+# =============================================
+def create_tables(*names):
+    """CREATE TABLE (con i relativi indici) per le tabelle mancanti del modello."""
+    def plan(conn):
+        import models  # noqa
+        existing = set(inspect(conn).get_table_names())
+        stmts = []
+        for table in Base.metadata.sorted_tables:
+            if (names and table.name not in names) or table.name in existing:
+                continue
+            stmts.append(str(CreateTable(table).compile(dialect=conn.dialect)).strip())
+            for idx in sorted(table.indexes, key=lambda i: i.name):
+                stmts.append(str(CreateIndex(idx).compile(dialect=conn.dialect)).strip())
+        return stmts
+    return plan
+
+
+def _column_ddl(col, dialect):
+    col_type = col.type.compile(dialect=dialect)
+    default_clause = ""
+    if col.default is not None:
+        dv = col.default.arg
+        if callable(dv):
+            pass
+        elif isinstance(dv, str):
+            default_clause = f" DEFAULT '{dv}'"
+        elif isinstance(dv, bool):
+            default_clause = f" DEFAULT {'true' if dv else 'false'}"
+        elif isinstance(dv, (int, float)):
+            default_clause = f" DEFAULT {dv}"
+    elif col.nullable:
+        default_clause = ""
+    elif "VARCHAR" in col_type.upper() or col_type.upper() == "TEXT":
+        default_clause = " DEFAULT ''"
+    elif "NUMERIC" in col_type.upper() or col_type.upper() == "INTEGER":
+        default_clause = " DEFAULT 0"
+    elif col_type.upper() == "BOOLEAN":
+        default_clause = " DEFAULT false"
+
+    # Per colonne NOT NULL senza default, rendiamole nullable per sicurezza
+    null_clause = " NOT NULL" if not col.nullable and default_clause else ""
+    return f'ADD COLUMN "{col.name}" {col_type}{default_clause}{null_clause}'
+
+
+def add_columns(*names):
+    """Colonne del modello mancanti nel DB: un solo ALTER TABLE per tabella."""
+    def plan(conn):
+        import models  # noqa
+        inspector = inspect(conn)
+        existing_tables = set(inspector.get_table_names())
+        stmts = []
+        for table in Base.metadata.sorted_tables:
+            if (names and table.name not in names) or table.name not in existing_tables:
+                continue
+            existing_cols = {c["name"] for c in inspector.get_columns(table.name)}
+            clauses = [_column_ddl(col, conn.dialect) for col in table.columns
+                       if col.name not in existing_cols]
+            if not clauses:
+                continue
+            if conn.dialect.name == "sqlite":
+                # SQLite accetta una sola ADD COLUMN per istruzione
+                stmts.extend(f'ALTER TABLE "{table.name}" {c}' for c in clauses)
+            else:
+                stmts.append(f'ALTER TABLE "{table.name}" ' + ", ".join(clauses))
+        return stmts
+    return plan
+
+
+def backfill_saldi():
+    """Ricalcolo completo dei saldi memorizzati sulle prestazioni."""
+    def plan(conn):
+        from utils.saldi import _P, _totale_sql, _incassato_sql
+        stmt = _P.update().values(totale=_totale_sql(),
+                                  totale_incassato_confermato=_incassato_sql(),
+                                  credito_residuo=_totale_sql() - _incassato_sql(),
+                                  updated_at=_P.c.updated_at)
+        return [str(stmt.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))]
+    return plan
+
+
+def sql(*statements, dialects=None):
+    """Istruzioni SQL fisse, eventualmente limitate ad alcuni dialetti."""
+    def plan(conn):
+        if dialects and conn.dialect.name not in dialects:
+            return []
+        return list(statements)
+    return plan
+
+
+# =============================================
+# VERSIONI (solo in aggiunta, mai modificare quelle già rilasciate)
+# =============================================
+def _migrations():
+    from utils.db_indexes import INDEXES, POSTGRES_INDEXES
+    return [
+        (1, "Schema iniziale, colonne mancanti e indici Dashboard", [
+            create_tables(),
+            add_columns(),
+            sql(*INDEXES),
+            sql(*POSTGRES_INDEXES, dialects=("postgresql",)),
+        ]),
+        (2, "Filtri data su intervalli: indice su fatture.data, rimosso indice EXTRACT", [
+            sql("CREATE INDEX IF NOT EXISTS idx_fattura_data ON fatture (data)"),
+            sql("DROP INDEX IF EXISTS idx_prest_data_mese", dialects=("postgresql",)),
+        ]),
+        (3, "Saldi memorizzati su prestazioni (totale, incassato confermato, residuo)", [
+            add_columns("prestazioni"),
+            backfill_saldi(),
+        ]),
+        (4, "Contatore numerazione fatture per fatturante e anno", [
+            create_tables("numerazione_fatture"),
+            sql("INSERT INTO numerazione_fatture (fatturante_id, anno, ultimo_numero) "
+                "SELECT fatturante_id, anno, max(numero) FROM fatture GROUP BY fatturante_id, anno"),
+        ]),
+        (5, "Archivio documenti XML/PDF generati", [
+            create_tables("documenti_fattura"),
+        ]),
+        (6, "EndToEndId SDD sugli incassi per gli esiti pain.002", [
+            add_columns("incassi"),
+            sql("CREATE INDEX IF NOT EXISTS ix_incassi_end_to_end_id ON incassi (end_to_end_id)"),
+        ]),
+        (7, "Tracciati SDD archiviati e collegati agli incassi", [
+            create_tables("sdd_batch", "sdd_batch_file"),
+            add_columns("incassi"),
+            sql("CREATE INDEX IF NOT EXISTS ix_incassi_sdd_batch_id ON incassi (sdd_batch_id)"),
+        ]),
+        (8, "Un solo tracciato SDD attivo per chiave", [
+            sql("CREATE UNIQUE INDEX IF NOT EXISTS uq_sdd_batch_chiave_attivo ON sdd_batch (chiave) "
+                "WHERE stato = 'Generato'"),
+        ]),
+    ]
+
+
+MIGRATIONS = _migrations()
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# =============================================
+# STIMA IMPATTO LOCK
+# =============================================
+_TABLE_RE = re.compile(
+    r'^\s*(?:ALTER TABLE|UPDATE|DELETE FROM|INSERT INTO|CREATE (?:UNIQUE )?INDEX(?: IF NOT EXISTS)? \S+ ON|DROP INDEX)'
+    r'\s+"?(\w+)"?', re.IGNORECASE)
+
+
+def _row_estimate(conn, table):
+    try:
+        if conn.dialect.name == "postgresql":
+            n = conn.execute(text("SELECT reltuples::bigint FROM pg_class WHERE relname = :t"),
+                             {"t": table}).scalar()
+            return max(int(n or 0), 0)
+        return conn.execute(text(f'SELECT count(*) FROM "{table}"')).scalar()
+    except Exception:
+        return None
+
+
+def lock_impact(conn, statement):
+    """Stima del lock preso da un'istruzione DDL/DML e delle righe coinvolte."""
+    s = statement.strip().upper()
+    m = _TABLE_RE.match(statement)
+    table = m.group(1) if m else None
+    rows = _row_estimate(conn, table) if table and not s.startswith("DROP INDEX") else None
+    n = f"~{rows:,} righe".replace(",", ".") if rows is not None else "righe n/d"
+    if s.startswith("CREATE TABLE"):
+        return "nessun lock su tabelle esistenti"
+    if s.startswith("ALTER TABLE"):
+        if "DEFAULT" in s and ("NOW()" in s or "RANDOM()" in s):
+            return f"ACCESS EXCLUSIVE con riscrittura tabella ({n})"
+        return f"ACCESS EXCLUSIVE breve, solo catalogo ({table})"
+    if s.startswith("CREATE") and "INDEX" in s:
+        if "CONCURRENTLY" in s:
+            return f"SHARE UPDATE EXCLUSIVE, letture e scritture consentite ({n})"
+        return f"SHARE: scritture bloccate durante la scansione ({n})"
+    if s.startswith("DROP INDEX"):
+        return "ACCESS EXCLUSIVE breve sulla tabella dell'indice"
+    if s.startswith(("UPDATE", "DELETE", "INSERT")):
+        return f"ROW EXCLUSIVE, righe bloccate fino al commit ({n})"
+    return "non stimato"
+
+
+# =============================================
+# RUNNER
+# =============================================
+def applied_versions(conn):
+    """Versioni registrate; nessuna se `schema_migrations` non esiste ancora (sola lettura)."""
+    if not inspect(conn).has_table(schema_migrations.name):
+        return set()
+    return set(conn.execute(select(schema_migrations.c.versione)).scalars())
+
+
+def pending_migrations(engine):
+    with engine.connect() as conn:
+        done = applied_versions(conn)
+    return [m for m in MIGRATIONS if m[0] not in done]
+
+
+def migrate(engine, dry_run=False, out=print):
+    """
+    Applica in ordine le versioni mancanti. Con dry_run stampa DDL e impatto
+    stimato senza modificare il DB. Ritorna l'elenco delle versioni trattate.
+    """
+    todo = pending_migrations(engine)
+    if not todo:
+        out("Schema aggiornato: nessuna migrazione da applicare.")
+        return []
+
+    if not dry_run:
+        with engine.begin() as conn:
+            _meta.create_all(bind=conn)
+
+    for versione, descrizione, ops in todo:
+        out(f"== {versione:04d} — {descrizione}")
+        t0 = time.perf_counter()
+        if dry_run:
+            with engine.connect() as conn:
+                for op in ops:
+                    for stmt in op(conn):
+                        out(f"   {stmt};")
+                        out(f"      ↳ lock: {lock_impact(conn, stmt)}")
+            continue
+
+        with engine.begin() as conn:
+            for op in ops:
+                for stmt in op(conn):
+                    conn.execute(text(stmt))
+            durata = round((time.perf_counter() - t0) * 1000, 1)
+            conn.execute(schema_migrations.insert().values(
+                versione=versione, descrizione=descrizione,
+                applicata_il=datetime.utcnow(), durata_ms=durata))
+        out(f"   applicata in {durata} ms")
+    return [m[0] for m in todo]
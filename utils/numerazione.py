@@ -0,0 +1,112 @@
+"""
+Numerazione fatture per (soggetto fatturante, anno).
+
+Il contatore vive in `numerazione_fatture`: ogni emissione riserva un blocco di
+numeri con un'unica INSERT ... ON CONFLICT DO UPDATE ... RETURNING, che blocca
+la riga del contatore fino al commit. Due operatori che emettono insieme per lo
+stesso fatturante vengono così serializzati invece di collidere sul vincolo
+`uq_fattura_num_anno_fatt`; se l'emissione fallisce, il rollback annulla anche
+la prenotazione e non restano buchi.
+"""
+from datetime import datetime
+from sqlalchemy import select, func, literal, over
+from models import NumerazioneFattura, Fattura
+
+_N = NumerazioneFattura.__table__
+_F = Fattura.__table__
+
+
+def _max_emesso(fatturante_id, anno):
+    return select(func.coalesce(func.max(_F.c.numero), 0)).where(
+        _F.c.fatturante_id == fatturante_id, _F.c.anno == anno
+    ).scalar_subquery()
+
+
+def riserva_numeri(session, fatturante_id, anno, quanti=1):
+    """
+    Riserva `quanti` numeri consecutivi e ritorna il primo. Il contatore parte
+    dal massimo già presente in `fatture` e non scende mai sotto di esso
+    (fatture importate o inserite a mano).
+    """
+    if quanti < 1:
+        raise ValueError("quanti deve essere almeno 1")
+    dialect = session.get_bind().dialect.name
+    ora = datetime.utcnow()
+
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+            maggiore = func.greatest
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+            maggiore = func.max  # max(a, b) scalare in SQLite
+        stmt = insert(_N).values(
+            fatturante_id=fatturante_id, anno=anno, aggiornato_il=ora,
+            ultimo_numero=_max_emesso(fatturante_id, anno) + quanti,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[_N.c.fatturante_id, _N.c.anno],
+            set_={"ultimo_numero": maggiore(_N.c.ultimo_numero, _max_emesso(fatturante_id, anno)) + quanti,
+                  "aggiornato_il": ora},
+        ).returning(_N.c.ultimo_numero)
+        ultimo = session.execute(stmt).scalar_one()
+        return ultimo - quanti + 1
+
+    # Altri dialetti: SELECT ... FOR UPDATE sul contatore
+    riga = session.execute(
+        select(_N.c.ultimo_numero).where(_N.c.fatturante_id == fatturante_id, _N.c.anno == anno)
+        .with_for_update()
+    ).first()
+    emesso = session.execute(select(_max_emesso(fatturante_id, anno))).scalar()
+    primo = max(riga[0] if riga else 0, emesso) + 1
+    if riga:
+        session.execute(_N.update().where(_N.c.fatturante_id == fatturante_id, _N.c.anno == anno)
+                        .values(ultimo_numero=primo + quanti - 1, aggiornato_il=ora))
+    else:
+        session.execute(_N.insert().values(fatturante_id=fatturante_id, anno=anno,
+                                           ultimo_numero=primo + quanti - 1, aggiornato_il=ora))
+    return primo
+
+
+# =============================================
+# VERIFICA
+# =============================================
+def verifica_numerazione(conn, fatturante_id=None, anno=None):
+    """
+    Anomalie della numerazione esistente. Ritorna un dict con:
+    - "buchi": (fatturante_id, anno, da, a) numeri mancanti tra due fatture;
+    - "duplicati": (fatturante_id, anno, numero, quante);
+    - "contatori": (fatturante_id, anno, contatore, massimo) contatori rimasti indietro.
+    """
+    filtri = []
+    if fatturante_id is not None:
+        filtri.append(_F.c.fatturante_id == fatturante_id)
+    if anno is not None:
+        filtri.append(_F.c.anno == anno)
+
+    prec = over(func.lag(_F.c.numero), partition_by=(_F.c.fatturante_id, _F.c.anno),
+                order_by=_F.c.numero)
+    seq = select(_F.c.fatturante_id, _F.c.anno, _F.c.numero,
+                 func.coalesce(prec, literal(0)).label("prec")).where(*filtri).subquery()
+    buchi = conn.execute(
+        select(seq.c.fatturante_id, seq.c.anno, (seq.c.prec + 1).label("da"), (seq.c.numero - 1).label("a"))
+        .where(seq.c.numero - seq.c.prec > 1)
+        .order_by(seq.c.fatturante_id, seq.c.anno, seq.c.numero)
+    ).fetchall()
+
+    duplicati = conn.execute(
+        select(_F.c.fatturante_id, _F.c.anno, _F.c.numero, func.count().label("quante"))
+        .where(*filtri).group_by(_F.c.fatturante_id, _F.c.anno, _F.c.numero)
+        .having(func.count() > 1).order_by(_F.c.fatturante_id, _F.c.anno, _F.c.numero)
+    ).fetchall()
+
+    massimi = select(_F.c.fatturante_id, _F.c.anno, func.max(_F.c.numero).label("massimo")) \
+        .where(*filtri).group_by(_F.c.fatturante_id, _F.c.anno).subquery()
+    contatori = conn.execute(
+        select(massimi.c.fatturante_id, massimi.c.anno,
+               func.coalesce(_N.c.ultimo_numero, 0).label("contatore"), massimi.c.massimo)
+        .select_from(massimi.outerjoin(_N, (_N.c.fatturante_id == massimi.c.fatturante_id)
+                                       & (_N.c.anno == massimi.c.anno)))
+        .where(func.coalesce(_N.c.ultimo_numero, 0) < massimi.c.massimo)
+    ).fetchall()
+    return {"buchi": buchi, "duplicati": duplicati, "contatori": contatori}
@@ -1,17 +1,169 @@
 """Generazione PDF fattura di cortesia con logo."""
 import io
+import hashlib
+import threading
+from collections import OrderedDict
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm
 from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Flowable
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.utils import ImageReader
 from reportlab.lib.enums import TA_CENTER, TA_RIGHT, TA_LEFT
-from decimal import Decimal, ROUND_HALF_UP
 from utils.helpers import calc_periodicity_label
-
-
-def _r2(val):
-    return Decimal(str(val)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+from utils.importi import riepilogo, euro
+
+
+# =============================================
+# CACHE LOGO
+# =============================================
+# Il logo viene decodificato e ridotto una volta sola alla risoluzione di stampa
+# del riquadro (40x20 mm a 300 dpi); le fatture successive riusano il PNG ridotto.
+LOGO_BOX_PX = (472, 236)
+_LOGO_CACHE_MAX = 32
+_logo_cache = OrderedDict()
+_logo_lock = threading.Lock()
+
+
+def logo_thumbnail(logo):
+    """PNG ridotto del logo (bytes) o None se l'immagine non è leggibile."""
+    if not logo:
+        return None
+    key = hashlib.sha1(logo).hexdigest()
+    with _logo_lock:
+        if key in _logo_cache:
+            _logo_cache.move_to_end(key)
+            return _logo_cache[key]
+    try:
+        from PIL import Image as PILImage
+        img = PILImage.open(io.BytesIO(logo))
+        img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        img.thumbnail(LOGO_BOX_PX, PILImage.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, format="PNG", optimize=True)
+        thumb = out.getvalue()
+    except Exception:
+        thumb = None
+    with _logo_lock:
+        _logo_cache[key] = thumb
+        while len(_logo_cache) > _LOGO_CACHE_MAX:
+            _logo_cache.popitem(last=False)
+    return thumb
+
+
+_reader_cache = OrderedDict()
+
+
+def _costruisci_logo(logo):
+    thumb = logo_thumbnail(logo)
+    if not thumb:
+        return None
+    try:
+        reader = ImageReader(io.BytesIO(thumb))
+        reader.getRGBData()  # decodifica subito: i pixel restano nel reader
+    except Exception:
+        return None
+    return reader
+
+
+def logo_reader(logo):
+    """
+    ImageReader del logo ridotto, già decodificato, condiviso da tutti i PDF
+    del processo con lo stesso logo (o None se il logo non è leggibile).
+    """
+    if not logo:
+        return None
+    key = hashlib.sha1(logo).hexdigest()
+    with _logo_lock:
+        if key in _reader_cache:
+            _reader_cache.move_to_end(key)
+            return _reader_cache[key]
+    reader = _costruisci_logo(logo)
+    with _logo_lock:
+        _reader_cache[key] = reader
+        while len(_reader_cache) > _LOGO_CACHE_MAX:
+            _reader_cache.popitem(last=False)
+    return reader
+
+
+class _Logo(Flowable):
+    """Logo disegnato da un ImageReader condiviso, senza rileggere l'immagine."""
+
+    def __init__(self, reader, width, height):
+        super().__init__()
+        self.reader, self.width, self.height = reader, width, height
+        self.hAlign = "LEFT"
+
+    def wrap(self, *args):
+        return self.width, self.height
+
+    def draw(self):
+        self.canv.drawImage(self.reader, 0, 0, self.width, self.height, mask="auto")
+
+
+# =============================================
+# STILI
+# =============================================
+# Paragrafi e tabelle usano sempre gli stessi stili: si costruiscono una volta
+# per processo invece che a ogni fattura.
+_stili = None
+_stili_lock = threading.Lock()
+
+
+def _costruisci_stili():
+    normal = getSampleStyleSheet()["Normal"]
+    sn = ParagraphStyle("sn", parent=normal, fontSize=9, leading=12)
+    return {
+        "sn": sn,
+        "sb": ParagraphStyle("sb", parent=normal, fontSize=9, leading=12, fontName="Helvetica-Bold"),
+        "sc": ParagraphStyle("sc", parent=normal, fontSize=9, leading=12, alignment=TA_CENTER),
+        "sr": ParagraphStyle("sr", parent=normal, fontSize=9, leading=12, alignment=TA_RIGHT),
+        "stitle": ParagraphStyle("stitle", parent=normal, fontSize=14, leading=18,
+                                 fontName="Helvetica-Bold", textColor=colors.HexColor("#1e293b")),
+        "foot": ParagraphStyle("foot", parent=sn, fontSize=7, textColor=colors.grey),
+    }
+
+
+def stili():
+    """ParagraphStyle della fattura, condivisi nel processo."""
+    global _stili
+    with _stili_lock:
+        if _stili is None:
+            _stili = _costruisci_stili()
+        return _stili
+
+
+_STILE_INTESTAZIONE = TableStyle([
+    ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 8),
+])
+_STILE_DESTINATARIO = TableStyle([
+    ("BOX", (0, 0), (-1, -1), 0.5, colors.grey),
+    ("TOPPADDING", (0, 0), (-1, -1), 4),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 4),
+    ("LEFTPADDING", (0, 0), (-1, -1), 6),
+])
+_STILE_RIGHE = TableStyle([
+    ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#1e293b")),
+    ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+    ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+    ("FONTSIZE", (0, 0), (-1, -1), 9),
+    ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+    ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.HexColor("#f0f9ff")]),
+    ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ("TOPPADDING", (0, 0), (-1, -1), 4),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 4),
+])
+_STILE_RIEPILOGO = TableStyle([
+    ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#334155")),
+    ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+    ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+    ("FONTSIZE", (0, 0), (-1, -1), 9),
+    ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+    ("ALIGN", (1, 1), (-1, -1), "RIGHT"),
+    ("TOPPADDING", (0, 0), (-1, -1), 4),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 4),
+])
 
 
 def genera_fattura_pdf(fattura, prestazioni, fatturante, cliente):
@@ -19,28 +171,13 @@ def genera_fattura_pdf(fattura, prestazioni, fatturante, cliente):
     buf = io.BytesIO()
     doc = SimpleDocTemplate(buf, pagesize=A4, topMargin=15*mm, bottomMargin=15*mm,
                             leftMargin=15*mm, rightMargin=15*mm)
-    styles = getSampleStyleSheet()
+    st = stili()
+    sn, sc, sr = st["sn"], st["sc"], st["sr"]
     elements = []
 
-    # Stili custom
-    sn = ParagraphStyle("sn", parent=styles["Normal"], fontSize=9, leading=12)
-    sb = ParagraphStyle("sb", parent=styles["Normal"], fontSize=9, leading=12, fontName="Helvetica-Bold")
-    sc = ParagraphStyle("sc", parent=styles["Normal"], fontSize=9, leading=12, alignment=TA_CENTER)
-    sr = ParagraphStyle("sr", parent=styles["Normal"], fontSize=9, leading=12, alignment=TA_RIGHT)
-    stitle = ParagraphStyle("stitle", parent=styles["Normal"], fontSize=14, leading=18,
-                            fontName="Helvetica-Bold", textColor=colors.HexColor("#1e293b"))
-
     # === HEADER con logo ===
-    header_data = []
-    logo_cell = ""
-    if fatturante.logo:
-        try:
-            logo_buf = io.BytesIO(fatturante.logo)
-            logo_img = Image(logo_buf, width=40*mm, height=20*mm)
-            logo_img.hAlign = "LEFT"
-            logo_cell = logo_img
-        except Exception:
-            logo_cell = ""
+    reader = logo_reader(fatturante.logo)
+    logo_cell = _Logo(reader, 40*mm, 20*mm) if reader else ""
 
     fatt_info = f"""<b>{fatturante.ragione_sociale}</b><br/>
     {fatturante.indirizzo} — {fatturante.cap} {fatturante.citta} ({fatturante.provincia})<br/>
@@ -49,15 +186,12 @@ def genera_fattura_pdf(fattura, prestazioni, fatturante, cliente):
 
     header_data = [[logo_cell, Paragraph(fatt_info, sn)]]
     ht = Table(header_data, colWidths=[45*mm, 135*mm])
-    ht.setStyle(TableStyle([
-        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 8),
-    ]))
+    ht.setStyle(_STILE_INTESTAZIONE)
     elements.append(ht)
     elements.append(Spacer(1, 8*mm))
 
     # === TITOLO ===
-    elements.append(Paragraph(f"FATTURA N. {fattura.numero}/{fattura.anno}", stitle))
+    elements.append(Paragraph(f"FATTURA N. {fattura.numero}/{fattura.anno}", st["stitle"]))
     elements.append(Paragraph(f"Data: {fattura.data.strftime('%d/%m/%Y')}", sn))
     elements.append(Spacer(1, 5*mm))
 
@@ -68,77 +202,41 @@ def genera_fattura_pdf(fattura, prestazioni, fatturante, cliente):
     {cliente.cap} {cliente.citta} ({cliente.provincia})<br/>
     P.IVA: {cliente.partita_iva} — C.F.: {cliente.codice_fiscale}"""
     dest_t = Table([[Paragraph(cl_info, sn)]], colWidths=[90*mm])
-    dest_t.setStyle(TableStyle([
-        ("BOX", (0, 0), (-1, -1), 0.5, colors.grey),
-        ("TOPPADDING", (0, 0), (-1, -1), 4),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 4),
-        ("LEFTPADDING", (0, 0), (-1, -1), 6),
-    ]))
+    dest_t.setStyle(_STILE_DESTINATARIO)
     elements.append(dest_t)
     elements.append(Spacer(1, 8*mm))
 
     # === RIGHE PRESTAZIONI ===
     data = [["N.", "Descrizione", "Importo", "IVA %", "Totale"]]
-    tot_imp = Decimal("0")
-    riepilogo_iva = {}
+    conti = riepilogo(prestazioni)
 
-    for i, p in enumerate(prestazioni, 1):
+    for i, (p, (imp, _, tot_riga)) in enumerate(zip(prestazioni, conti["righe"]), 1):
         desc = p.descrizione + calc_periodicity_label(p.periodicita, p.data_inizio)
-        imp = _r2(p.importo_unitario)
-        iva_amt = _r2(float(p.importo_unitario) * p.aliquota_iva / 100)
-        tot_riga = imp + iva_amt
-        tot_imp += imp
-        riepilogo_iva.setdefault(p.aliquota_iva, {"imp": Decimal("0"), "iva": Decimal("0")})
-        riepilogo_iva[p.aliquota_iva]["imp"] += imp
-        riepilogo_iva[p.aliquota_iva]["iva"] += iva_amt
-
         data.append([
             Paragraph(str(i), sc),
             Paragraph(desc, sn),
-            Paragraph(f"€ {imp:,.2f}".replace(",", "."), sr),
+            Paragraph(f"€ {euro(imp):,.2f}".replace(",", "."), sr),
             Paragraph(f"{p.aliquota_iva}%", sc),
-            Paragraph(f"€ {tot_riga:,.2f}".replace(",", "."), sr),
+            Paragraph(f"€ {euro(tot_riga):,.2f}".replace(",", "."), sr),
         ])
 
     t = Table(data, colWidths=[12*mm, 90*mm, 28*mm, 18*mm, 32*mm])
-    t.setStyle(TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#1e293b")),
-        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
-        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-        ("FONTSIZE", (0, 0), (-1, -1), 9),
-        ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-        ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.HexColor("#f0f9ff")]),
-        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-        ("TOPPADDING", (0, 0), (-1, -1), 4),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 4),
-    ]))
+    t.setStyle(_STILE_RIGHE)
     elements.append(t)
     elements.append(Spacer(1, 5*mm))
 
     # === RIEPILOGO IVA ===
     riep_data = [["Aliquota", "Imponibile", "Imposta"]]
-    tot_iva_tot = Decimal("0")
-    for aliq in sorted(riepilogo_iva.keys()):
-        v = riepilogo_iva[aliq]
-        tot_iva_tot += v["iva"]
-        riep_data.append([f"{aliq}%", f"€ {v['imp']:,.2f}".replace(",", "."),
-                          f"€ {v['iva']:,.2f}".replace(",", ".")])
-
-    gran_totale = tot_imp + tot_iva_tot
+    for aliq, (imp, iva) in conti["aliquote"].items():
+        riep_data.append([f"{aliq}%", f"€ {euro(imp):,.2f}".replace(",", "."),
+                          f"€ {euro(iva):,.2f}".replace(",", ".")])
+
+    gran_totale = euro(conti["totale"])
     riep_data.append(["", Paragraph("<b>TOTALE FATTURA</b>", sr),
                        Paragraph(f"<b>€ {gran_totale:,.2f}</b>".replace(",", "."), sr)])
 
     rt = Table(riep_data, colWidths=[30*mm, 50*mm, 50*mm])
-    rt.setStyle(TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#334155")),
-        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
-        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-        ("FONTSIZE", (0, 0), (-1, -1), 9),
-        ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-        ("ALIGN", (1, 1), (-1, -1), "RIGHT"),
-        ("TOPPADDING", (0, 0), (-1, -1), 4),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 4),
-    ]))
+    rt.setStyle(_STILE_RIEPILOGO)
     elements.append(rt)
     elements.append(Spacer(1, 8*mm))
 
@@ -149,7 +247,7 @@ def genera_fattura_pdf(fattura, prestazioni, fatturante, cliente):
 
     elements.append(Spacer(1, 5*mm))
     elements.append(Paragraph("<i>Documento di cortesia — la fattura originale è in formato elettronico (XML).</i>",
-                              ParagraphStyle("foot", parent=sn, fontSize=7, textColor=colors.grey)))
+                              st["foot"]))
 
     doc.build(elements)
     buf.seek(0)
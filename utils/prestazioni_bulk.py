@@ -0,0 +1,75 @@
+"""
+Operazioni massive sulle prestazioni eseguite in SQL, senza un oggetto ORM per riga.
+"""
+from datetime import datetime
+from sqlalchemy import select, insert, cast, func, literal, literal_column, Date
+from models import Prestazione
+from utils.helpers import add_period
+
+_P = Prestazione.__table__
+
+# Mesi di spostamento per periodicità (stessa semantica di helpers.add_period)
+PERIODO_MESI = {"Mensile": 1, "Trimestrale": 3, "Semestrale": 6, "Annuale": 12}
+
+# Colonne copiate invariate dalla prestazione di origine
+_COPIA = ("cliente_id", "conto_ricavo_id", "fatturante_id", "periodicita", "descrizione",
+          "importo_unitario", "aliquota_iva", "modalita_incasso", "totale")
+
+
+def _sposta_sql(col, mesi):
+    # date + interval su PostgreSQL tronca a fine mese come relativedelta (31/01 + 1 mese = 28/02)
+    if not mesi:
+        return col
+    return cast(col + literal_column(f"interval '{int(mesi)} months'"), Date)
+
+
+def duplica_prestazioni(session, ids, periodo="same"):
+    """
+    Duplica le prestazioni `ids` spostando data_inizio/data_fine di un periodo
+    ("same" = date invariate). Nessuna fattura né incasso viene copiato.
+    Ritorna gli id delle nuove prestazioni.
+    """
+    ids = sorted({int(i) for i in ids})
+    if not ids:
+        return []
+    mesi = PERIODO_MESI.get(periodo, 0)
+    ora = datetime.utcnow()
+
+    if session.get_bind().dialect.name == "postgresql":
+        # Un'unica INSERT ... SELECT ... RETURNING
+        sel = select(
+            *(_P.c[c] for c in _COPIA),
+            func.coalesce(_P.c.note, ""),
+            _sposta_sql(_P.c.data_inizio, mesi),
+            _sposta_sql(_P.c.data_fine, mesi),
+            literal(0).label("totale_incassato_confermato"),
+            _P.c.totale.label("credito_residuo"),
+            literal(ora).label("created_at"),
+            literal(ora).label("updated_at"),
+        ).where(_P.c.id.in_(ids)).order_by(_P.c.id)
+        stmt = insert(_P).from_select(
+            [*_COPIA, "note", "data_inizio", "data_fine", "totale_incassato_confermato",
+             "credito_residuo", "created_at", "updated_at"], sel,
+        ).returning(_P.c.id)
+        return list(session.execute(stmt).scalars())
+
+    # Altri dialetti: date calcolate in Python, una sola INSERT multi-riga
+    sorgente = session.execute(
+        select(*(_P.c[c] for c in _COPIA), _P.c.note, _P.c.data_inizio, _P.c.data_fine)
+        .where(_P.c.id.in_(ids)).order_by(_P.c.id)
+    ).mappings().all()
+    righe = []
+    for r in sorgente:
+        nuova = {c: r[c] for c in _COPIA}
+        nuova.update(
+            note=r["note"] or "",
+            data_inizio=add_period(r["data_inizio"], periodo) if mesi else r["data_inizio"],
+            data_fine=add_period(r["data_fine"], periodo) if mesi else r["data_fine"],
+            totale_incassato_confermato=0, credito_residuo=r["totale"],
+            created_at=ora, updated_at=ora,
+        )
+        righe.append(nuova)
+    if not righe:
+        return []
+    return list(session.execute(insert(_P).returning(_P.c.id, sort_by_parameter_order=True),
+                                righe).scalars())
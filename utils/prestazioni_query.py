@@ -0,0 +1,81 @@
+"""Query di lettura sulle prestazioni (filtri Dashboard, paginazione, metriche)."""
+from sqlalchemy import func, case, tuple_
+from models import Prestazione
+from utils.helpers import apply_date_filter
+from utils.importi import centesimi, euro
+
+
+def applica_filtri(q, filtri):
+    """
+    Applica a una query su Prestazione i filtri della Dashboard.
+    `filtri` contiene "mese"/"anno" (filtro rapido) oppure le chiavi del filtro
+    avanzato: "data" (dict di parse_date_filter), "cliente_id", "conto_ricavo_id",
+    "fatturante_id", "periodicita", "stato" ("Fatturato" / "Non fatturato").
+    """
+    if filtri.get("mese"):
+        return apply_date_filter(q, Prestazione.data_inizio,
+                                 {"tipo": "mese_anno", "mese": filtri["mese"], "anno": filtri["anno"]})
+    if filtri.get("data"):
+        q = apply_date_filter(q, Prestazione.data_inizio, filtri["data"])
+    if filtri.get("cliente_id"):
+        q = q.filter(Prestazione.cliente_id == filtri["cliente_id"])
+    if filtri.get("conto_ricavo_id"):
+        q = q.filter(Prestazione.conto_ricavo_id == filtri["conto_ricavo_id"])
+    if filtri.get("fatturante_id"):
+        q = q.filter(Prestazione.fatturante_id == filtri["fatturante_id"])
+    if filtri.get("periodicita"):
+        q = q.filter(Prestazione.periodicita == filtri["periodicita"])
+    if filtri.get("stato") == "Fatturato":
+        q = q.filter(Prestazione.fattura_id.isnot(None))
+    elif filtri.get("stato") == "Non fatturato":
+        q = q.filter(Prestazione.fattura_id.is_(None))
+    return q
+
+
+def metriche_prestazioni(session, filtri):
+    """
+    Totale / Fatturato / Non fatturato / Incassato / Residuo delle prestazioni
+    filtrate, calcolati in un'unica SELECT sui saldi memorizzati.
+    """
+    q = session.query(
+        func.count(Prestazione.id),
+        func.sum(Prestazione.totale),
+        func.sum(case((Prestazione.fattura_id.isnot(None), Prestazione.totale), else_=0)),
+        func.sum(Prestazione.totale_incassato_confermato),
+    )
+    n, tot, fat, inc = applica_filtri(q, filtri).one()
+
+    tot, fat, inc = (euro(centesimi(v)) for v in (tot, fat, inc))
+    return {"n": n, "totale": tot, "fatturato": fat, "non_fatturato": tot - fat,
+            "incassato": inc, "residuo": tot - inc}
+
+
+# Ordinamento stabile della tabella: la chiave keyset è (data_inizio, cliente_id, id)
+ORDINE = (Prestazione.data_inizio, Prestazione.cliente_id, Prestazione.id)
+
+
+def chiave_keyset(p):
+    return (p.data_inizio, p.cliente_id, p.id)
+
+
+def pagina_prestazioni(q, dopo=None, limite=100):
+    """
+    Una pagina della query ordinata per ORDINE, a partire dalla riga successiva
+    alla chiave `dopo` (None = prima pagina). Ritorna (righe, chiave_successiva);
+    la chiave è None sull'ultima pagina.
+    """
+    if dopo is not None:
+        q = q.filter(tuple_(*ORDINE) > tuple_(*dopo))
+    righe = q.order_by(*ORDINE).limit(limite + 1).all()
+    if len(righe) > limite:
+        righe = righe[:limite]
+        return righe, chiave_keyset(righe[-1])
+    return righe, None
+
+
+def ids_prestazioni(session, filtri, tra=None):
+    """Id delle prestazioni filtrate (solo la colonna id), opzionalmente ristretti a `tra`."""
+    q = applica_filtri(session.query(Prestazione.id), filtri)
+    if tra is not None:
+        q = q.filter(Prestazione.id.in_([int(i) for i in tra]))
+    return {r[0] for r in q}
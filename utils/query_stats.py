@@ -0,0 +1,134 @@
+"""
+Strumentazione delle query SQL per ogni rerun di pagina.
+
+Gli eventi `before/after_cursor_execute` dell'engine registrano ogni istruzione
+nel collettore del thread corrente (Streamlit esegue ogni rerun in un thread
+dedicato). A fine pagina `query_stats_panel()` chiude il rerun, scrive una riga
+JSON nel log e mostra il riepilogo nella sidebar agli admin.
+"""
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import event
+from config import QUERY_LOG_PATH, N_PLUS_ONE_SOGLIA
+
+_local = threading.local()
+_log_lock = threading.Lock()
+
+_WS_RE = re.compile(r"\s+")
+_IN_RE = re.compile(r"\bIN \((?:[^()]|\([^()]*\))*\)", re.IGNORECASE)
+_POSTCOMPILE_RE = re.compile(r"\(\[POSTCOMPILE_\w+\]\)")
+
+
+def normalize(statement):
+    """Forma canonica dell'istruzione: spazi compattati, liste IN collassate."""
+    s = _WS_RE.sub(" ", statement).strip()
+    s = _POSTCOMPILE_RE.sub("(...)", s)
+    return _IN_RE.sub("IN (...)", s)
+
+
+# =============================================
+# EVENTI ENGINE
+# =============================================
+def _before(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("_qs_start", []).append(time.perf_counter())
+
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("_qs_start")
+    if not starts:
+        return
+    elapsed = (time.perf_counter() - starts.pop()) * 1000
+    run = getattr(_local, "run", None)
+    if run is not None:
+        run["statements"].append((normalize(statement), elapsed))
+
+
+def install(engine):
+    """Registra gli eventi di misura sull'engine (una volta sola)."""
+    if not event.contains(engine, "before_cursor_execute", _before):
+        event.listen(engine, "before_cursor_execute", _before)
+        event.listen(engine, "after_cursor_execute", _after)
+
+
+# =============================================
+# RERUN
+# =============================================
+def begin_run(pagina):
+    """Apre il collettore per il rerun corrente del thread."""
+    _local.run = {"pagina": pagina, "inizio": time.perf_counter(),
+                  "ts": datetime.now(), "statements": []}
+
+
+def _report(run):
+    stmts = run["statements"]
+    per_pattern = defaultdict(lambda: [0, 0.0])
+    for sql, ms in stmts:
+        per_pattern[sql][0] += 1
+        per_pattern[sql][1] += ms
+    ripetute = sorted(((sql, n, round(ms, 1)) for sql, (n, ms) in per_pattern.items() if n > 1),
+                      key=lambda r: -r[1])
+    # N+1: stessa SELECT ripetuta molte volte nello stesso rerun
+    n_plus_one = [r for r in ripetute
+                  if r[1] >= N_PLUS_ONE_SOGLIA and r[0].upper().startswith("SELECT")]
+    slowest = sorted(stmts, key=lambda s: -s[1])[:5]
+    return {
+        "ts": run["ts"].isoformat(timespec="seconds"),
+        "pagina": run["pagina"],
+        "n_query": len(stmts),
+        "db_ms": round(sum(ms for _, ms in stmts), 1),
+        "pagina_ms": round((time.perf_counter() - run["inizio"]) * 1000, 1),
+        "pattern_distinti": len(per_pattern),
+        "piu_lente": [{"sql": sql[:300], "ms": round(ms, 1)} for sql, ms in slowest],
+        "ripetute": [{"sql": sql[:300], "n": n, "ms": ms} for sql, n, ms in ripetute[:10]],
+        "n_plus_one": [{"sql": sql[:300], "n": n, "ms": ms} for sql, n, ms in n_plus_one],
+    }
+
+
+def _write_log(report):
+    if not QUERY_LOG_PATH:
+        return
+    try:
+        os.makedirs(os.path.dirname(QUERY_LOG_PATH) or ".", exist_ok=True)
+        with _log_lock, open(QUERY_LOG_PATH, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(report, ensure_ascii=False) + "\n")
+    except OSError:
+        pass  # il log non deve mai bloccare la pagina
+
+
+def end_run(utente=None):
+    """Chiude il rerun corrente, scrive il log e ritorna il report (o None)."""
+    run = getattr(_local, "run", None)
+    if run is None:
+        return None
+    _local.run = None
+    report = _report(run)
+    report["utente"] = utente
+    _write_log(report)
+    return report
+
+
+def query_stats_panel():
+    """Chiude il rerun e, per gli admin, mostra il riepilogo query nella sidebar."""
+    import streamlit as st
+    report = end_run(st.session_state.get("username"))
+    if report is None or st.session_state.get("ruolo") != "admin":
+        return
+    with st.sidebar.expander(f"🛢️ Query: {report['n_query']} — {report['db_ms']} ms",
+                             expanded=bool(report["n_plus_one"])):
+        st.caption(f"Pagina {report['pagina_ms']} ms · "
+                   f"{report['pattern_distinti']} istruzioni distinte")
+        for r in report["n_plus_one"]:
+            st.warning(f"Possibile N+1: {r['n']}× ({r['ms']} ms)\n\n`{r['sql'][:160]}`")
+        if report["piu_lente"]:
+            st.markdown("**Più lente**")
+            for r in report["piu_lente"]:
+                st.caption(f"{r['ms']} ms — `{r['sql'][:120]}`")
+        if report["ripetute"]:
+            st.markdown("**Ripetute**")
+            for r in report["ripetute"]:
+                st.caption(f"{r['n']}× / {r['ms']} ms — `{r['sql'][:120]}`")
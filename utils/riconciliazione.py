@@ -0,0 +1,337 @@
+"""
+Riconciliazione degli estratti conto camt.053 con i crediti aperti.
+
+`leggi_camt053` legge l'estratto in streaming (iterparse, un movimento alla
+volta) e ritorna gli accrediti. `IndiceCrediti` carica con due query i crediti
+aperti, cioè le prestazioni con residuo raggruppate per fattura, e li indicizza
+per importo, numero fattura, P.IVA/CF/IBAN del cliente e parole del nome.
+`proponi_abbinamenti` valuta ogni movimento solo sulle partite trovate negli
+indici, in un'unica passata. Dopo la revisione, `registra_incassi` crea gli
+incassi confermati con una INSERT multi-riga, ricontrollando riferimenti e
+residui correnti: le proposte possono essere state calcolate molto prima.
+"""
+import re
+from collections import defaultdict
+from datetime import date, datetime
+from lxml import etree
+from sqlalchemy import select, insert
+from models import Prestazione, Fattura, Cliente, Incasso
+from utils.importi import centesimi, euro
+from utils.saldi import aggiorna_saldi
+
+# Punteggio degli indizi e soglia minima per proporre un abbinamento
+PUNTI_IMPORTO = 40
+PUNTI_FATTURA = 40
+PUNTI_CLIENTE = 30  # P.IVA, CF o IBAN del cliente nel movimento
+PUNTI_NOME = 20     # in proporzione alle parole del nome ritrovate
+SOGLIA = 50
+# Parole del nome presenti in più clienti di così non servono a distinguerli
+MAX_CLIENTI_PAROLA = 50
+
+_P = Prestazione.__table__
+_F = Fattura.__table__
+_C = Cliente.__table__
+
+_RE_FATTURA = re.compile(
+    r"\b(?:FATT\w*|FT|FAT|FATTURA)\.?\s*(?:N\.?|NR\.?|NUM\.?|N°)?\s*(\d{1,6})(?:\s*[/-]\s*(\d{4}))?"
+    r"|\b(\d{1,6})\s*/\s*(20\d\d)\b", re.IGNORECASE)
+_RE_CODICI = re.compile(r"\b(?:IT)?(\d{11})\b|\b([A-Z]{6}\d{2}[A-Z]\d{2}[A-Z]\d{3}[A-Z])\b")
+_PAROLE_VUOTE = {"SRL", "SRLS", "SPA", "SNC", "SAS", "SOC", "COOP", "STUDIO", "DOTT", "DOTTSSA",
+                 "AVV", "ING", "ARCH", "GEOM", "RAG", "PROF", "DEL", "DELLA", "DEI", "DEGLI",
+                 "PER", "CON", "BONIFICO", "FAVORE", "SALDO", "ACCONTO", "PAGAMENTO"}
+
+
+def _parole(testo):
+    parole = re.sub(r"[^A-Z0-9 ]", " ", (testo or "").upper()).split()
+    return {p for p in parole if len(p) >= 3 and p not in _PAROLE_VUOTE and not p.isdigit()}
+
+
+# =============================================
+# LETTURA camt.053
+# =============================================
+def _testo(el, percorso):
+    t = el.find("/".join(f"{{*}}{tag}" for tag in percorso.split("/")))
+    return t.text.strip() if t is not None and t.text else None
+
+
+def _data(el, percorso):
+    t = _testo(el, percorso + "/Dt") or (_testo(el, percorso + "/DtTm") or "")[:10]
+    return datetime.strptime(t, "%Y-%m-%d").date() if t else None
+
+
+def _causale(el):
+    parti = [t.text.strip() for t in el.iterfind("{*}RmtInf/{*}Ustrd") if t.text]
+    parti += [t.text.strip() for t in el.iterfind("{*}RmtInf/{*}Strd/{*}CdtrRefInf/{*}Ref") if t.text]
+    return " ".join(parti) or _testo(el, "AddtlTxInf") or ""
+
+
+def leggi_camt053(fonte):
+    """
+    Legge un estratto conto camt.053 (percorso o file binario) e yield un dict
+    per accredito: data, importo (centesimi), ordinante, iban, causale e
+    riferimento della banca. Addebiti e storni sono esclusi; un movimento con
+    più TxDtls produce un accredito per transazione.
+    """
+    try:
+        for _, ntry in etree.iterparse(fonte, events=("end",), tag="{*}Ntry",
+                                       no_network=True, resolve_entities=False):
+            if _testo(ntry, "CdtDbtInd") == "CRDT" and _testo(ntry, "RvslInd") != "true":
+                data = _data(ntry, "BookgDt") or _data(ntry, "ValDt") or date.today()
+                rif = _testo(ntry, "AcctSvcrRef") or _testo(ntry, "NtryRef")
+                dettagli = list(ntry.iterfind("{*}NtryDtls/{*}TxDtls"))
+                for k, tx in enumerate(dettagli or [ntry], 1):
+                    importo = (_testo(tx, "AmtDtls/TxAmt/Amt") or _testo(tx, "Amt")
+                               or _testo(ntry, "Amt"))
+                    tx_rif = _testo(tx, "Refs/AcctSvcrRef") or _testo(tx, "Refs/EndToEndId")
+                    if tx_rif in (None, "NOTPROVIDED"):
+                        tx_rif = f"{rif}/{k}" if rif and len(dettagli) > 1 else rif
+                    yield {
+                        "data": data,
+                        "importo": centesimi(importo),
+                        "ordinante": _testo(tx, "RltdPties/Dbtr/Nm") or "",
+                        "iban": _testo(tx, "RltdPties/DbtrAcct/Id/IBAN") or "",
+                        "causale": _causale(tx) or _testo(ntry, "AddtlNtryInf") or "",
+                        "riferimento": tx_rif,
+                    }
+            ntry.clear()
+            while ntry.getprevious() is not None:
+                del ntry.getparent()[0]
+    except etree.XMLSyntaxError as e:
+        raise ValueError(f"Estratto conto non leggibile: {e}") from e
+
+
+# =============================================
+# INDICE DEI CREDITI APERTI
+# =============================================
+class IndiceCrediti:
+    """
+    Crediti aperti indicizzati per la ricerca. Una partita è una fattura (o una
+    prestazione non fatturata) con residuo: dict con chiave, cliente_id,
+    cliente, fattura_id, numero, anno, descrizione, residuo (centesimi) e
+    righe [(prestazione_id, residuo), ...].
+    """
+
+    def __init__(self, session):
+        self.partite = {}
+        righe = session.execute(
+            select(_P.c.id, _P.c.cliente_id, _P.c.fattura_id, _P.c.descrizione,
+                   _P.c.credito_residuo, _F.c.numero, _F.c.anno)
+            .select_from(_P.outerjoin(_F, _F.c.id == _P.c.fattura_id))
+            .where(_P.c.credito_residuo > 0).order_by(_P.c.id))
+        for r in righe:
+            chiave = ("F", r.fattura_id) if r.fattura_id else ("P", r.id)
+            p = self.partite.get(chiave)
+            if p is None:
+                p = self.partite[chiave] = {
+                    "chiave": chiave, "cliente_id": r.cliente_id, "cliente": "",
+                    "fattura_id": r.fattura_id, "numero": r.numero, "anno": r.anno,
+                    "descrizione": f"Fatt. {r.numero}/{r.anno}" if r.fattura_id else r.descrizione,
+                    "residuo": 0, "righe": []}
+            residuo = centesimi(r.credito_residuo)
+            p["residuo"] += residuo
+            p["righe"].append((r.id, residuo))
+
+        self.per_importo = defaultdict(list)
+        self.per_fattura = defaultdict(list)
+        self.per_cliente = defaultdict(list)
+        for p in self.partite.values():
+            self.per_importo[p["residuo"]].append(p["chiave"])
+            self.per_cliente[p["cliente_id"]].append(p["chiave"])
+            if p["fattura_id"]:
+                self.per_fattura[(p["numero"], None)].append(p["chiave"])
+                self.per_fattura[(p["numero"], p["anno"])].append(p["chiave"])
+
+        self.per_codice = {}
+        self.per_parola = defaultdict(set)
+        self.parole_cliente = {}
+        clienti = session.execute(
+            select(_C.c.id, _C.c.cognome_ragione_sociale, _C.c.nome, _C.c.partita_iva,
+                   _C.c.codice_fiscale, _C.c.iban_sdd)
+            .where(_C.c.id.in_(select(_P.c.cliente_id).where(_P.c.credito_residuo > 0))))
+        nomi = {}
+        for c in clienti:
+            nomi[c.id] = " ".join(x for x in (c.cognome_ragione_sociale, c.nome) if x)
+            for codice in (c.partita_iva, c.codice_fiscale, c.iban_sdd):
+                codice = (codice or "").replace(" ", "").upper()
+                if codice:
+                    self.per_codice[codice] = c.id
+            parole = _parole(nomi[c.id])
+            self.parole_cliente[c.id] = parole
+            for w in parole:
+                self.per_parola[w].add(c.id)
+        for p in self.partite.values():
+            p["cliente"] = nomi.get(p["cliente_id"], "")
+
+    def _clienti_da_codici(self, mov):
+        testo = f"{mov['causale']} {mov['ordinante']}".upper()
+        codici = {mov["iban"].replace(" ", "").upper()} if mov["iban"] else set()
+        for piva, cf in _RE_CODICI.findall(testo):
+            codici.add(piva or cf)
+        return {self.per_codice[c] for c in codici if c in self.per_codice}
+
+    def _clienti_da_nome(self, mov):
+        parole = _parole(mov["ordinante"]) or _parole(mov["causale"])
+        trovati = defaultdict(int)
+        for w in parole:
+            clienti = self.per_parola.get(w, ())
+            if len(clienti) <= MAX_CLIENTI_PAROLA:
+                for cid in clienti:
+                    trovati[cid] += 1
+        return {cid: n / len(self.parole_cliente[cid]) for cid, n in trovati.items()}
+
+    def _fatture_citate(self, mov):
+        citate = set()
+        for num, anno, num2, anno2 in _RE_FATTURA.findall(mov["causale"]):
+            numero, anno = int(num or num2), int(anno or anno2) if (anno or anno2) else None
+            citate.update(self.per_fattura.get((numero, anno), ()))
+        return citate
+
+    def candidati(self, mov):
+        """[(punteggio, chiave), ...] delle partite compatibili, dal più alto."""
+        per_importo = set(self.per_importo.get(mov["importo"], ()))
+        citate = self._fatture_citate(mov)
+        da_codici = self._clienti_da_codici(mov)
+        da_nome = self._clienti_da_nome(mov)
+        chiavi = per_importo | citate
+        for cid in da_codici | set(da_nome):
+            chiavi.update(self.per_cliente.get(cid, ()))
+        punteggi = []
+        for k in chiavi:
+            cid = self.partite[k]["cliente_id"]
+            punti = ((PUNTI_IMPORTO if k in per_importo else 0)
+                     + (PUNTI_FATTURA if k in citate else 0)
+                     + (PUNTI_CLIENTE if cid in da_codici else 0)
+                     + round(PUNTI_NOME * min(da_nome.get(cid, 0), 1)))
+            punteggi.append((punti, k))
+        punteggi.sort(key=lambda x: (-x[0], x[1]))
+        return punteggi
+
+
+# =============================================
+# ABBINAMENTO
+# =============================================
+def _ripartisci(partita, cent):
+    """Importo sulle righe della partita in ordine; ritorna (righe, eccedenza)."""
+    righe = []
+    for pid, residuo in partita["righe"]:
+        if cent <= 0:
+            break
+        quota = min(cent, residuo)
+        righe.append((pid, quota))
+        cent -= quota
+    return righe, cent
+
+
+def _rif(mov):
+    """Riferimento del movimento come salvato su Incasso.riferimento."""
+    return (mov["riferimento"] or "")[:100]
+
+
+def _registrati(session, riferimenti):
+    """Riferimenti (non vuoti) già presenti sugli incassi."""
+    rif = sorted({r for r in riferimenti if r})
+    registrati = set()
+    for i in range(0, len(rif), 1000):
+        registrati.update(session.execute(
+            select(Incasso.riferimento).where(Incasso.riferimento.in_(rif[i:i + 1000]))).scalars())
+    return registrati
+
+
+def proponi_abbinamenti(session, movimenti, indice=None):
+    """
+    Propone una partita per ogni movimento. Ritorna un dict per movimento con
+    stato ("proposto", "ambiguo", "nessuno", "già registrato"), partita,
+    punteggio, ripartizione [(prestazione_id, centesimi)], eccedenza e fino a
+    tre alternative. Ogni partita si assegna al più a un movimento, partendo
+    dai punteggi più alti.
+    """
+    movimenti = list(movimenti)
+    indice = indice or IndiceCrediti(session)
+    registrati = _registrati(session, [_rif(m) for m in movimenti])
+
+    proposte, coda = [], []
+    for i, mov in enumerate(movimenti):
+        proposta = {"movimento": mov, "stato": "nessuno", "partita": None, "punteggio": 0,
+                    "ripartizione": [], "eccedenza": mov["importo"], "alternative": []}
+        proposte.append(proposta)
+        if _rif(mov) in registrati:
+            proposta["stato"] = "già registrato"
+            continue
+        cand = indice.candidati(mov)
+        proposta["alternative"] = [indice.partite[k] for _, k in cand[:4]]
+        if cand and cand[0][0] >= SOGLIA:
+            if len(cand) > 1 and cand[1][0] == cand[0][0]:
+                proposta["stato"], proposta["punteggio"] = "ambiguo", cand[0][0]
+            else:
+                coda.extend((punti, i, k) for punti, k in cand if punti >= SOGLIA)
+
+    usate = set()
+    for punti, i, k in sorted(coda, key=lambda x: (-x[0], x[1])):
+        proposta = proposte[i]
+        if proposta["partita"] is not None or k in usate:
+            continue
+        usate.add(k)
+        partita = indice.partite[k]
+        proposta.update(stato="proposto", partita=partita, punteggio=punti)
+        proposta["ripartizione"], proposta["eccedenza"] = _ripartisci(
+            partita, proposta["movimento"]["importo"])
+    for proposta in proposte:
+        if proposta["partita"] is not None:
+            proposta["alternative"] = [p for p in proposta["alternative"]
+                                       if p["chiave"] != proposta["partita"]["chiave"]][:3]
+        else:
+            proposta["alternative"] = proposta["alternative"][:3]
+    return proposte
+
+
+def scegli_partita(proposta, partita):
+    """Copia della proposta abbinata a `partita` (es. un'alternativa di un movimento ambiguo)."""
+    ripartizione, eccedenza = _ripartisci(partita, proposta["movimento"]["importo"])
+    return dict(proposta, stato="scelto", partita=partita, ripartizione=ripartizione,
+                eccedenza=eccedenza)
+
+
+def registra_incassi(session, proposte, modalita="Bonifico"):
+    """
+    Crea gli incassi confermati delle proposte con partita (una INSERT
+    multi-riga) e ricalcola i saldi delle prestazioni coinvolte. Il commit è a
+    carico del chiamante. Al momento della registrazione salta i movimenti il
+    cui riferimento è già su un incasso (stesso estratto registrato da un'altra
+    sessione) e limita ogni quota al residuo attuale della prestazione (incassi
+    registrati dopo la proposta). Ritorna {"creati", "gia_registrati",
+    "non_allocato"} (centesimi rimasti fuori per residuo insufficiente).
+    """
+    esito = {"creati": 0, "gia_registrati": 0, "non_allocato": 0}
+    proposte = [p for p in proposte if p["ripartizione"]]
+    pids = sorted({pid for p in proposte for pid, _ in p["ripartizione"]})
+    # Righe bloccate fino al commit (PostgreSQL): due registrazioni concorrenti si serializzano
+    residui = {}
+    for i in range(0, len(pids), 1000):
+        residui.update((pid, centesimi(r)) for pid, r in session.execute(
+            select(_P.c.id, _P.c.credito_residuo).where(_P.c.id.in_(pids[i:i + 1000])).with_for_update()))
+    registrati = _registrati(session, [_rif(p["movimento"]) for p in proposte])
+
+    ora = datetime.utcnow()
+    righe = []
+    for proposta in proposte:
+        mov = proposta["movimento"]
+        rif = _rif(mov)
+        if rif in registrati:
+            esito["gia_registrati"] += 1
+            continue
+        if rif:
+            registrati.add(rif)
+        for pid, cent in proposta["ripartizione"]:
+            quota = min(cent, max(residui.get(pid, 0), 0))
+            esito["non_allocato"] += cent - quota
+            if quota <= 0:
+                continue
+            residui[pid] -= quota
+            righe.append({"prestazione_id": pid, "importo": euro(quota), "data": mov["data"],
+                          "stato": "Confermato", "modalita": modalita, "riferimento": rif,
+                          "note": mov["causale"], "created_at": ora})
+    if righe:
+        session.execute(insert(Incasso), righe)
+        aggiorna_saldi(session, {r["prestazione_id"] for r in righe})
+    esito["creati"] = len(righe)
+    return esito
@@ -0,0 +1,185 @@
+"""
+Saldi memorizzati sulle prestazioni: totale, incassato confermato e residuo.
+
+`totale` viene ricalcolato prima del flush dagli importi della prestazione;
+incassato e residuo vengono aggiornati con un'unica UPDATE insiemistica dopo
+il flush per le prestazioni i cui incassi sono stati inseriti, modificati o
+eliminati (anche con UPDATE/DELETE massivi ORM). `riconcilia` ricalcola tutto
+da zero e segnala le differenze.
+"""
+from decimal import Decimal
+from sqlalchemy import event, select, func, or_
+from sqlalchemy.orm import attributes
+from models import Prestazione, Incasso
+from utils import importi
+
+STATO_CONFERMATO = "Confermato"
+_SALDI = ("totale_incassato_confermato", "credito_residuo")
+
+
+def calcola_totale(importo, aliquota):
+    """Importo + IVA arrotondato al centesimo (regola di utils/importi.py)."""
+    return importi.euro(importi.totale(importi.centesimi(importo), aliquota))
+
+
+# =============================================
+# ESPRESSIONI SQL
+# =============================================
+_P = Prestazione.__table__
+_I = Incasso.__table__
+
+
+def _incassato_sql():
+    return select(func.coalesce(func.sum(_I.c.importo), 0)).where(
+        _I.c.prestazione_id == _P.c.id, _I.c.stato == STATO_CONFERMATO
+    ).scalar_subquery()
+
+
+def _totale_sql():
+    return importi.totale_sql(_P.c.importo_unitario, _P.c.aliquota_iva)
+
+
+def ricalcola_saldi(conn, ids=None, totale=False):
+    """
+    Ricalcola incassato e residuo (e, con totale=True, anche il totale) per le
+    prestazioni `ids`, o per tutte se ids è None. Ritorna le righe aggiornate.
+    """
+    tot = _totale_sql() if totale else _P.c.totale
+    # updated_at resta invariato: il ricalcolo dei saldi non è una modifica dell'utente
+    values = {"totale_incassato_confermato": _incassato_sql(),
+              "credito_residuo": tot - _incassato_sql(),
+              "updated_at": _P.c.updated_at}
+    if totale:
+        values["totale"] = tot
+    stmt = _P.update().values(**values)
+    if ids is not None:
+        ids = sorted({int(i) for i in ids})
+        if not ids:
+            return 0
+        stmt = stmt.where(_P.c.id.in_(ids))
+    return conn.execute(stmt).rowcount
+
+
+def aggiorna_saldi(session, ids):
+    """
+    Ricalcola incassato e residuo delle prestazioni `ids` dopo scritture che
+    non passano dagli eventi della sessione (es. INSERT multi-riga) e fa
+    scadere i saldi delle prestazioni già caricate nella sessione.
+    """
+    ids = set(ids)
+    if not ids:
+        return 0
+    n = ricalcola_saldi(session.connection(), ids)
+    for obj in session.identity_map.values():
+        if isinstance(obj, Prestazione) and obj.id in ids:
+            session.expire(obj, _SALDI)
+    return n
+
+
+def drift(conn):
+    """Prestazioni con saldi memorizzati diversi da quelli ricalcolati."""
+    inc = _incassato_sql()
+    tot = _totale_sql()
+
+    def diverso(a, b):
+        return func.abs(func.coalesce(a, 0) - b) >= 0.005
+
+    stmt = select(_P.c.id, _P.c.totale, tot.label("totale_atteso"),
+                  _P.c.totale_incassato_confermato, inc.label("incassato_atteso"),
+                  _P.c.credito_residuo, (tot - inc).label("residuo_atteso")).where(or_(
+        diverso(_P.c.totale, tot),
+        diverso(_P.c.totale_incassato_confermato, inc),
+        diverso(_P.c.credito_residuo, tot - inc),
+    )).order_by(_P.c.id)
+    return conn.execute(stmt).fetchall()
+
+
+def riconcilia(conn, fix=False):
+    """Ritorna le righe in disaccordo; con fix=True le riallinea."""
+    righe = drift(conn)
+    if fix and righe:
+        ricalcola_saldi(conn, [r.id for r in righe], totale=True)
+    return righe
+
+
+# =============================================
+# EVENTI SESSIONE
+# =============================================
+def _pid_incasso(inc):
+    """Id prestazione attuale e precedente di un incasso (se spostato)."""
+    ids = set()
+    hist = attributes.get_history(inc, "prestazione_id")
+    for v in (*hist.added, *hist.unchanged, *hist.deleted):
+        if v is not None:
+            ids.add(v)
+    prest = inc.__dict__.get("prestazione")  # solo se già in memoria, senza lazy load
+    if prest is not None and prest.id is not None:
+        ids.add(prest.id)
+    return ids
+
+
+def _before_flush(session, flush_context, instances):
+    pendenti = session.info.setdefault("_saldi_pendenti", [])
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, Prestazione):
+            tot = calcola_totale(obj.importo_unitario, obj.aliquota_iva)
+            if obj in session.new:
+                obj.totale = tot
+                obj.totale_incassato_confermato = Decimal("0")
+                obj.credito_residuo = tot
+            elif obj.totale != tot:
+                obj.totale = tot
+                pendenti.append(obj)
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Incasso):
+            pendenti.append(obj)
+
+
+def _after_flush(session, flush_context):
+    pendenti = session.info.pop("_saldi_pendenti", None)
+    if not pendenti:
+        return
+    ids = set()
+    for obj in pendenti:
+        if isinstance(obj, Prestazione):
+            ids.add(obj.id)
+        else:
+            ids |= _pid_incasso(obj)
+    ids.discard(None)
+    if ids:
+        ricalcola_saldi(session.connection(), ids)
+        session.info.setdefault("_saldi_da_scadere", set()).update(ids)
+
+
+def _after_flush_postexec(session, flush_context):
+    ids = session.info.pop("_saldi_da_scadere", None)
+    if not ids:
+        return
+    for obj in session.identity_map.values():
+        if isinstance(obj, Prestazione) and obj.id in ids:
+            session.expire(obj, _SALDI)
+
+
+def _do_orm_execute(state):
+    """UPDATE/DELETE massivi su Incasso: ricalcolo delle prestazioni coinvolte."""
+    if not (state.is_update or state.is_delete):
+        return None
+    if not any(m.class_ is Incasso for m in state.all_mappers):
+        return None
+    where = state.statement.whereclause
+    sel = select(_I.c.prestazione_id).distinct()
+    if where is not None:
+        sel = sel.where(where)
+    ids = set(state.session.connection().execute(sel).scalars())
+    result = state.invoke_statement()
+    aggiorna_saldi(state.session, ids)
+    return result
+
+
+def install(session_factory):
+    """Registra gli eventi di mantenimento dei saldi sulla factory delle sessioni."""
+    if not event.contains(session_factory, "before_flush", _before_flush):
+        event.listen(session_factory, "before_flush", _before_flush)
+        event.listen(session_factory, "after_flush", _after_flush)
+        event.listen(session_factory, "after_flush_postexec", _after_flush_postexec)
+        event.listen(session_factory, "do_orm_execute", _do_orm_execute)
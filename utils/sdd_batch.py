@@ -0,0 +1,148 @@
+"""
+Tracciati SDD archiviati e idempotenti.
+
+Ogni generazione è un SddBatch con chiave sha256 di fatturante, data di
+addebito e addebiti (prestazione, importo). Se esiste già un batch
+attivo con la stessa chiave, `crea_batch` lo ritorna senza scrivere nulla:
+nessun incasso duplicato se il download va perso o il pulsante viene premuto
+due volte. MsgId, PmtInfId ed EndToEndId derivano dall'id del batch, i file
+restano nel database e si riscaricano senza rigenerarli. Un batch annullato
+elimina i suoi incassi ancora da confermare.
+
+La chiave copre solo richieste identiche: una prestazione che ha già un
+incasso da confermare in un batch attivo non entra in un altro batch, qualunque
+sia la data o il resto della selezione. L'indice unico parziale su (chiave)
+dei batch attivi blocca i doppi click concorrenti.
+"""
+import hashlib
+import io
+import json
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from models import SddBatch, SddBatchFile, Incasso, Prestazione
+from utils.importi import centesimi, euro
+from utils.sdd_sepa_xml import pianifica_sdd, scrivi_sdd
+from utils.validazione_xml import valida, XMLNonValido
+
+STATO_ATTIVO = "Generato"
+STATO_ANNULLATO = "Annullato"
+STATO_INCASSO = "Caricato da confermare"
+
+
+def chiave_batch(fatturante_id, data_addebito, incassi_list):
+    """
+    sha256 dei dati che identificano una generazione (ordine degli addebiti
+    irrilevante). Il tipo sequenza non entra nella chiave: dopo il primo batch
+    un cliente passa da FRST a RCUR e la stessa richiesta cambierebbe chiave.
+    """
+    addebiti = sorted((i["prestazione"].id, centesimi(i["importo"])) for i in incassi_list)
+    dati = [fatturante_id, data_addebito.isoformat(), addebiti]
+    return hashlib.sha256(json.dumps(dati).encode()).hexdigest()
+
+
+def batch_attivo(session, chiave):
+    return (session.query(SddBatch)
+            .filter(SddBatch.chiave == chiave, SddBatch.stato == STATO_ATTIVO)
+            .order_by(SddBatch.id.desc()).first())
+
+
+def addebiti_in_sospeso(session, prestazione_ids):
+    """{prestazione_id: batch_id} delle prestazioni con un incasso da confermare in un batch attivo."""
+    ids = list({int(i) for i in prestazione_ids})
+    if not ids:
+        return {}
+    return dict(session.query(Incasso.prestazione_id, Incasso.sdd_batch_id).join(SddBatch)
+                .filter(Incasso.prestazione_id.in_(ids), Incasso.stato == STATO_INCASSO,
+                        SddBatch.stato == STATO_ATTIVO))
+
+
+class AddebitiInSospeso(ValueError):
+    """Prestazioni già presenti, da confermare, in un altro batch attivo."""
+
+    def __init__(self, sospesi):
+        self.sospesi = sospesi
+        batch = ", ".join(f"#{b}" for b in sorted(set(sospesi.values())))
+        super().__init__(f"{len(sospesi)} prestazioni hanno già un addebito da confermare "
+                         f"nei tracciati {batch}")
+
+
+def crea_batch(session, fatturante, incassi_list, data_addebito, max_transazioni=None, max_importo=None):
+    """
+    Genera, valida e archivia i tracciati degli incassi e registra gli Incasso
+    "Caricato da confermare" collegati al batch (commit a carico del chiamante).
+    Ritorna (batch, creato): creato è False se il batch esisteva già.
+    Solleva AddebitiInSospeso se qualche prestazione è già in un altro batch
+    attivo da confermare, XMLNonValido se un file non supera l'XSD: il batch è
+    già nel flush, il chiamante deve fare rollback.
+    """
+    chiave = chiave_batch(fatturante.id, data_addebito, incassi_list)
+    esistente = batch_attivo(session, chiave)
+    if esistente is not None:
+        return esistente, False
+
+    ids = [i["prestazione"].id for i in incassi_list]
+    # Su PostgreSQL serializza le richieste concorrenti sulle stesse prestazioni
+    session.query(Prestazione.id).filter(Prestazione.id.in_(ids)).with_for_update().all()
+    sospesi = addebiti_in_sospeso(session, ids)
+    if sospesi:
+        raise AddebitiInSospeso(sospesi)
+
+    batch = SddBatch(chiave=chiave, fatturante_id=fatturante.id, data_addebito=data_addebito,
+                     stato=STATO_ATTIVO, n_transazioni=len(incassi_list),
+                     totale=euro(sum(centesimi(i["importo"]) for i in incassi_list)))
+    try:
+        with session.begin_nested():
+            session.add(batch)
+            session.flush()
+    except IntegrityError:
+        # Stessa chiave appena registrata da un'altra sessione
+        return batch_attivo(session, chiave), False
+
+    # Identificativi stabili per batch: rigenerare lo stesso batch produce gli stessi id
+    incassi_list = [dict(i, end_to_end_id=f"SDD{batch.id:06d}-{k:05d}")
+                    for k, i in enumerate(incassi_list, 1)]
+    files = pianifica_sdd(incassi_list, data_addebito, max_transazioni, max_importo)
+    for n, blocchi in enumerate(files, 1):
+        msg_id = f"SDD{batch.id:06d}-{n:02d}"
+        pmt_ids = [f"{msg_id}-{j:02d}" for j in range(1, len(blocchi) + 1)]
+        buf = io.BytesIO()
+        scrivi_sdd(buf, fatturante, blocchi, msg_id, pmt_ids)
+        contenuto = buf.getvalue()
+        suffisso = f"_{n:02d}" if len(files) > 1 else ""
+        filename = f"SDD_{blocchi[0][0].isoformat()}_{batch.id:06d}{suffisso}.xml"
+        errori = valida(contenuto, "pain.008")
+        if errori:
+            raise XMLNonValido(filename, errori)
+        batch.files.append(SddBatchFile(
+            progressivo=n, msg_id=msg_id, pmt_inf_ids=",".join(pmt_ids), filename=filename,
+            sha256=hashlib.sha256(contenuto).hexdigest(), contenuto=contenuto))
+
+    session.add_all(Incasso(
+        prestazione_id=i["prestazione"].id, importo=euro(centesimi(i["importo"])),
+        data=i.get("data") or data_addebito, stato=STATO_INCASSO, modalita="SDD SEPA",
+        end_to_end_id=i["end_to_end_id"], sdd_batch=batch) for i in incassi_list)
+    return batch, True
+
+
+def file_batch(session, batch_id):
+    """[(contenuto, filename), ...] dei file archiviati del batch, in ordine."""
+    return [(f.contenuto, f.filename) for f in session.query(SddBatchFile)
+            .filter(SddBatchFile.batch_id == batch_id).order_by(SddBatchFile.progressivo)]
+
+
+def annulla_batch(session, batch):
+    """
+    Annulla il batch ed elimina i suoi incassi. Solleva ValueError se qualche
+    incasso ha già un esito (Confermato o Insoluto): il tracciato è stato
+    elaborato dalla banca. Commit a carico del chiamante.
+    """
+    if batch.stato == STATO_ANNULLATO:
+        return 0
+    con_esito = (session.query(Incasso)
+                 .filter(Incasso.sdd_batch_id == batch.id, Incasso.stato != STATO_INCASSO).count())
+    if con_esito:
+        raise ValueError(f"{con_esito} incassi del tracciato hanno già un esito: annullamento non possibile")
+    eliminati = (session.query(Incasso).filter(Incasso.sdd_batch_id == batch.id)
+                 .delete(synchronize_session=False))
+    batch.stato, batch.annullato_il = STATO_ANNULLATO, datetime.utcnow()
+    return eliminati
@@ -1,13 +1,21 @@
-"""Generazione XML SDD SEPA — Standard ISO 20022 pain.008.001.02"""
+"""
+Generazione XML SDD SEPA — Standard ISO 20022 pain.008.001.02
+
+Gli incassi si raggruppano per data di addebito e tipo sequenza (FRST, RCUR,
+FNAL, OOFF), un PmtInf per gruppo; i file si scrivono in streaming con
+etree.xmlfile, una transazione alla volta, e si possono dividere per numero di
+transazioni o somma di controllo (SDD_MAX_TRANSAZIONI, SDD_MAX_IMPORTO).
+"""
 from lxml import etree
 from datetime import date, datetime
-from decimal import Decimal, ROUND_HALF_UP
+import io
 import uuid
+from config import SDD_MAX_TRANSAZIONI, SDD_MAX_IMPORTO
+from utils.importi import centesimi, euro
+from utils.validazione_sdd import identificativo_creditore, normalizza_iban
 
 NS = "urn:iso:std:iso:20022:tech:xsd:pain.008.001.02"
-
-def _r2(val):
-    return Decimal(str(val)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+SEQ_TIPI = ("FRST", "RCUR", "FNAL", "OOFF")
 
 def _el(parent, tag, text=None):
     e = etree.SubElement(parent, tag)
@@ -15,61 +23,162 @@ def _el(parent, tag, text=None):
     return e
 
 
-def genera_sdd_xml(fatturante, incassi_list, data_esecuzione=None):
-    if data_esecuzione is None:
-        data_esecuzione = date.today()
+def _id(prefisso):
+    return f"{prefisso}-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8].upper()}"
+
 
-    msg_id = f"MSG-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8].upper()}"
-    pmt_id = f"PMT-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8].upper()}"
+def nuovo_end_to_end_id():
+    """EndToEndId per una transazione, da salvare sull'incasso per gli esiti."""
+    return f"E2E-{uuid.uuid4().hex[:12].upper()}"
 
-    root = etree.Element("Document", nsmap={None: NS})
-    cstmr = _el(root, "CstmrDrctDbtInitn")
 
-    gh = _el(cstmr, "GrpHdr")
+# =============================================
+# PIANIFICAZIONE
+# =============================================
+def pianifica_sdd(incassi_list, data_esecuzione=None, max_transazioni=None, max_importo=None):
+    """
+    Divide gli incassi in file e blocchi PmtInf. Ogni incasso può indicare
+    "data" (default data_esecuzione) e "seq_tipo" (default RCUR). Un file non
+    supera max_transazioni né max_importo (euro; 0/None = nessun limite): un
+    gruppo che non ci sta prosegue nel file successivo.
+    Ritorna [[(data, seq_tipo, [incassi]), ...], ...], un elenco per file.
+    """
+    data_esecuzione = data_esecuzione or date.today()
+    max_transazioni = SDD_MAX_TRANSAZIONI if max_transazioni is None else max_transazioni
+    max_cent = centesimi(SDD_MAX_IMPORTO if max_importo is None else max_importo)
+
+    gruppi = {}
+    for inc in incassi_list:
+        seq = inc.get("seq_tipo") or "RCUR"
+        if seq not in SEQ_TIPI:
+            raise ValueError(f"Tipo sequenza SDD non valido: {seq}")
+        gruppi.setdefault((inc.get("data") or data_esecuzione, seq), []).append(inc)
+
+    files, blocchi, n, cent = [], [], 0, 0
+    for (data, seq) in sorted(gruppi, key=lambda k: (k[0], SEQ_TIPI.index(k[1]))):
+        blocco = []
+        for inc in gruppi[(data, seq)]:
+            c = centesimi(inc["importo"])
+            if n and ((max_transazioni and n + 1 > max_transazioni) or (max_cent and cent + c > max_cent)):
+                if blocco:
+                    blocchi.append((data, seq, blocco))
+                files.append(blocchi)
+                blocchi, blocco, n, cent = [], [], 0, 0
+            blocco.append(inc)
+            n += 1
+            cent += c
+        blocchi.append((data, seq, blocco))
+    if blocchi:
+        files.append(blocchi)
+    return files
+
+
+# =============================================
+# SCRITTURA
+# =============================================
+def _group_header(fatturante, n, ctrl, msg_id):
+    gh = etree.Element("GrpHdr")
     _el(gh, "MsgId", msg_id)
     _el(gh, "CreDtTm", datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"))
-    _el(gh, "NbOfTxs", str(len(incassi_list)))
-    ctrl = sum(_r2(i["importo"]) for i in incassi_list)
+    _el(gh, "NbOfTxs", str(n))
     _el(gh, "CtrlSum", str(ctrl))
     ip = _el(gh, "InitgPty"); _el(ip, "Nm", fatturante.ragione_sociale[:70])
+    return gh
+
 
-    pi = _el(cstmr, "PmtInf")
+def _pmt_inf_testata(fatturante, data, seq, n, ctrl, pmt_id):
+    """Elementi di PmtInf che precedono le transazioni, nell'ordine dello schema."""
+    pi = etree.Element("PmtInf")
     _el(pi, "PmtInfId", pmt_id); _el(pi, "PmtMtd", "DD"); _el(pi, "BtchBookg", "true")
-    _el(pi, "NbOfTxs", str(len(incassi_list))); _el(pi, "CtrlSum", str(ctrl))
+    _el(pi, "NbOfTxs", str(n)); _el(pi, "CtrlSum", str(ctrl))
 
     pti = _el(pi, "PmtTpInf")
     sl = _el(pti, "SvcLvl"); _el(sl, "Cd", "SEPA")
     li = _el(pti, "LclInstrm"); _el(li, "Cd", "CORE")
-    _el(pti, "SeqTp", "RCUR")
-    _el(pi, "ReqdColltnDt", data_esecuzione.isoformat())
+    _el(pti, "SeqTp", seq)
+    _el(pi, "ReqdColltnDt", data.isoformat())
 
     cdtr = _el(pi, "Cdtr"); _el(cdtr, "Nm", fatturante.ragione_sociale[:70])
     ca = _el(pi, "CdtrAcct"); caid = _el(ca, "Id")
-    _el(caid, "IBAN", fatturante.iban.replace(" ", ""))
+    _el(caid, "IBAN", normalizza_iban(fatturante.iban))
     cag = _el(pi, "CdtrAgt"); fi = _el(cag, "FinInstnId"); _el(fi, "BIC", "NOTPROVIDED")
 
     csi = _el(pi, "CdtrSchmeId"); csid = _el(csi, "Id")
     pv = _el(csid, "PrvtId"); ot = _el(pv, "Othr")
-    _el(ot, "Id", f"IT{fatturante.codice_fiscale}ZZZ")
+    _el(ot, "Id", identificativo_creditore(fatturante.codice_fiscale))
     sn = _el(ot, "SchmeNm"); _el(sn, "Prtry", "SEPA")
+    return list(pi)
+
+
+def _transazione(inc):
+    cl = inc["cliente"]
+    importo = euro(centesimi(inc["importo"]))
+    e2e = inc.get("end_to_end_id") or nuovo_end_to_end_id()
+
+    dd = etree.Element("DrctDbtTxInf")
+    pid = _el(dd, "PmtId"); _el(pid, "EndToEndId", e2e[:35])
+    amt = _el(dd, "InstdAmt", str(importo)); amt.set("Ccy", "EUR")
+
+    ddt = _el(dd, "DrctDbtTx"); mri = _el(ddt, "MndtRltdInf")
+    _el(mri, "MndtId", cl.rif_mandato_sdd or f"MAND-{cl.id}")
+    _el(mri, "DtOfSgntr",
+        cl.data_mandato_sdd.isoformat() if cl.data_mandato_sdd else date.today().isoformat())
+
+    dag = _el(dd, "DbtrAgt"); dfi = _el(dag, "FinInstnId"); _el(dfi, "BIC", "NOTPROVIDED")
+    dbtr = _el(dd, "Dbtr"); _el(dbtr, "Nm", cl.denominazione[:70])
+    da = _el(dd, "DbtrAcct"); dai = _el(da, "Id"); _el(dai, "IBAN", normalizza_iban(cl.iban_sdd))
+    ri = _el(dd, "RmtInf"); _el(ri, "Ustrd", inc.get("prestazione_descrizione", "Pagamento")[:140])
+    return dd
+
+
+def _somma(incassi):
+    return euro(sum(centesimi(i["importo"]) for i in incassi))
+
+
+def scrivi_sdd(out, fatturante, blocchi, msg_id=None, pmt_inf_ids=None):
+    """
+    Scrive un file pain.008 con i blocchi [(data, seq_tipo, [incassi]), ...] su
+    `out` (percorso o file binario). Gli elementi si serializzano uno alla
+    volta: la memoria non cresce con il numero di transazioni. MsgId e PmtInfId
+    si generano se non indicati.
+    """
+    msg_id = msg_id or _id("MSG")
+    pmt_inf_ids = pmt_inf_ids or [_id("PMT") for _ in blocchi]
+    n = sum(len(b[2]) for b in blocchi)
+    ctrl = euro(sum(centesimi(i["importo"]) for b in blocchi for i in b[2]))
+    # I figli senza namespace ereditano il namespace di default di Document
+    with etree.xmlfile(out, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        with xf.element("Document", nsmap={None: NS}):
+            with xf.element("CstmrDrctDbtInitn"):
+                xf.write(_group_header(fatturante, n, ctrl, msg_id), pretty_print=True)
+                for (data, seq, incassi), pmt_id in zip(blocchi, pmt_inf_ids):
+                    with xf.element("PmtInf"):
+                        for e in _pmt_inf_testata(fatturante, data, seq, len(incassi), _somma(incassi), pmt_id):
+                            xf.write(e, pretty_print=True)
+                        for inc in incassi:
+                            xf.write(_transazione(inc), pretty_print=True)
+
+
+def genera_sdd_files(fatturante, incassi_list, data_esecuzione=None,
+                     max_transazioni=None, max_importo=None):
+    """
+    Genera i tracciati pain.008 per gli incassi, divisi come da pianifica_sdd().
+    Yield (xml_bytes, filename, blocchi) per file.
+    """
+    data_esecuzione = data_esecuzione or date.today()
+    files = pianifica_sdd(incassi_list, data_esecuzione, max_transazioni, max_importo)
+    for i, blocchi in enumerate(files, 1):
+        buf = io.BytesIO()
+        scrivi_sdd(buf, fatturante, blocchi)
+        suffisso = f"_{i:02d}" if len(files) > 1 else ""
+        yield buf.getvalue(), f"SDD_{blocchi[0][0].isoformat()}{suffisso}.xml", blocchi
 
-    for inc in incassi_list:
-        cl = inc["cliente"]
-        importo = _r2(inc["importo"])
-        e2e = inc.get("end_to_end_id", f"E2E-{uuid.uuid4().hex[:12].upper()}")
-
-        dd = _el(pi, "DrctDbtTxInf")
-        pid = _el(dd, "PmtId"); _el(pid, "EndToEndId", e2e[:35])
-        amt = _el(dd, "InstdAmt", str(importo)); amt.set("Ccy", "EUR")
-
-        ddt = _el(dd, "DrctDbtTx"); mri = _el(ddt, "MndtRltdInf")
-        _el(mri, "MndtId", cl.rif_mandato_sdd or f"MAND-{cl.id}")
-        _el(mri, "DtOfSgntr",
-            cl.data_mandato_sdd.isoformat() if cl.data_mandato_sdd else date.today().isoformat())
 
-        dbtr = _el(dd, "Dbtr"); _el(dbtr, "Nm", cl.denominazione[:70])
-        da = _el(dd, "DbtrAcct"); dai = _el(da, "Id"); _el(dai, "IBAN", cl.iban_sdd.replace(" ", ""))
-        dag = _el(dd, "DbtrAgt"); dfi = _el(dag, "FinInstnId"); _el(dfi, "BIC", "NOTPROVIDED")
-        ri = _el(dd, "RmtInf"); _el(ri, "Ustrd", inc.get("prestazione_descrizione", "Pagamento")[:140])
-
-    return etree.tostring(root, xml_declaration=True, encoding="UTF-8", pretty_print=True).decode()
+def genera_sdd_xml(fatturante, incassi_list, data_esecuzione=None):
+    """Un solo tracciato (senza limiti di divisione) come stringa."""
+    data_esecuzione = data_esecuzione or date.today()
+    blocchi = pianifica_sdd(incassi_list, data_esecuzione, 0, 0)
+    buf = io.BytesIO()
+    scrivi_sdd(buf, fatturante, blocchi[0] if blocchi else [])
+    return buf.getvalue().decode()
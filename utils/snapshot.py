@@ -0,0 +1,30 @@
+"""Copie in sola lettura di righe ORM: dati semplici, condivisibili e picklabili."""
+from types import SimpleNamespace
+from sqlalchemy import inspect
+
+
+class Snapshot(SimpleNamespace):
+    """Attributi della riga al momento della copia; non modificabile."""
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"snapshot in sola lettura: {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"snapshot in sola lettura: {name}")
+
+
+class ClienteSnapshot(Snapshot):
+    @property
+    def denominazione(self):
+        from models import Cliente
+        return Cliente.denominazione.fget(self)
+
+
+def column_keys(model, exclude=()):
+    """Nomi degli attributi-colonna del modello, esclusi quelli indicati."""
+    return [a.key for a in inspect(model).column_attrs if a.key not in exclude]
+
+
+def snapshot(obj, cls=Snapshot, exclude=()):
+    """Copia le colonne (non escluse) di un oggetto ORM in uno snapshot."""
+    return cls(**{k: getattr(obj, k) for k in column_keys(type(obj), exclude)})
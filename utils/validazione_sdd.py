@@ -0,0 +1,199 @@
+"""
+Controlli preventivi sui dati SDD: IBAN (lunghezza per paese e checksum
+mod-97), identificativo creditore SEPA, mandati (riferimento, data, duplicati).
+
+`valida_clienti_sdd` controlla un intero lotto di clienti con un solo passaggio
+numpy: il mod-97 di tutti gli IBAN si calcola una cifra alla volta su una
+matrice lotto × cifre. L'esito per IBAN resta in una cache LRU per (IBAN,
+updated_at), così le anteprime ripetute ricalcolano solo i clienti modificati.
+"""
+import re
+import threading
+from collections import OrderedDict
+from datetime import date
+import numpy as np
+
+# Lunghezza dell'IBAN nei paesi dello schema SEPA
+IBAN_LUNGHEZZE = {
+    "AD": 24, "AT": 20, "BE": 16, "BG": 22, "CH": 21, "CY": 28, "CZ": 24, "DE": 22,
+    "DK": 18, "EE": 20, "ES": 24, "FI": 18, "FR": 27, "GB": 22, "GI": 23, "GR": 27,
+    "HR": 21, "HU": 28, "IE": 22, "IS": 26, "IT": 27, "LI": 21, "LT": 20, "LU": 20,
+    "LV": 21, "MC": 27, "MT": 31, "NL": 18, "NO": 15, "PL": 28, "PT": 25, "RO": 24,
+    "SE": 24, "SI": 19, "SK": 24, "SM": 27, "VA": 22,
+}
+# Caratteri ammessi dallo schema SEPA nei riferimenti (MndtId max 35)
+_RE_MANDATO = re.compile(r"^[A-Za-z0-9/\-?:().,'+ ]{1,35}$")
+_RE_IBAN = re.compile(r"^[A-Z]{2}\d{2}[A-Z0-9]{11,30}$")
+# Lettere → numeri della ISO 13616 (A=10 … Z=35)
+_LETTERE = str.maketrans({chr(c): str(c - 55) for c in range(ord("A"), ord("Z") + 1)})
+
+_CACHE_MAX = 4096
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def normalizza_iban(iban):
+    return re.sub(r"\s+", "", iban or "").upper()
+
+
+# =============================================
+# MOD-97
+# =============================================
+def _mod97(stringhe):
+    """Resto mod 97 delle stringhe alfanumeriche (lettere convertite), come array."""
+    cifre = [s.translate(_LETTERE) for s in stringhe]
+    if not cifre:
+        return np.zeros(0, dtype=np.int64)
+    larghezza = max(len(c) for c in cifre)
+    # Zeri a sinistra: il valore non cambia e la matrice è rettangolare
+    testo = "".join(c.rjust(larghezza, "0") for c in cifre).encode()
+    m = (np.frombuffer(testo, dtype=np.uint8).reshape(len(cifre), larghezza) - 48).astype(np.int64)
+    resto = np.zeros(len(cifre), dtype=np.int64)
+    for j in range(larghezza):
+        resto = (resto * 10 + m[:, j]) % 97
+    return resto
+
+
+def _errori_iban(ibans):
+    """Messaggio d'errore (o None) per ogni IBAN normalizzato."""
+    errori = [None] * len(ibans)
+    da_calcolare = []
+    for i, iban in enumerate(ibans):
+        if not iban:
+            errori[i] = "IBAN SDD mancante"
+        elif not _RE_IBAN.match(iban):
+            errori[i] = f"IBAN {iban} non ben formato"
+        elif IBAN_LUNGHEZZE.get(iban[:2]) is None:
+            errori[i] = f"IBAN {iban}: paese {iban[:2]} fuori dall'area SEPA"
+        elif len(iban) != IBAN_LUNGHEZZE[iban[:2]]:
+            errori[i] = f"IBAN {iban}: lunghezza {len(iban)}, attesa {IBAN_LUNGHEZZE[iban[:2]]}"
+        else:
+            da_calcolare.append(i)
+    resti = _mod97([ibans[i][4:] + ibans[i][:4] for i in da_calcolare])
+    for i in np.asarray(da_calcolare, dtype=np.int64)[resti != 1]:
+        errori[i] = f"IBAN {ibans[i]}: cifre di controllo errate"
+    return errori
+
+
+def iban_errore(iban):
+    """Errore dell'IBAN (str) o None se valido."""
+    return _errori_iban([normalizza_iban(iban)])[0]
+
+
+# =============================================
+# IDENTIFICATIVO CREDITORE
+# =============================================
+def identificativo_creditore(codice_fiscale, paese="IT", codice_attivita="ZZZ"):
+    """
+    Creditor Identifier SEPA: paese, cifre di controllo, codice attività e
+    identificativo nazionale (in Italia il codice fiscale, a 16 caratteri con
+    zeri a sinistra). Le cifre di controllo escludono il codice attività.
+    """
+    nazionale = re.sub(r"[^A-Z0-9]", "", (codice_fiscale or "").upper())
+    if paese == "IT":
+        nazionale = nazionale.rjust(16, "0")
+    controllo = 98 - int(_mod97([nazionale + paese + "00"])[0])
+    return f"{paese}{controllo:02d}{codice_attivita}{nazionale}"
+
+
+def creditore_errore(ci):
+    """Errore dell'identificativo creditore (str) o None se valido."""
+    ci = normalizza_iban(ci)
+    if not re.match(r"^[A-Z]{2}\d{2}[A-Z0-9]{3}[A-Z0-9]{1,28}$", ci):
+        return f"Identificativo creditore {ci} non ben formato"
+    if int(_mod97([ci[7:] + ci[:4]])[0]) != 1:
+        return f"Identificativo creditore {ci}: cifre di controllo errate"
+    return None
+
+
+def valida_creditore(fatturante):
+    """Errori bloccanti del fatturante come creditore SDD (IBAN e codice fiscale)."""
+    errori = []
+    e = iban_errore(fatturante.iban)
+    if e:
+        errori.append(f"{fatturante.ragione_sociale}: {e.replace('IBAN SDD', 'IBAN')}")
+    if not fatturante.codice_fiscale:
+        errori.append(f"{fatturante.ragione_sociale}: codice fiscale mancante per l'identificativo creditore")
+    else:
+        e = creditore_errore(identificativo_creditore(fatturante.codice_fiscale))
+        if e:
+            errori.append(f"{fatturante.ragione_sociale}: {e}")
+    return errori
+
+
+# =============================================
+# CLIENTI
+# =============================================
+def _iban_cache(ibans, aggiornati):
+    """Come _errori_iban() con cache per (IBAN, updated_at); calcola solo i mancanti."""
+    chiavi = list(zip(ibans, aggiornati))
+    errori, mancanti = [None] * len(chiavi), []
+    with _cache_lock:
+        for i, k in enumerate(chiavi):
+            if k in _cache:
+                _cache.move_to_end(k)
+                errori[i] = _cache[k]
+            else:
+                mancanti.append(i)
+    if mancanti:
+        nuovi = _errori_iban([ibans[i] for i in mancanti])
+        with _cache_lock:
+            for i, e in zip(mancanti, nuovi):
+                errori[i] = _cache[chiavi[i]] = e
+            while len(_cache) > _CACHE_MAX:
+                _cache.popitem(last=False)
+    return errori
+
+
+def valida_clienti_sdd(clienti, data_addebito=None):
+    """
+    Controlla i dati SDD di un lotto di clienti (oggetti Cliente o simili).
+    Ritorna {cliente_id: {"errori": [...], "avvisi": [...]}} per i soli clienti
+    con anomalie: gli errori escludono il cliente dal tracciato, gli avvisi no.
+    """
+    clienti = list(clienti)
+    data_addebito = data_addebito or date.today()
+    ibans = [normalizza_iban(c.iban_sdd) for c in clienti]
+    errori_iban = _iban_cache(ibans, [getattr(c, "updated_at", None) for c in clienti])
+
+    rif = np.array([(c.rif_mandato_sdd or "").strip() for c in clienti], dtype=object)
+    date_mandato = np.array([c.data_mandato_sdd or date.min for c in clienti], dtype=object)
+    senza_data = date_mandato == date.min
+    futura = date_mandato > data_addebito
+    # Stesso riferimento mandato su clienti diversi
+    _, inversi, conteggi = np.unique(rif.astype(str), return_inverse=True, return_counts=True)
+    duplicato = (conteggi[inversi] > 1) & (rif != "")
+
+    esito = {}
+    for i, c in enumerate(clienti):
+        errori, avvisi = [], []
+        if not c.sdd_attivo:
+            errori.append("SDD non attivo")
+        if errori_iban[i]:
+            errori.append(errori_iban[i])
+        if not rif[i]:
+            avvisi.append("rif. mandato SDD mancante")
+        elif not _RE_MANDATO.match(rif[i]):
+            errori.append(f"rif. mandato {rif[i]!r} con caratteri non ammessi o oltre 35 caratteri")
+        elif duplicato[i]:
+            errori.append(f"rif. mandato {rif[i]} usato da più clienti")
+        if senza_data[i]:
+            avvisi.append("data mandato SDD mancante")
+        elif futura[i]:
+            errori.append(f"mandato firmato il {c.data_mandato_sdd:%d/%m/%Y}, dopo la data di addebito")
+        if errori or avvisi:
+            esito[c.id] = {"errori": errori, "avvisi": avvisi}
+    return esito
+
+
+def errori_cliente(sdd_attivo, iban, rif_mandato="", data_mandato=None):
+    """Errori bloccanti per il salvataggio di un cliente (nessuno se SDD non attivo e IBAN vuoto)."""
+    iban = normalizza_iban(iban)
+    if not sdd_attivo and not iban:
+        return []
+    errori = [e for e in [_errori_iban([iban])[0]] if e]
+    if rif_mandato and not _RE_MANDATO.match(rif_mandato.strip()):
+        errori.append("Rif. mandato con caratteri non ammessi o oltre 35 caratteri")
+    if data_mandato and data_mandato > date.today():
+        errori.append("Data mandato futura")
+    return errori
@@ -0,0 +1,142 @@
+"""
+Validazione XSD locale dei tracciati generati (FatturaPA 1.2.2, SDD pain.008.001.02).
+
+Gli schemi stanno in utils/xsd/ e vengono compilati una volta per processo; gli
+import remoti (la firma XMLDSig dello schema FatturaPA) si risolvono sui file
+locali, senza accesso alla rete. I lotti grandi si validano nel pool di
+processi di utils/xml_pool.py.
+
+I file in utils/xsd/ sono trascrizioni non ufficiali (la firma XMLDSig è uno
+schema ridotto): se nella cartella si copia lo schema pubblicato con il suo nome
+originale, viene usato al posto della trascrizione. `origine_schemi` dice quale
+file è in uso e se una trascrizione è stata modificata (sha256 in TRASCRITTI).
+"""
+import hashlib
+import os
+import threading
+from lxml import etree
+from config import XML_WORKERS, XML_PARALLELO_SOGLIA
+
+XSD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xsd")
+# Nome del file ufficiale per ogni schema
+SCHEMI = {
+    "fatturapa": "Schema_del_file_FatturaPA_v1.2.2.xsd",
+    "pain.008": "pain.008.001.02.xsd",
+}
+# File ufficiale → trascrizione locale usata quando l'ufficiale manca
+TRASCRIZIONI = {
+    "Schema_del_file_FatturaPA_v1.2.2.xsd": "FatturaPA_v1.2.2_trascritto.xsd",
+    "pain.008.001.02.xsd": "pain.008.001.02_trascritto.xsd",
+    "xmldsig-core-schema.xsd": "xmldsig-core-schema_ridotto.xsd",
+}
+# sha256 delle trascrizioni revisionate
+TRASCRITTI = {
+    "FatturaPA_v1.2.2_trascritto.xsd": "c5b92f879ec49a80a68298fd5f395b2cd8ba8ee292f188cab5354f2d74de1d0d",
+    "pain.008.001.02_trascritto.xsd": "19aceed85c2d077be51d3ef4a67591542939ecf2d4387965a5e211603c0e8685",
+    "xmldsig-core-schema_ridotto.xsd": "f7142d9870f3c03efdb2ec63f8d115dc54bcdf37efd33267a4cfc8310b401b36",
+}
+# Errori riportati al massimo per ogni documento
+MAX_ERRORI = 20
+
+_PARSER = etree.XMLParser(no_network=True, resolve_entities=False)
+_lock = threading.Lock()
+_schemi = {}
+
+
+class XMLNonValido(ValueError):
+    """Documento che non supera la validazione XSD; `errori` come ritornati da valida()."""
+
+    def __init__(self, nome, errori):
+        self.errori = errori
+        super().__init__(f"{nome}: {len(errori)} errori di validazione XSD")
+
+
+def _percorso(ufficiale):
+    """File in XSD_DIR per lo schema `ufficiale`: quello pubblicato se presente, altrimenti la trascrizione."""
+    path = os.path.join(XSD_DIR, ufficiale)
+    if os.path.isfile(path) or ufficiale not in TRASCRIZIONI:
+        return path
+    return os.path.join(XSD_DIR, TRASCRIZIONI[ufficiale])
+
+
+def origine_schemi():
+    """
+    {file ufficiale: origine} per gli schemi usati: "ufficiale" se il file
+    pubblicato è nella cartella, "trascrizione non ufficiale" o, se lo sha256
+    non coincide con TRASCRITTI, "trascrizione non ufficiale MODIFICATA".
+    """
+    esito = {}
+    for ufficiale in TRASCRIZIONI:
+        path = _percorso(ufficiale)
+        nome = os.path.basename(path)
+        if nome == ufficiale:
+            esito[ufficiale] = "ufficiale"
+            continue
+        with open(path, "rb") as f:
+            sha = hashlib.sha256(f.read()).hexdigest()
+        esito[ufficiale] = ("trascrizione non ufficiale" if TRASCRITTI.get(nome) == sha
+                            else "trascrizione non ufficiale MODIFICATA")
+    return esito
+
+
+class _SchemiLocali(etree.Resolver):
+    """Risolve gli schemaLocation (anche remoti) sui file omonimi in XSD_DIR o sulle trascrizioni."""
+
+    def resolve(self, url, pubid, context):
+        path = _percorso(os.path.basename(url or ""))
+        return self.resolve_filename(path, context) if os.path.isfile(path) else None
+
+
+def _compilato(nome):
+    # XMLSchema e relativo lock: validate() scrive error_log sull'oggetto condiviso
+    with _lock:
+        if nome not in _schemi:
+            parser = etree.XMLParser(no_network=True)
+            parser.resolvers.add(_SchemiLocali())
+            doc = etree.parse(_percorso(SCHEMI[nome]), parser)
+            _schemi[nome] = (etree.XMLSchema(doc), threading.Lock())
+        return _schemi[nome]
+
+
+def schema(nome):
+    """XMLSchema compilato per `nome` (chiave di SCHEMI), condiviso nel processo."""
+    return _compilato(nome)[0]
+
+
+def valida(xml, nome):
+    """
+    Valida un documento (str o bytes) contro lo schema `nome`. Ritorna la lista
+    degli errori (vuota se valido): dict con riga, percorso e messaggio.
+    """
+    if isinstance(xml, str):
+        xml = xml.encode("utf-8")
+    try:
+        doc = etree.fromstring(xml, _PARSER)
+    except etree.XMLSyntaxError as e:
+        return [{"riga": e.lineno, "percorso": None, "messaggio": str(e)}]
+    xsd, lock = _compilato(nome)
+    with lock:
+        if xsd.validate(doc):
+            return []
+        log = list(xsd.error_log)[:MAX_ERRORI]
+    return [{"riga": e.line, "percorso": e.path, "messaggio": e.message} for e in log]
+
+
+def valida_lotto(documenti, nome, workers=None):
+    """
+    Valida [(chiave, xml), ...] e ritorna {chiave: errori} dei soli documenti
+    non validi. Oltre XML_PARALLELO_SOGLIA documenti usa il pool di processi.
+    """
+    documenti = list(documenti)
+    workers = XML_WORKERS if workers is None else workers
+    if workers > 1 and len(documenti) >= XML_PARALLELO_SOGLIA:
+        from utils.xml_pool import valida_parallelo
+        risultati = valida_parallelo(documenti, nome, workers)
+    else:
+        risultati = ((chiave, valida(xml, nome)) for chiave, xml in documenti)
+    return {chiave: errori for chiave, errori in risultati if errori}
+
+
+def formatta_errori(errori):
+    """Righe leggibili 'riga N: messaggio' per la UI."""
+    return [f"riga {e['riga']}: {e['messaggio']}" for e in errori]
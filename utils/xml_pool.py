@@ -0,0 +1,102 @@
+"""
+Pool di processi per la generazione XML FatturaPA e dei PDF di cortesia.
+
+I worker ricevono solo snapshot picklabili (nessun oggetto ORM né sessione) e
+restituiscono (xml_str, filename, fattura_id, errori), con gli errori della
+validazione XSD fatta nello stesso worker, oppure (pdf, filename, fattura_id).
+Stili e logo decodificato restano in cache in ogni worker tra un task e l'altro. Il pool usa il contesto "spawn"
+e resta attivo per tutta la vita del processo Streamlit, così il costo di avvio
+dei worker si paga una volta sola.
+"""
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from config import XML_WORKERS
+
+# Fatture per task: abbastanza da ammortizzare il trasferimento tra processi
+CHUNK = 25
+
+_pool = None
+_pool_workers = 0
+_lock = threading.Lock()
+
+
+def get_pool(workers=None):
+    """Pool condiviso del processo (ricreato se cambia il numero di worker)."""
+    global _pool, _pool_workers
+    workers = workers or XML_WORKERS
+    with _lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+        return _pool
+
+
+@atexit.register
+def shutdown():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def snapshot_lotto(lotto):
+    """(fattura, righe, fatturante, cliente) ORM → tuple di snapshot picklabili."""
+    from utils.snapshot import snapshot
+    return [(snapshot(f), [snapshot(p) for p in righe], fatturante, cliente)
+            for f, righe, fatturante, cliente in lotto]
+
+
+def _genera_chunk(chunk, valida=True):
+    from utils.fattura_xml import genera_fattura_xml
+    from utils.validazione_xml import valida as valida_xsd
+    out = []
+    for fattura, righe, fatturante, cliente in chunk:
+        xml_str, filename = genera_fattura_xml(fattura, righe, fatturante, cliente)
+        out.append((xml_str, filename, fattura.id, valida_xsd(xml_str, "fatturapa") if valida else None))
+    return out
+
+
+def _genera_pdf_chunk(chunk):
+    from utils.pdf_generator import genera_fattura_pdf
+    return [(genera_fattura_pdf(fattura, righe, fatturante, cliente),
+             f"Fattura_{fattura.numero}_{fattura.anno}.pdf", fattura.id)
+            for fattura, righe, fatturante, cliente in chunk]
+
+
+def _valida_chunk(chunk, nome):
+    from utils.validazione_xml import valida
+    return [(chiave, valida(xml, nome)) for chiave, xml in chunk]
+
+
+def _mappa(fn, items, workers, *args):
+    pool = get_pool(workers)
+    futures = [pool.submit(fn, items[i:i + CHUNK], *args) for i in range(0, len(items), CHUNK)]
+    for fut in as_completed(futures):
+        yield from fut.result()
+
+
+def genera_parallelo(snapshots, workers=None, valida=True):
+    """
+    Genera (e con valida=True valida) gli XML degli snapshot nel pool e li
+    restituisce man mano che i worker completano (ordine di completamento, non di input).
+    """
+    return _mappa(_genera_chunk, snapshots, workers, valida)
+
+
+def valida_parallelo(documenti, nome, workers=None):
+    """(chiave, errori) per [(chiave, xml), ...], in ordine di completamento."""
+    return _mappa(_valida_chunk, documenti, workers, nome)
+
+
+def genera_pdf_parallelo(snapshots, workers=None):
+    """
+    (pdf, filename, fattura_id) degli snapshot, generati nel pool, in ordine di
+    completamento. Il fatturante dello snapshot deve contenere il logo.
+    """
+    return _mappa(_genera_pdf_chunk, snapshots, workers)